@@ -6,18 +6,66 @@ Automatic rebalancing of AWS EC2 Reserved Instances between Availability Zones
 """
 from __future__ import print_function
 
-from dynamic_ec2reservation.config_handler import get_global_option
+from dynamic_ec2reservation.aws.ec2 import (
+    get_connection_factory, get_regions, get_targets)
+from dynamic_ec2reservation.arrays import (
+    get_scenario_coverage, load_scenarios,
+    get_changes as get_scenario_changes,
+    get_change_diff as get_scenario_diff)
+from dynamic_ec2reservation.changeplan import (
+    get_fingerprint, get_region_plan, read_plan, write_plan,
+    get_modifications as get_plan_modifications)
+from dynamic_ec2reservation.classification import get_unmatched_platforms
+from dynamic_ec2reservation.config_handler import (
+    get_accounts, get_configuration, get_global_option)
 from dynamic_ec2reservation.daemon import Daemon
-from dynamic_ec2reservation.log_handler import LOGGER as logger
+from dynamic_ec2reservation.events import (
+    get_event_feed, collect_events, resolve_events)
+from dynamic_ec2reservation.executor import ModificationBudget, get_tracker
+from dynamic_ec2reservation.inventory import Inventory
+from dynamic_ec2reservation.log_handler import LOGGER as logger, configure_logging
+from dynamic_ec2reservation.metrics import (
+    REGISTRY as metrics, record_inventory, write_textfile, start_http_server)
+from dynamic_ec2reservation.normalization import get_family_units
+from dynamic_ec2reservation.planning import (
+    get_histograms, load_prices, recommend, format_recommendation)
+from dynamic_ec2reservation.priority import (
+    get_priorities, sort_by_priority, format_priority)
+from dynamic_ec2reservation.profiling import (
+    SUMMARY as profile_summary, ROLLING_CYCLES, CycleProfile, start_tracing,
+    write_report)
 from dynamic_ec2reservation.rebalance import (
     get_reservation_pool, get_reserved_instances, get_running_instances,
-    get_changes, get_change_diff, execute_changes)
+    get_instance_changes, get_departed_instances, get_changes,
+    get_size_flexible_changes, get_change_diff, get_modifications,
+    submit_planned_modifications, get_instance_filters)
+from dynamic_ec2reservation.scheduler import Scheduler, is_throttling_error
+from dynamic_ec2reservation.simulation import SimulatedConnectionFactory
+from dynamic_ec2reservation.snapshot import InventorySnapshot
+from dynamic_ec2reservation.state import StateStore, get_state_path
+from dynamic_ec2reservation.store import LAUNCH_MARGIN, get_store
 
 from boto.exception import JSONResponseError, BotoServerError
 
+from collections import namedtuple
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+import fnmatch
+import os.path
+import sqlite3
 import sys
+import threading
 import time
 
+# The outcome of a rebalance cycle in one region. changes is the number of
+# reservation changes found, churn the fraction of the running instances
+# that changed since the previous full scan, and plan the region's part of
+# the change plan when one is written.
+RegionResult = namedtuple(
+    'RegionResult',
+    ['region', 'duration', 'error', 'changes', 'churn', 'plan'])
+
 class DynamicEC2ReservationDaemon(Daemon):
     """ Daemon for Dynamic DynamoDB"""
     def run(self):
@@ -26,13 +74,17 @@ class DynamicEC2ReservationDaemon(Daemon):
         :param check_interval: Delay in seconds between checks
         """
         try:
-            while True:
-                execute()
+            run_loop()
         except Exception as error:
             logger.exception(error)
 
 def main():
     """ Main function called from dynamic-ec2reservation """
+    # Parse and validate the options before anything else, so --help,
+    # --version and configuration errors return straight away
+    get_configuration()
+    configure_logging()
+
     try:
         if get_global_option('daemon'):
             daemon = DynamicEC2ReservationDaemon(
@@ -70,44 +122,971 @@ def main():
                     'stop, restart, and foreground')
                 sys.exit(1)
         else:
-            if get_global_option('run_once'):
+            if get_global_option('plan'):
+                plan()
+            elif get_global_option('what_if'):
+                what_if(get_global_option('what_if'))
+            elif get_global_option('apply_plan'):
+                if not apply_plan(get_global_option('apply_plan')):
+                    sys.exit(1)
+            elif get_global_option('run_once'):
                 execute()
             else:
-                while True:
-                    execute()
+                run_loop()
 
     except Exception as error:
         logger.exception(error)
 
 
-def execute():
-    reserved_instances = get_reserved_instances()
-    reservation_pool = get_reservation_pool()
-    running_instances = get_running_instances()
+def run_loop(connection_factory=None):
+    """ Rebalance until stopped, either on the check schedule or, with an
+    event source configured, whenever instance events arrive. A failed cycle
+    is logged and retried after a backoff.
+
+    :type connection_factory: callable
+    :param connection_factory: Returns an EC2 connection for a region name.
+        Defaults to connections built from the global options
+    """
+    if get_global_option('metrics_port'):
+        start_http_server(get_global_option('metrics_port'))
+
+    if get_global_option('event_source'):
+        if get_accounts():
+            logger.warning('Instance events cannot be matched to the '
+                           'configured accounts, which are only rebalanced '
+                           'on the check schedule')
+        run_event_loop(
+            get_event_feed(get_global_option('event_source')),
+            connection_factory)
+        return
+
+    while True:
+        try:
+            execute(connection_factory)
+        except Exception as error:
+            logger.exception('Rebalance cycle failed: {0}'.format(error))
+            scheduler = get_scheduler()
+            scheduler.record(errors=[error])
+            scheduler.wait()
+
+
+def run_event_loop(feed, connection_factory=None):
+    """ Rebalance the instance types affected by the events on a feed as
+    they arrive. The events are applied to the running instance counts kept
+    from the last full scan, so only the instances they name are described.
+    A full rebalance of every region still runs each check interval, to
+    pick up anything the events missed.
+
+    :type feed: dynamic_ec2reservation.events.EventFeed
+    :param feed: The instance events to follow
+    :type connection_factory: callable
+    :param connection_factory: Returns an EC2 connection for a region name.
+        Defaults to connections built from the global options
+    """
+    connection_factory = connection_factory or get_connection_factory()
+    scheduler = get_scheduler()
+
+    # With counts saved by a previous run, events can be applied straight
+    # away and the first full check waits for its turn
+    next_check = 0
+    scanned_at = []
+    for region in get_regions(connection_factory):
+        __restore_region(region, connection_factory)
+        scanned_at.append(get_store(
+            region, get_global_option('full_scan_interval')).scanned_at)
+    if scanned_at and None not in scanned_at:
+        next_check = min(scanned_at) + scheduler.interval
+
+    while True:
+        if time.time() >= next_check:
+            try:
+                __record_cycle(scheduler, rebalance_regions(connection_factory))
+            except Exception as error:
+                logger.exception('Rebalance cycle failed: {0}'.format(error))
+                scheduler.record(errors=[error])
+
+            delay = scheduler.next_delay()
+            next_check = time.time() + delay
+            logger.debug('Waiting for events, next full check in {0:.0f} '
+                         'seconds'.format(delay))
+            continue
+
+        events = collect_events(
+            feed,
+            get_global_option('event_window'),
+            next_check - time.time())
+        if not events:
+            continue
+
+        try:
+            __rebalance_events(events, connection_factory)
+        except Exception as error:
+            logger.exception('Event driven rebalance failed: {0}'.format(
+                error))
+
+
+def __rebalance_events(events, connection_factory):
+    """ Apply a batch of events to the inventory stores and rebalance the
+    groups they touched
+
+    :type events: list of dynamic_ec2reservation.events.InstanceEvent
+    :param events: The events to handle
+    :type connection_factory: callable
+    :param connection_factory: Returns an EC2 connection for a region name
+    """
+    scopes = {}
+    for region, region_events in resolve_events(
+            events, get_regions(connection_factory),
+            connection_factory).iteritems():
+        if region_events is None:
+            scopes[region] = None
+            continue
+
+        touched = get_store(
+            region, get_global_option('full_scan_interval')).apply(
+                region_events)
+        if touched:
+            scopes[region] = touched
+
+    logger.info('Received {0} instance events, rebalancing {1}'.format(
+        len(events), ', '.join(
+            '{0} ({1})'.format(
+                region,
+                'all' if scope is None else
+                ', '.join('/'.join(group) for group in sorted(scope)))
+            for region, scope in sorted(scopes.items())) or 'nothing'))
+    if scopes:
+        rebalance_regions(connection_factory, scopes)
+
+
+def execute(connection_factory=None):
+    """ Run one rebalance cycle for every configured region, then sleep until
+    the next check
+
+    :type connection_factory: callable
+    :param connection_factory: Returns an EC2 connection for a region name.
+        Defaults to connections built from the global options
+    """
+    results = rebalance_regions(connection_factory)
+
+    # Sleep between the checks
+    if not get_global_option('run_once'):
+        scheduler = get_scheduler()
+        __record_cycle(scheduler, results)
+        slept = scheduler.wait()
+
+        if __is_profiling():
+            profile_summary.add_sleep(slept)
+            logger.info('Profile of the last {0} cycles: {1}'.format(
+                min(profile_summary.cycles, ROLLING_CYCLES),
+                profile_summary.format()))
+
+
+__SCHEDULERS = {}
+
+def plan(connection_factory=None):
+    """ Print reservation purchase recommendations for every configured
+    region, from the running instance counts recorded by previous cycles
+
+    :type connection_factory: callable
+    :param connection_factory: Returns an EC2 connection for a region name.
+        Defaults to connections built from the global options
+    """
+    state = get_state(connection_factory)
+    if state is None:
+        logger.error('Planning needs the running instance counts kept in '
+                     'the state file')
+        return
+
+    if not get_global_option('describe_all_instances'):
+        logger.info('Cycles without --describe-all-instances only record the '
+                    'reserved instance types, so only those are planned for')
+
+    prices = None
+    if get_global_option('price_file'):
+        prices = load_prices(get_global_option('price_file'))
+
+    since = time.time() - get_global_option('plan_days') * 86400
+    for target in get_targets(connection_factory):
+        total_hours = state.count_sample_hours(target.name, since)
+        if not total_hours:
+            print('{0}: No running instance counts recorded in the last {1} '
+                  'days'.format(target.name, get_global_option('plan_days')))
+            continue
+
+        reserved_pool = get_reservation_pool(get_reserved_instances(
+            InventorySnapshot(target.connection_factory(target.region))))
+        recommendations = recommend(
+            get_histograms(state.iter_group_samples(target.name, since)),
+            total_hours, reserved_pool, get_global_option('plan_percentile'),
+            prices)
+
+        print('{0}: {1} recommendations from {2} hours of samples'.format(
+            target.name, len(recommendations), total_hours))
+        for recommendation in recommendations:
+            print('  {0}'.format(format_recommendation(recommendation)))
+
+
+def what_if(path, connection_factory=None):
+    """ Print how many running instances of each fleet in a scenario file
+    the reservations of every configured region would cover once
+    rebalanced, and how many reservations would move to get there
+
+    :type path: str
+    :param path: The scenario file, see
+        dynamic_ec2reservation.arrays.load_scenarios
+    :type connection_factory: callable
+    :param connection_factory: Returns an EC2 connection for a region name.
+        Defaults to connections built from the global options
+    """
+    scenarios = load_scenarios(path)
+    fleets = [running for _, running in scenarios]
+    for target in get_targets(connection_factory):
+        reserved_instances = get_reserved_instances(
+            InventorySnapshot(target.connection_factory(target.region)))
+        reservation_pool = get_reservation_pool(reserved_instances)
+        coverage = get_scenario_coverage(reserved_instances, fleets)
+
+        print('{0}: {1} scenarios against {2} reservations'.format(
+            target.name, len(scenarios),
+            sum(reservation_pool.itervalues())))
+        for (name, running), covered in zip(scenarios, coverage):
+            diff = get_scenario_diff(
+                reserved_instances, get_scenario_changes(
+                    reservation_pool, running, reserved_instances))
+            moved = sum(
+                max(count - reserved_instances[key], 0)
+                for key, count in diff.iteritems())
+            print('  {0}: {1} of {2} running instances covered, {3} '
+                  'reservations moved'.format(
+                      name, covered, sum(running.totals().itervalues()),
+                      moved))
+
+
+def get_scheduler():
+    """ Get the check scheduler of this instance, kept for the life of the
+    process
+
+    :returns: dynamic_ec2reservation.scheduler.Scheduler
+    """
+    instance = get_global_option('instance')
+    if instance not in __SCHEDULERS:
+        __SCHEDULERS[instance] = Scheduler(
+            get_global_option('check_interval'),
+            get_global_option('min_check_interval'),
+            get_global_option('max_check_interval'),
+            instance)
+
+    return __SCHEDULERS[instance]
+
+
+def __record_cycle(scheduler, results):
+    """ Tell the scheduler how a cycle over all regions went. Regions that
+    failed back off on their own; the whole schedule only backs off when
+    every region failed.
+
+    :type scheduler: dynamic_ec2reservation.scheduler.Scheduler
+    :param scheduler: The check scheduler
+    :type results: list of RegionResult
+    :param results: The outcome in each region
+    """
+    for result in results:
+        scheduler.record_target(result.region, result.error)
+
+    errors = [result.error for result in results if result.error]
+    healthy = [result for result in results if not result.error]
+    scheduler.record(
+        changes=sum(result.changes for result in healthy),
+        churn=max([result.churn for result in healthy] or [0.0]),
+        errors=errors if not healthy else [])
+
+
+def rebalance_regions(connection_factory=None, scopes=None):
+    """ Run one rebalance cycle for every configured region of every
+    account. Regions are rebalanced concurrently, up to the
+    max_concurrent_regions option over all accounts, each with its own
+    connection, and a failure in one region does not stop the others.
+
+    :type connection_factory: callable
+    :param connection_factory: Returns an EC2 connection for a region name
+        of the default account. Defaults to connections built from the
+        global options
+    :type scopes: dict
+    :param scopes: Limits the cycle to some instance types, as
+        {name: set of (platform, netloc, instance_type), or None for the
+        whole region}, where the name is the region, or ACCOUNT/REGION for
+        the configured accounts. Only the regions in it are rebalanced.
+        Defaults to everything in every region
+    :returns: list of RegionResult
+    """
+    targets = get_targets(connection_factory)
+    if scopes is not None:
+        targets = [target for target in targets if target.name in scopes]
+    else:
+        scopes = {}
+
+    scheduler = get_scheduler()
+    backing_off = [
+        target.name for target in targets
+        if not scheduler.is_due(target.name)]
+    if backing_off:
+        logger.info('Skipping regions backing off after errors: {0}'.format(
+            ', '.join(backing_off)))
+        targets = [
+            target for target in targets if target.name not in backing_off]
+        if not targets:
+            return []
+
+    if len(targets) == 1:
+        results = [__execute_target(targets[0], scopes)]
+    else:
+        pool = ThreadPool(min(
+            len(targets), get_global_option('max_concurrent_regions')))
+        try:
+            results = pool.map(
+                lambda target: __execute_target(target, scopes), targets)
+        finally:
+            pool.close()
+            pool.join()
+
+    if len(targets) > 1:
+        failed = [result.region for result in results if result.error]
+        logger.info('Rebalanced {0} regions, {1} failed{2}'.format(
+            len(targets), len(failed),
+            ': {0}'.format(', '.join(failed)) if failed else ''))
+
+    if get_global_option('plan_out'):
+        __write_plan(results)
+
+    if get_global_option('metrics_file'):
+        write_textfile(get_global_option('metrics_file'))
+
+    return results
+
+
+def __write_plan(results):
+    """ Write the change plan of a cycle to the plan_out file. Regions that
+    failed are left out.
+
+    :type results: list of RegionResult
+    :param results: The outcome in each region
+    """
+    path = get_global_option('plan_out')
+    region_plans = [result.plan for result in results if result.plan]
+    try:
+        write_plan(path, region_plans)
+    except (IOError, OSError) as error:
+        logger.error('Could not write change plan to {0}: {1}'.format(
+            path, error))
+        return
+
+    logger.info('Wrote {0} modifications in {1} regions to {2}'.format(
+        sum(len(region_plan['modifications'])
+            for region_plan in region_plans),
+        len(region_plans), path))
+
+
+def apply_plan(path, connection_factory=None):
+    """ Submit the modifications of a saved change plan without computing
+    them again. A region is skipped if its reservations changed since the
+    plan was made, or if any of the reservations to modify is still being
+    modified.
+
+    :type path: str
+    :param path: The plan file, as written with the plan_out option
+    :type connection_factory: callable
+    :param connection_factory: Returns an EC2 connection for a region name
+        of the default account. Defaults to connections built from the
+        global options
+    :returns: bool, whether every region of the plan was applied
+    """
+    plan = read_plan(path)
+    targets = dict(
+        (target.name, target) for target in get_targets(connection_factory))
+
+    applied = True
+    for region_plan in plan['regions']:
+        name = region_plan['name']
+        target = targets.get(name)
+        if target is None:
+            logger.error('{0}: Not a configured region, skipping'.format(name))
+            applied = False
+            continue
+
+        __restore_region(name, target.connection_factory)
+        snapshot = InventorySnapshot(
+            target.connection_factory(target.region))
+        tracker = get_tracker(name)
+        tracker.refresh(snapshot)
+
+        if get_fingerprint(snapshot) != region_plan['fingerprint']:
+            logger.error('{0}: Reservations changed since the plan was made, '
+                         'refusing to apply it'.format(name))
+            applied = False
+            continue
+
+        modifications = get_plan_modifications(region_plan)
+        busy = tracker.busy_reservation_ids.intersection(
+            reservation_id for modification in modifications
+            for reservation_id in modification.reservation_ids)
+        if busy:
+            logger.error('{0}: Reservations still being modified: {1}, '
+                         'refusing to apply the plan'.format(
+                             name, ', '.join(sorted(busy))))
+            applied = False
+            continue
+
+        for modification in modifications:
+            logger.info('{0}: Modifying {1} into {2}'.format(
+                name, ', '.join(modification.reservation_ids),
+                '; '.join('{0}: {1}'.format(key[3], count)
+                          for key, count in modification.configurations)))
+
+        if get_global_option('dry_run') or not modifications:
+            continue
+
+        submit_planned_modifications(
+            modifications, snapshot, tracker,
+            get_global_option('max_concurrent_modifications'))
+        logger.info('{0}: {1}'.format(name, tracker.summary()))
+
+        state = get_state(target.connection_factory)
+        if state is not None:
+            try:
+                state.save_modifications(name, dict(tracker.in_flight))
+                state.record_changes(
+                    name,
+                    set(modification.group for modification in modifications),
+                    time.time())
+            except sqlite3.Error as error:
+                logger.warning('{0}: Could not save state: {1}'.format(
+                    name, error))
+
+    return applied
+
+
+def __execute_target(target, scopes):
+    """ Run one rebalance cycle in the region of an account
 
-    changes = get_changes(reservation_pool, running_instances)
+    :type target: dynamic_ec2reservation.aws.ec2.Target
+    :param target: The region and account
+    :type scopes: dict
+    :param scopes: {name: scope}, as passed to rebalance_regions
+    :returns: RegionResult
+    """
+    return execute_region(
+        target.region, target.connection_factory, scopes.get(target.name),
+        target.name)
 
-    logstring = "Changing platform: {0}; network type: {1}; instance type: {2} to AZ members: {3}"
-    diff = get_change_diff(reserved_instances, changes)
 
-    if diff != {}:
-        for platform in diff.keys():
-            for netloc in diff[platform].keys():
-                for instance_type in diff[platform][netloc].keys():
+def execute_region(region, connection_factory, scope=None, name=None):
+    """ Run one rebalance cycle in a single region
+
+    :type region: str
+    :param region: The AWS region to rebalance
+    :type connection_factory: callable
+    :param connection_factory: Returns an EC2 connection for a region name
+    :type scope: set
+    :param scope: (platform, netloc, instance_type) groups to limit the
+        cycle to. Defaults to every group
+    :type name: str
+    :param name: The name the region's state, metrics and logs are kept
+        under. Defaults to the region
+    :returns: RegionResult
+    """
+    name = name or region
+    start = time.time()
+    try:
+        changes, churn, plan = __rebalance(
+            region, connection_factory, scope, name)
+    except Exception as error:
+        duration = time.time() - start
+        logger.exception('{0}: Rebalance failed after {1:.2f} seconds: {2}'.format(
+            name, duration, error))
+        metrics.inc('dynamic_ec2reservation_cycle_errors_total', region=name)
+        if is_throttling_error(error):
+            metrics.inc(
+                'dynamic_ec2reservation_throttled_total', region=name)
+        return RegionResult(name, duration, error, 0, 0.0, None)
+
+    duration = time.time() - start
+    metrics.observe(
+        'dynamic_ec2reservation_cycle_duration_seconds', duration,
+        region=name)
+    logger.info('{0}: Rebalance finished in {1:.2f} seconds'.format(
+        name, duration))
+    return RegionResult(name, duration, None, changes, churn, plan)
+
+
+def __rebalance(region, connection_factory, scope=None, name=None):
+    """ Describe, compute and apply the reservation changes for a region
+
+    :type region: str
+    :param region: The AWS region to rebalance
+    :type connection_factory: callable
+    :param connection_factory: Returns an EC2 connection for a region name
+    :type scope: set
+    :param scope: (platform, netloc, instance_type) groups to limit the
+        cycle to, using the running instance counts in the inventory store.
+        Defaults to a full scan of every group
+    :type name: str
+    :param name: The name the region's state, metrics and logs are kept
+        under. Defaults to the region
+    :returns: tuple of (number of changes, fraction of running instances
+        that changed since the previous full scan, the region's change plan
+        or None)
+    """
+    name = name or region
+    __restore_region(name, connection_factory)
+
+    flexible = get_global_option('instance_size_flexibility')
+    store = get_store(name, get_global_option('full_scan_interval'))
+    tracker = get_tracker(name)
+    if scope is not None and store.needs_full_scan():
+        logger.debug('{0}: Full scan due, rebalancing every group'.format(
+            name))
+        scope = None
+    elif scope is not None and tracker.deferred:
+        # Changes the budget left over last cycle are due in this one
+        scope = set(scope).union(tracker.deferred)
+
+    in_scope = None
+    if scope is not None:
+        in_scope = __get_scope_predicate(scope, flexible)
+
+    profile = None
+    if __is_profiling():
+        start_tracing()
+        profile = CycleProfile(
+            name, capture=bool(get_global_option('profile_dir')))
+
+    overlap = get_global_option('max_concurrent_requests')
+    snapshot = InventorySnapshot(connection_factory(region), overlap)
+    only = __get_only_predicate()
+    describe_all = not in_scope and not only and \
+        get_global_option('describe_all_instances')
+
+    # Without filters, the running instances do not depend on the
+    # reservations and are described alongside them
+    all_running = None
+    if overlap and describe_all and not store.can_merge({}):
+        background = ThreadPool(1)
+        all_running = background.apply_async(
+            __scan_instances, (snapshot, {}, 1, store.tracks_instances))
+        background.close()
+
+    # Check on modifications in flight before describing the reservations,
+    # so a modification finishing in between leaves its group marked busy
+    with __phase(profile, name, 'refresh_modifications'):
+        tracker.refresh(snapshot, background=bool(overlap))
+
+    with __phase(profile, name, 'describe_reserved'):
+        reserved_instances = get_reserved_instances(snapshot)
+
+    if only:
+        reserved_instances = reserved_instances.filter(only)
+
+    churn = 0.0
+    if in_scope:
+        reserved_instances = reserved_instances.filter(in_scope)
+        running_instances = store.get_running(in_scope)
+    else:
+        filters = {}
+        if not describe_all:
+            filters = get_instance_filters(reserved_instances, flexible)
+
+        scan = None
+        with __phase(profile, name, 'describe_instances'):
+            if all_running is not None:
+                scan = all_running.get()
+            elif filters is not None and store.can_merge(filters):
+                # Only the instances launched or stopped since the last
+                # describe are needed to bring the counts up to date
+                launched, departed = get_instance_changes(
+                    snapshot, filters, store.updated_at)
+            elif filters is not None:
+                scan = __scan_instances(
+                    snapshot, filters, overlap, store.tracks_instances)
+            else:
+                logger.debug('{0}: No reservations, not describing the '
+                             'running instances'.format(name))
+                scan = (Inventory(), None, None)
+
+        if scan is None:
+            if only:
+                launched = __filter_instances(launched, only)
+                departed = __filter_instances(departed, only)
+            changed = store.merge(launched, departed)
+            running_instances = Inventory(store.running.iteritems())
+            logger.debug('{0}: Counted {1} instances up or down since the '
+                         'last describe'.format(name, changed))
+        else:
+            running_instances, instances, scanned_at = scan
+            if only:
+                running_instances = running_instances.filter(only)
+                if instances:
+                    instances = __filter_instances(instances, only)
+            changed = store.replace(
+                running_instances, scanned_at, instances, filters)
+        churn = changed / float(
+            max(sum(running_instances.totals().values()), 1))
+
+        unmatched = get_unmatched_platforms(
+            reserved_instances, running_instances)
+        if unmatched:
+            logger.warning(
+                '{0}: No running instance is classified as {1}, so their '
+                'reservations are not rebalanced. Running instances are only '
+                'told apart from plain linux or windows by their platform '
+                'details, which EC2 does not return to this version of '
+                'boto, or as Red Hat or SUSE by their image.'.format(
+                    name, ', '.join(unmatched)))
+    reservation_pool = get_reservation_pool(reserved_instances)
+
+    with __phase(profile, name, 'compute_changes'):
+        group_key = None
+        if flexible:
+            changes, group_key = get_size_flexible_changes(
+                reserved_instances, running_instances)
+        else:
+            changes = get_changes(
+                reservation_pool, running_instances, reserved_instances)
+
+        diff = get_change_diff(reserved_instances, changes, group_key)
+
+    changed_groups = set()
+    modifications = []
+    logstring = "{0}: Changing platform: {1}; network type: {2}; instance type: {3} to AZ members: {4}"
+
+    if diff:
+        nested_diff = diff.to_nested()
+        for platform in nested_diff.keys():
+            for netloc in nested_diff[platform].keys():
+                for instance_type in nested_diff[platform][netloc].keys():
                     logger.info(
                         logstring.format(
-                            platform, netloc, instance_type,
-                            '; '.join("{0}: {1}".format(key, val) for (key, val) in diff[platform][netloc][instance_type].items())))
+                            name, platform, netloc, instance_type,
+                            '; '.join("{0}: {1}".format(key, val) for (key, val) in nested_diff[platform][netloc][instance_type].items())))
 
-        if not get_global_option('dry_run'):
-            execute_changes(diff)
+        priorities = get_priorities(
+            diff, reserved_instances, running_instances, group_key,
+            __get_prices())
+        modifications = sort_by_priority(
+            get_modifications(diff, snapshot, group_key, tracker),
+            priorities)
 
     else:
-        logger.debug('No changes needed')
+        logger.debug('{0}: No changes needed'.format(name))
 
+    if not get_global_option('dry_run') and \
+            not get_global_option('plan_out'):
+        budget = ModificationBudget(
+            get_global_option('max_modifications_per_cycle'),
+            get_global_option('modification_time_budget'))
+        if modifications:
+            with __phase(profile, name, 'execute'):
+                submit_planned_modifications(
+                    modifications, snapshot, tracker,
+                    get_global_option('max_concurrent_modifications'),
+                    budget)
 
-    # Sleep between the checks
-    if not get_global_option('run_once'):
-        logger.debug('Sleeping {0} seconds until next check'.format(
-            get_global_option('check_interval')))
-        time.sleep(get_global_option('check_interval'))
+        tracker.deferred = frozenset(
+            request.group for request in budget.deferred)
+        changed_groups = set(
+            modification.group for modification in modifications
+            if modification.group not in tracker.deferred)
+        if tracker.deferred:
+            logger.info(
+                '{0}: Budget used up, deferring {1} modifications to the '
+                'next cycle: {2}'.format(
+                    name, len(budget.deferred), '; '.join(
+                        '{0} ({1})'.format(
+                            '/'.join(request.group),
+                            format_priority(priorities[request.group]))
+                        for request in budget.deferred)))
+        metrics.set(
+            'dynamic_ec2reservation_deferred_modifications',
+            len(budget.deferred), region=name)
+
+    plan = None
+    if get_global_option('plan_out'):
+        plan = get_region_plan(
+            name, region, get_fingerprint(snapshot), modifications)
+
+    tracker.join()
+    if tracker.submitted or tracker.failed:
+        logger.info('{0}: {1}'.format(name, tracker.summary()))
+
+    logger.debug('{0}: Made {1} EC2 API calls this cycle ({2})'.format(
+        name,
+        snapshot.api_call_count,
+        ', '.join('{0}: {1}'.format(action, count)
+                  for (action, count) in sorted(snapshot.api_calls.items()))))
+
+    for action, count in snapshot.api_calls.iteritems():
+        metrics.inc(
+            'dynamic_ec2reservation_api_calls_total', count,
+            region=name, action=action)
+    metrics.set('dynamic_ec2reservation_changes', len(diff), region=name)
+    record_inventory(
+        name, reserved_instances, running_instances, replace=not in_scope)
+
+    __save_region(name, store, tracker, changed_groups, connection_factory)
+
+    if profile:
+        profile_summary.add(profile)
+        logger.info('{0}: Profile: {1}'.format(name, profile.format()))
+        if get_global_option('profile_dir'):
+            write_report(get_global_option('profile_dir'), profile)
+
+    return len(diff), churn, plan
+
+
+def __get_prices():
+    """ Get the prices from the price file, reading it again whenever it
+    changes. Returns None without a price file or when it cannot be read.
+
+    :returns: dict of (platform, instance_type) -> (on demand, reserved)
+    """
+    path = get_global_option('price_file')
+    if not path:
+        return None
+
+    try:
+        modified = os.path.getmtime(os.path.expanduser(path))
+        with __PRICES_LOCK:
+            if path not in __PRICES or __PRICES[path][0] != modified:
+                __PRICES[path] = (modified, load_prices(path))
+
+            return __PRICES[path][1]
+    except (IOError, OSError, ValueError, KeyError) as error:
+        logger.warning('Could not read the price file {0}: {1}'.format(
+            path, error))
+        return None
+
+def __is_profiling():
+    """ Whether the cycles should be profiled
+
+    :returns: bool
+    """
+    return bool(
+        get_global_option('profile') or get_global_option('profile_dir'))
+
+
+@contextmanager
+def __phase(profile, region, name):
+    """ Time a phase of a rebalance cycle for the metrics, and for the
+    profile when profiling
+
+    :type profile: dynamic_ec2reservation.profiling.CycleProfile
+    :param profile: The profile of the cycle, or None
+    :type region: str
+    :param region: The AWS region
+    :type name: str
+    :param name: The phase name
+    """
+    with metrics.timer(
+            'dynamic_ec2reservation_phase_duration_seconds',
+            region=region, phase=name):
+        if profile is None:
+            yield
+        else:
+            with profile.stage(name):
+                yield
+
+
+__PRICES = {}
+__PRICES_LOCK = threading.Lock()
+
+__STATES = {}
+__STATES_LOCK = threading.Lock()
+__RESTORED_REGIONS = set()
+
+def get_state(connection_factory=None):
+    """ Get the state store of this instance, kept for the life of the
+    process. There is none when simulating, or when the database cannot be
+    opened.
+
+    :type connection_factory: callable
+    :param connection_factory: The connection factory the state is for.
+        Simulated fleets, e.g. the benchmark's, never keep state, so they
+        cannot overwrite the state of a real daemon.
+    :returns: dynamic_ec2reservation.state.StateStore or None
+    """
+    if get_global_option('simulate') or \
+            isinstance(connection_factory, SimulatedConnectionFactory):
+        return None
+
+    path = get_global_option('state_file') or get_state_path(
+        get_global_option('pid_file_dir'), get_global_option('instance'))
+    with __STATES_LOCK:
+        if path not in __STATES:
+            try:
+                __STATES[path] = StateStore(path)
+            except sqlite3.Error as error:
+                logger.warning(
+                    'Could not open state file {0}, state will not be '
+                    'kept across restarts: {1}'.format(path, error))
+                __STATES[path] = None
+
+        return __STATES[path]
+
+
+def __restore_region(region, connection_factory=None):
+    """ Load the state a previous run saved for a region, once per process
+
+    :type region: str
+    :param region: The AWS region
+    :type connection_factory: callable
+    :param connection_factory: The connection factory of the region
+    """
+    state = get_state(connection_factory)
+    with __STATES_LOCK:
+        if state is None or region in __RESTORED_REGIONS:
+            return
+        __RESTORED_REGIONS.add(region)
+
+    saved = state.load_inventory(region)
+    if saved:
+        get_store(region, get_global_option('full_scan_interval')).restore(
+            *saved)
+        logger.info('{0}: Restored running instance counts from a scan '
+                    '{1:.0f} seconds ago'.format(
+                        region, time.time() - saved[1]))
+
+    in_flight = state.load_modifications(region)
+    if in_flight:
+        get_tracker(region).restore(in_flight)
+        logger.info('{0}: Following up on {1} modifications submitted by a '
+                    'previous run'.format(region, len(in_flight)))
+
+    changes = state.load_changes(region)
+    if changes:
+        logger.debug('{0}: Reservations last changed {1:.0f} seconds '
+                     'ago'.format(region, time.time() - max(changes.values())))
+
+
+def __save_region(region, store, tracker, changed_groups,
+                  connection_factory=None):
+    """ Save the state of a region after a cycle
+
+    :type region: str
+    :param region: The AWS region
+    :type store: dynamic_ec2reservation.store.InventoryStore
+    :param store: The running instance counts
+    :type tracker: dynamic_ec2reservation.executor.ModificationTracker
+    :param tracker: The modifications in flight
+    :type changed_groups: set
+    :param changed_groups: Groups with modifications submitted this cycle
+    :type connection_factory: callable
+    :param connection_factory: The connection factory of the region
+    """
+    state = get_state(connection_factory)
+    if state is None:
+        return
+
+    try:
+        state.save_inventory(
+            region, store.running, store.scanned_at, store.incremental_cycles,
+            store.get_tracked())
+        state.save_modifications(region, dict(tracker.in_flight))
+        if changed_groups:
+            state.record_changes(region, changed_groups, time.time())
+        if store.scanned_at is not None:
+            state.record_sample(region, store.running, time.time())
+    except sqlite3.Error as error:
+        logger.warning('{0}: Could not save state: {1}'.format(region, error))
+
+
+def __scan_instances(snapshot, filters, shards, track):
+    """ Describe the running instances for a full scan
+
+    :type snapshot: dynamic_ec2reservation.snapshot.InventorySnapshot
+    :param snapshot: The inventory snapshot for this cycle
+    :type filters: dict
+    :param filters: The DescribeInstances filters
+    :type shards: int
+    :param shards: Most DescribeInstances calls to page through at once
+    :type track: bool
+    :param track: Whether to collect the instances the inventory store
+        tracks by id: those that are not running, described first, and
+        those launched shortly before the scan
+    :returns: tuple of (Inventory of running instances, dict of instance
+        id -> (key, whether it is counted) or None, when the scan started)
+    """
+    scanned_at = time.time()
+    instances = None
+    launched = None
+    if track:
+        instances = dict(
+            (instance_id, (key, False)) for instance_id, (key, _)
+            in get_departed_instances(snapshot, filters).iteritems())
+        launched = {}
+
+    running = get_running_instances(
+        snapshot, filters, shards, scanned_at - LAUNCH_MARGIN, launched)
+    if track:
+        instances.update(
+            (instance_id, (key, True))
+            for instance_id, key in launched.iteritems())
+
+    return running, instances, scanned_at
+
+
+def __filter_instances(instances, predicate):
+    """ Keep the instances whose key a predicate accepts
+
+    :type instances: dict
+    :param instances: instance id -> tuple starting with the key
+    :type predicate: callable
+    :param predicate: Called with each key
+    :returns: dict
+    """
+    return dict(
+        (instance_id, value) for instance_id, value in instances.iteritems()
+        if predicate(value[0]))
+
+
+def __get_only_predicate():
+    """ Get a key predicate for the only_types and only_platforms options.
+    Instance types can have shell style wildcards, e.g. m4.*.
+
+    :returns: callable, or None when neither option is set
+    """
+    only_types = [
+        instance_type.strip()
+        for instance_type in (get_global_option('only_types') or '').split(',')
+        if instance_type.strip()]
+    only_platforms = set(
+        platform.strip().lower()
+        for platform in (get_global_option('only_platforms') or '').split(',')
+        if platform.strip())
+    if not only_types and not only_platforms:
+        return None
+
+    return lambda key: \
+        (not only_platforms or key[0] in only_platforms) and \
+        (not only_types or any(
+            fnmatch.fnmatchcase(key[2], instance_type)
+            for instance_type in only_types))
+
+
+def __get_scope_predicate(scope, flexible):
+    """ Get a key predicate that limits a rebalance to a scope. With
+    instance size flexibility, whole families are in scope, since any size
+    in a family can take over its reservations.
+
+    :type scope: set
+    :param scope: (platform, netloc, instance_type) groups
+    :type flexible: bool
+    :param flexible: Whether instance size flexibility is enabled
+    :returns: callable
+    """
+    if not flexible:
+        return lambda key: key[:3] in scope
+
+    families = set(
+        (platform, netloc, get_family_units(instance_type)[0])
+        for platform, netloc, instance_type in scope)
+    return lambda key: \
+        (key[0], key[1], get_family_units(key[2])[0]) in families
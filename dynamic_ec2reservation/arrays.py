@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Array backed inventories
+
+Vectorised versions of the placement and diff steps for when NumPy is
+installed. Every (platform, netloc, instance_type) group is a row and every
+AZ a column of an integer matrix, so the reservations of all groups are
+placed with a handful of array operations instead of a Python loop per
+group and AZ. The results are the same as those of the dict based
+functions in dynamic_ec2reservation.rebalance, which are used when NumPy is
+missing.
+
+Converting between inventories and arrays costs about as much as a single
+pass of the dict based code, so the daemon keeps using that. The arrays pay
+off for the what-if analyses of --what-if, where one encoding of the
+reservations is placed against many fleets at once by stacking their rows.
+"""
+import collections
+import itertools
+import json
+import os.path
+
+from dynamic_ec2reservation import rebalance
+from dynamic_ec2reservation.inventory import Inventory
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def encode(inventories, groups=None):
+    """ Convert inventories to count matrices with shared axes. Rows are
+    (platform, netloc, instance_type) groups, columns are AZs in name order.
+
+    :type inventories: list of dynamic_ec2reservation.inventory.Inventory
+    :param inventories: The counts
+    :type groups: set
+    :param groups: Only encode these groups. Defaults to every group
+    :returns: tuple of (list of groups, list of AZs, list of numpy.ndarray)
+    """
+    # Indexes are handed out in order of first appearance
+    rows = collections.defaultdict(itertools.count().next)
+    columns = collections.defaultdict(itertools.count().next)
+    cells = []
+    for inventory in inventories:
+        items = inventory.iteritems()
+        if groups is not None:
+            items = [item for item in items if item[0][:3] in groups]
+        else:
+            items = list(items)
+
+        cells.append((
+            numpy.fromiter(
+                (rows[key[:3]] for key, _ in items), numpy.intp, len(items)),
+            numpy.fromiter(
+                (columns[key[3]] for key, _ in items), numpy.intp,
+                len(items)),
+            numpy.fromiter(
+                (count for _, count in items), numpy.int64, len(items))))
+
+    # Columns in AZ name order, which is how placement breaks ties
+    azs = sorted(columns)
+    remap = numpy.empty(len(azs), dtype=numpy.intp)
+    remap[[columns[az] for az in azs]] = numpy.arange(len(azs))
+
+    group_list = [None] * len(rows)
+    for group, row in rows.iteritems():
+        group_list[row] = group
+
+    matrices = []
+    for row_index, column_index, values in cells:
+        counts = numpy.zeros((len(rows), len(azs)), dtype=numpy.int64)
+        counts[row_index, remap[column_index]] = values
+        matrices.append(counts)
+
+    return group_list, azs, matrices
+
+
+def decode(groups, azs, counts, rows=None):
+    """ Convert a count matrix back to an inventory, leaving out zeros
+
+    :type groups: list
+    :param groups: (platform, netloc, instance_type) of each row
+    :type azs: list
+    :param azs: The AZ of each column
+    :type counts: numpy.ndarray
+    :param counts: The counts
+    :type rows: numpy.ndarray
+    :param rows: Boolean mask of the rows to convert. Defaults to all
+    :returns: dynamic_ec2reservation.inventory.Inventory
+    """
+    if rows is not None:
+        counts = numpy.where(rows[:, None], counts, 0)
+
+    row_index, column_index = numpy.nonzero(counts)
+    values = counts[row_index, column_index]
+
+    inventory = Inventory()
+    for row, column, count in zip(
+            row_index.tolist(), column_index.tolist(), values.tolist()):
+        inventory[groups[row] + (azs[column],)] = count
+
+    return inventory
+
+
+def fill(capacity, demand):
+    """ Hand out each row's capacity to its columns from left to right,
+    giving every column at most its demand
+
+    :type capacity: numpy.ndarray
+    :param capacity: Capacity per row
+    :type demand: numpy.ndarray
+    :param demand: Demand per row and column
+    :returns: numpy.ndarray of the amount each column gets
+    """
+    before = numpy.cumsum(demand, axis=1) - demand
+    return numpy.clip(capacity[:, None] - before, 0, demand)
+
+
+def place(pool, running, current):
+    """ Vectorised place_reservations for every row at once. Columns must
+    be in AZ name order, which breaks ties the same way.
+
+    :type pool: numpy.ndarray
+    :param pool: Reservations available per row
+    :type running: numpy.ndarray
+    :param running: Running instances per row and AZ
+    :type current: numpy.ndarray
+    :param current: Current reservations per row and AZ
+    :returns: numpy.ndarray of reservations per row and AZ
+    """
+    # Keep reservations that are already covering running instances
+    placement = fill(pool, numpy.minimum(current, running))
+    remaining = pool - placement.sum(axis=1)
+
+    # Cover the largest shortfalls first, in AZ order among equals
+    shortfall = running - placement
+    order = numpy.argsort(-shortfall, axis=1, kind='mergesort')
+    rows = numpy.arange(len(pool))[:, None]
+    added = numpy.empty_like(shortfall)
+    added[rows, order] = fill(remaining, shortfall[rows, order])
+    placement += added
+    remaining -= added.sum(axis=1)
+
+    # Leave unneeded reservations where they already are
+    placement += fill(remaining, numpy.maximum(current - placement, 0))
+    return placement
+
+
+def get_changes(reserved_pool, instances, reserved=None):
+    """ Vectorised dynamic_ec2reservation.rebalance.get_changes, which it
+    falls back to without NumPy
+
+    :type reserved_pool: dict
+    :param reserved_pool: The pool of reserved instances by OS/network/type
+    :type instances: dynamic_ec2reservation.inventory.Inventory
+    :param instances: The currently running instance count by AZ
+    :type reserved: dynamic_ec2reservation.inventory.Inventory
+    :param reserved: The current reservations by AZ
+    :returns: dynamic_ec2reservation.inventory.Inventory
+    """
+    if numpy is None:
+        return rebalance.get_changes(reserved_pool, instances, reserved)
+
+    groups, azs, (running, current) = encode(
+        [instances, reserved if reserved is not None else Inventory()],
+        set(group for group, count in reserved_pool.iteritems() if count))
+
+    # Groups without running instances are left alone
+    in_use = running.any(axis=1)
+    pool = numpy.array(
+        [reserved_pool[group] for group in groups], dtype=numpy.int64)
+
+    return decode(groups, azs, place(pool, running, current), in_use)
+
+
+def get_change_diff(current, new):
+    """ Vectorised dynamic_ec2reservation.rebalance.get_change_diff for
+    (platform, netloc, instance_type) groups, which it falls back to without
+    NumPy
+
+    :type current: dynamic_ec2reservation.inventory.Inventory
+    :param current: The current reservations
+    :type new: dynamic_ec2reservation.inventory.Inventory
+    :param new: The new reservations
+    :returns: dynamic_ec2reservation.inventory.Inventory
+    """
+    if numpy is None:
+        return rebalance.get_change_diff(current, new)
+
+    groups, azs, (new_counts, current_counts) = encode(
+        [new, current], set(key[:3] for key in new))
+
+    changed = (new_counts != current_counts).any(axis=1)
+    return decode(groups, azs, new_counts, changed)
+
+
+def get_scenario_coverage(reserved, scenarios):
+    """ Work out how many running instances the reservations would cover
+    after rebalancing, for many what-if fleets at once
+
+    :type reserved: dynamic_ec2reservation.inventory.Inventory
+    :param reserved: The current reservations
+    :type scenarios: list of dynamic_ec2reservation.inventory.Inventory
+    :param scenarios: Running instance counts to try
+    :returns: list of int, the covered instances of each scenario
+    """
+    if numpy is None:
+        pool = reserved.totals()
+        return [
+            sum(min(count, running[key]) for key, count in
+                get_changes(pool, running, reserved).iteritems())
+            for running in scenarios]
+
+    groups, azs, matrices = encode([reserved] + list(scenarios))
+    current, running = matrices[0], numpy.array(matrices[1:])
+    if not len(scenarios) or not groups:
+        return [0] * len(scenarios)
+
+    # Stack the scenarios into one matrix, as placement works row by row
+    count = len(scenarios)
+    stacked_running = running.reshape(count * len(groups), len(azs))
+    stacked_current = numpy.tile(current, (count, 1))
+    placement = place(
+        stacked_current.sum(axis=1), stacked_running, stacked_current)
+
+    covered = numpy.minimum(placement, stacked_running)
+    return covered.reshape(count, -1).sum(axis=1).tolist()
+
+
+def load_scenarios(path):
+    """ Load what-if fleets from a JSON file in the form of:
+
+    {name: [{"platform": "linux", "netloc": "EC2-VPC",
+             "instance_type": "m4.large",
+             "availability_zone": "us-east-1a", "count": 3}, ...]}
+
+    which lists the running instances of each fleet in the same way as the
+    fixtures of --simulate.
+
+    :type path: str
+    :param path: The scenario file
+    :returns: list of (name, dynamic_ec2reservation.inventory.Inventory) in
+        name order
+    """
+    with open(os.path.expanduser(path)) as scenario_file:
+        table = json.load(scenario_file)
+
+    scenarios = []
+    for name in sorted(table):
+        running = Inventory()
+        for entry in table[name]:
+            if int(entry['count']) > 0:
+                running.add(
+                    (entry['platform'], entry['netloc'],
+                     entry['instance_type'], entry['availability_zone']),
+                    int(entry['count']))
+        scenarios.append((name, running))
+
+    return scenarios
@@ -1,33 +1,332 @@
 # -*- coding: utf-8 -*-
 """ Ensure connections to EC2 """
+import os.path
+import threading
+from collections import namedtuple
+
 from boto.ec2 import connect_to_region
-from dynamic_ec2reservation.config_handler import get_global_option
+from boto.ec2.connection import EC2Connection
+from boto.regioninfo import RegionInfo
+from dynamic_ec2reservation.aws.ratelimit import (
+    RateLimitedConnection, RateLimiter, parse_rates)
+from dynamic_ec2reservation.aws.sts import CredentialCache, get_endpoint
+from dynamic_ec2reservation.config_handler import (
+    get_accounts, get_global_option)
 from dynamic_ec2reservation.log_handler import LOGGER as logger
 
-def __get_connection_ec2():
-    """ Ensure connection to EC2 """
-    region = get_global_option('region')
-    try:
-        if (get_global_option('aws_access_key_id') and
-                get_global_option('aws_secret_access_key')):
-            logger.debug(
-                'Authenticating to EC2 using credentials in configuration file')
-            connection = connect_to_region(
-                region,
+# A region of an account to rebalance. name is the region for the default
+# account and ACCOUNT/REGION for the configured accounts, and is what the
+# state, metrics and logs of the region are kept under.
+Target = namedtuple('Target', ['name', 'region', 'connection_factory'])
+
+
+class ConnectionFactory(object):
+    """ Builds EC2 connections on first use and reuses them afterwards
+
+    Nothing is connected until a region is asked for, so the factory can be
+    created, passed around and thrown away without touching the network.
+    The connections are rate limited per account, region and API action.
+    """
+    # The account the rate limits of the connections are kept under, or None
+    # to keep them under the access key the connections authenticate with
+    account = None
+
+    def __init__(self, aws_access_key_id=None, aws_secret_access_key=None,
+                 endpoint_url=None):
+        """ Constructor
+
+        :type aws_access_key_id: str
+        :param aws_access_key_id: AWS access key, or None to use boto's
+            authentication handler
+        :type aws_secret_access_key: str
+        :param aws_secret_access_key: AWS secret key, or None to use boto's
+            authentication handler
+        :type endpoint_url: str
+        :param endpoint_url: EC2 endpoint to use for every region instead of
+            AWS, e.g. a local stub
+        """
+        self.aws_access_key_id = aws_access_key_id
+        self.aws_secret_access_key = aws_secret_access_key
+        self.endpoint_url = endpoint_url
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, region):
+        """ Get the EC2 connection for a region, connecting on first use
+
+        :type region: str
+        :param region: The AWS region to connect to
+        :returns: boto.ec2.connection.EC2Connection
+        """
+        with self._lock:
+            if region not in self._connections:
+                self._connections[region] = self._connect(region)
+
+            return self._connections[region]
+
+    def _connect(self, region, security_token=None):
+        """ Ensure connection to EC2
+
+        :type region: str
+        :param region: The AWS region to connect to
+        :type security_token: str
+        :param security_token: Session token of temporary credentials
+        """
+        try:
+            if self.aws_access_key_id and self.aws_secret_access_key:
+                logger.debug(
+                    'Authenticating to EC2 using {0}'.format(
+                        'assumed role credentials' if security_token else
+                        'credentials in configuration file'))
+                kwargs = {
+                    'aws_access_key_id': self.aws_access_key_id,
+                    'aws_secret_access_key': self.aws_secret_access_key,
+                    'security_token': security_token
+                }
+            else:
+                logger.debug(
+                    'Authenticating using boto\'s authentication handler')
+                kwargs = {}
+
+            if self.endpoint_url:
+                endpoint = get_endpoint(self.endpoint_url)
+                connection = EC2Connection(
+                    region=RegionInfo(name=region, endpoint=endpoint['host']),
+                    port=endpoint['port'], is_secure=endpoint['is_secure'],
+                    **kwargs)
+            else:
+                connection = connect_to_region(region, **kwargs)
+
+        except Exception as err:
+            logger.error('Failed connecting to EC2: {0}'.format(err))
+            raise
+
+        if connection is None:
+            raise ValueError('Unknown EC2 region: {0}'.format(region))
+
+        logger.debug('Connected to EC2 in {0}'.format(region))
+        return RateLimitedConnection(
+            connection, get_rate_limiter(),
+            self.account or get_rate_limit_account(connection), region)
+
+
+class AssumedRoleConnectionFactory(ConnectionFactory):
+    """ Builds EC2 connections to another account with the temporary
+    credentials of a role assumed in it
+
+    The connection of a region is reused until the credentials are renewed,
+    and rebuilt with the new ones after that.
+    """
+    def __init__(self, credentials, role_arn, external_id=None,
+                 endpoint_url=None):
+        """ Constructor
+
+        :type credentials: dynamic_ec2reservation.aws.sts.CredentialCache
+        :param credentials: The cache to get the role's credentials from
+        :type role_arn: str
+        :param role_arn: The ARN of the role to assume
+        :type external_id: str
+        :param external_id: The external id the role's trust policy asks for
+        :type endpoint_url: str
+        :param endpoint_url: EC2 endpoint to use instead of AWS
+        """
+        ConnectionFactory.__init__(self, endpoint_url=endpoint_url)
+        self.credentials = credentials
+        self.role_arn = role_arn
+        self.external_id = external_id
+        # arn:aws:iam::ACCOUNT_ID:role/NAME
+        self.account = (role_arn.split(':') + [''] * 5)[4] or role_arn
+        # region -> credentials its connection was built with
+        self._issued = {}
+
+    def __call__(self, region):
+        """ Get the EC2 connection for a region, connecting on first use and
+        whenever the role's credentials were renewed
+
+        :type region: str
+        :param region: The AWS region to connect to
+        :returns: boto.ec2.connection.EC2Connection
+        """
+        credentials = self.credentials.get(self.role_arn, self.external_id)
+        with self._lock:
+            if self._issued.get(region) is not credentials:
+                self.aws_access_key_id = credentials.access_key
+                self.aws_secret_access_key = credentials.secret_key
+                self._connections[region] = self._connect(
+                    region, credentials.session_token)
+                self._issued[region] = credentials
+
+            return self._connections[region]
+
+
+__DEFAULT_FACTORY = None
+__DEFAULT_FACTORY_LOCK = threading.Lock()
+
+def get_connection_factory():
+    """ Get the connection factory configured from the global options,
+    creating it on first use. With the simulate option this is a simulated
+    account loaded from a fixture.
+
+    :returns: ConnectionFactory
+    """
+    global __DEFAULT_FACTORY
+
+    with __DEFAULT_FACTORY_LOCK:
+        if __DEFAULT_FACTORY is None and get_global_option('simulate'):
+            from dynamic_ec2reservation.simulation import load_fixture
+            logger.info('Simulating EC2 from {0}'.format(
+                get_global_option('simulate')))
+            __DEFAULT_FACTORY = load_fixture(get_global_option('simulate'))
+
+        if __DEFAULT_FACTORY is None:
+            __DEFAULT_FACTORY = ConnectionFactory(
                 aws_access_key_id=get_global_option('aws_access_key_id'),
                 aws_secret_access_key=get_global_option(
-                    'aws_secret_access_key'))
-        else:
-            logger.debug(
-                'Authenticating using boto\'s authentication handler')
-            connection = connect_to_region(region)
+                    'aws_secret_access_key'),
+                endpoint_url=get_global_option('endpoint_url'))
+
+        return __DEFAULT_FACTORY
 
-    except Exception as err:
-        logger.error('Failed connecting to EC2: {0}'.format(err))
-        raise
 
-    logger.debug('Connected to EC2 in {0}'.format(region))
-    return connection
+__RATE_LIMITER = []
+
+def get_rate_limiter():
+    """ Get the rate limiter configured from the global options, creating
+    it on first use. Its buckets are shared with the other processes on the
+    host through the rate limit file, or kept in this process if the file
+    cannot be written.
+
+    :returns: dynamic_ec2reservation.aws.ratelimit.RateLimiter
+    """
+    with __DEFAULT_FACTORY_LOCK:
+        if not __RATE_LIMITER:
+            path = os.path.expanduser(
+                get_global_option('rate_limit_file') or os.path.join(
+                    get_global_option('pid_file_dir'),
+                    'dynamic-ec2reservation.ratelimit'))
+            try:
+                open(path, 'a').close()
+            except IOError as error:
+                logger.warning(
+                    'Cannot share the API rate limits through {0}, limiting '
+                    'this process only: {1}'.format(path, error))
+                path = None
+
+            __RATE_LIMITER.append(RateLimiter(
+                parse_rates(get_global_option('api_rate_limits')), path))
+
+        return __RATE_LIMITER[0]
+
+
+def get_rate_limit_account(connection):
+    """ Get what to keep the rate limits of a connection's calls under when
+    its account is not known. Daemons using different credentials on a host
+    may call different accounts, so the access key boto found for the
+    connection is used, and 'default' only if it found none.
+
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: The connection
+    :returns: str
+    """
+    return getattr(connection, 'aws_access_key_id', None) or 'default'
+
+
+def get_connection(region):
+    """ Get the EC2 connection for a region from the default factory
+
+    :type region: str
+    :param region: The AWS region to connect to
+    :returns: boto.ec2.connection.EC2Connection
+    """
+    return get_connection_factory()(region)
+
+
+def get_regions(connection_factory=None, regions=None):
+    """ Get the regions to rebalance. The regions option is a comma separated
+    list of region names, or "all" for every region enabled for the account.
+    Without it only the region option is used.
+
+    :type connection_factory: callable
+    :param connection_factory: Returns an EC2 connection for a region name,
+        used to look up the enabled regions. Defaults to get_connection
+    :type regions: str
+    :param regions: Regions to use instead of the regions option, in the
+        same form
+    :returns: list of str
+    """
+    regions = regions or get_global_option('regions')
+    if not regions:
+        return [get_global_option('region')]
+
+    regions = [region.strip() for region in regions.split(',')
+               if region.strip()]
+
+    if regions == ['all']:
+        connection_factory = connection_factory or get_connection
+        regions = [
+            region.name for region in
+            connection_factory(get_global_option('region')).get_all_regions()]
+
+    return sorted(set(regions))
+
+
+__ACCOUNT_FACTORIES = {}
+__CREDENTIALS = []
+
+def get_targets(connection_factory=None):
+    """ Get every region of every account to rebalance. Without accounts in
+    the configuration these are the regions of the default account. With
+    them, each [account: NAME] section is an account whose role-arn is
+    assumed, and whose regions default to the global ones. An account
+    without a role-arn uses the default credentials.
+
+    :type connection_factory: callable
+    :param connection_factory: Returns an EC2 connection for a region name
+        of the default account. Defaults to get_connection_factory
+    :returns: list of Target
+    """
+    connection_factory = connection_factory or get_connection_factory()
+    accounts = get_accounts()
+    if not accounts or get_global_option('simulate'):
+        return [
+            Target(region, region, connection_factory)
+            for region in get_regions(connection_factory)]
+
+    targets = []
+    for account, options in sorted(accounts.iteritems()):
+        factory = connection_factory
+        if options.get('role_arn'):
+            factory = __get_account_factory(account, options)
+
+        targets.extend(
+            Target('{0}/{1}'.format(account, region), region, factory)
+            for region in get_regions(factory, options.get('regions')))
+
+    return targets
+
+
+def __get_account_factory(account, options):
+    """ Get the connection factory of an account, kept for the life of the
+    process so its connections and credentials are reused
+
+    :type account: str
+    :param account: The account name
+    :type options: dict
+    :param options: The options of the account
+    :returns: AssumedRoleConnectionFactory
+    """
+    with __DEFAULT_FACTORY_LOCK:
+        if not __CREDENTIALS:
+            __CREDENTIALS.append(CredentialCache(
+                aws_access_key_id=get_global_option('aws_access_key_id'),
+                aws_secret_access_key=get_global_option(
+                    'aws_secret_access_key'),
+                endpoint_url=get_global_option('endpoint_url')))
 
+        if account not in __ACCOUNT_FACTORIES:
+            __ACCOUNT_FACTORIES[account] = AssumedRoleConnectionFactory(
+                __CREDENTIALS[0], options['role_arn'],
+                options.get('external_id'),
+                endpoint_url=get_global_option('endpoint_url'))
 
-EC2_CONNECTION = __get_connection_ec2()
+        return __ACCOUNT_FACTORIES[account]
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+EC2 API rate limiting
+
+Every EC2 call goes through a token bucket per account, region and API
+action, so that several daemons and regions sharing an account leave room
+for the other tools calling the API. The buckets are kept in a file that
+every process locks while taking a token, so all the Dynamic EC2
+Reservation instances on a host share them. A throttled call halves the
+rate of its bucket for everyone, and the rate climbs back to the configured
+one with every call that goes through.
+"""
+import fcntl
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from dynamic_ec2reservation.log_handler import LOGGER as logger
+from dynamic_ec2reservation.scheduler import is_throttling_error
+
+# boto method -> the EC2 API action it calls
+ACTIONS = {
+    'get_all_instances': 'DescribeInstances',
+    'get_all_reservations': 'DescribeInstances',
+    'get_only_instances': 'DescribeInstances',
+    'get_all_images': 'DescribeImages',
+    'get_all_reserved_instances': 'DescribeReservedInstances',
+    'describe_reserved_instances_modifications':
+        'DescribeReservedInstancesModifications',
+    'modify_reserved_instances': 'ModifyReservedInstances',
+    'get_all_regions': 'DescribeRegions'
+}
+
+# Requests per second and burst of each action, unless configured otherwise
+DEFAULT_RATES = {
+    '*': (5.0, 20),
+    'ModifyReservedInstances': (1.0, 5)
+}
+
+# A throttled bucket never slows down below this fraction of its rate
+MIN_RATE_FRACTION = 0.05
+
+# Fraction of the configured rate a bucket gains back per successful call
+RECOVERY_STEP = 0.05
+
+
+def parse_rates(rates):
+    """ Parse the rate limits option, a comma separated list of
+    ACTION=RATE[/BURST], where ACTION * sets the rate of every action that
+    is not listed, RATE is in requests per second and 0 means no limit.
+    BURST defaults to twice the rate.
+
+    :type rates: str
+    :param rates: e.g. "*=10/40,ModifyReservedInstances=1"
+    :returns: dict of action -> (rate, burst)
+    """
+    limits = dict(DEFAULT_RATES)
+    for entry in (rates or '').split(','):
+        if not entry.strip():
+            continue
+
+        try:
+            action, limit = entry.split('=')
+            rate, _, burst = limit.partition('/')
+            rate = float(rate)
+            burst = int(burst) if burst else max(int(math.ceil(rate * 2)), 1)
+        except ValueError:
+            raise ValueError('Invalid rate limit "{0}", expected '
+                             'ACTION=RATE[/BURST]'.format(entry.strip()))
+
+        limits[action.strip()] = (rate, burst)
+
+    return limits
+
+
+class RateLimiter(object):
+    """ Token buckets keyed by account, region and action, kept in memory or
+    in a file shared with other processes
+    """
+    def __init__(self, limits=None, path=None):
+        """ Constructor
+
+        :type limits: dict
+        :param limits: action -> (rate, burst), from parse_rates
+        :type path: str
+        :param path: File to share the buckets through, or None to keep
+            them in this process
+        """
+        self.limits = limits or dict(DEFAULT_RATES)
+        self.path = path
+        # key -> [tokens, updated, rate], when there is no file
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key, action):
+        """ Take a token, waiting for one if the bucket is empty
+
+        :type key: str
+        :param key: ACCOUNT/REGION the call is made in
+        :type action: str
+        :param action: The EC2 API action
+        :returns: float, the seconds waited
+        """
+        rate, burst = self._get_limit(action)
+        if not rate:
+            return 0.0
+
+        with self._open() as buckets:
+            bucket = self._refill(buckets, key, action, rate, burst)
+            # Tokens are taken up front, so callers that have to wait queue
+            # up behind each other instead of racing for the next one
+            delay = max(1 - bucket[0], 0) / bucket[2]
+            bucket[0] -= 1
+
+        if delay:
+            if delay >= 1:
+                logger.debug('{0}: Waiting {1:.1f} seconds to call {2}'.format(
+                    key, delay, action))
+            time.sleep(delay)
+
+        return delay
+
+    def record(self, key, action, error=None):
+        """ Adjust the rate of a bucket after a call. Throttled calls halve
+        it, and others bring it back up towards the configured rate.
+
+        :type key: str
+        :param key: ACCOUNT/REGION the call was made in
+        :type action: str
+        :param action: The EC2 API action
+        :type error: Exception
+        :param error: The exception the call raised, if any
+        """
+        rate, burst = self._get_limit(action)
+        if not rate:
+            return
+
+        throttled = error is not None and is_throttling_error(error)
+        with self._open() as buckets:
+            bucket = self._refill(buckets, key, action, rate, burst)
+            if throttled:
+                bucket[0] = min(bucket[0], 0)
+                bucket[2] = max(bucket[2] / 2, rate * MIN_RATE_FRACTION)
+            elif bucket[2] < rate:
+                bucket[2] = min(bucket[2] + rate * RECOVERY_STEP, rate)
+
+        if throttled:
+            logger.warning('{0}: {1} throttled, slowing down to {2:.2f} '
+                           'calls per second'.format(key, action, bucket[2]))
+
+    def _get_limit(self, action):
+        """ Get the (rate, burst) of an action """
+        return self.limits.get(action) or self.limits.get('*') or (0, 0)
+
+    @staticmethod
+    def _refill(buckets, key, action, rate, burst):
+        """ Get a bucket with the tokens it gained since it was last used,
+        creating it full
+
+        :returns: list of [tokens, updated, rate]
+        """
+        now = time.time()
+        bucket = buckets.setdefault(
+            '{0}/{1}'.format(key, action), [burst, now, rate])
+        bucket[2] = min(bucket[2], rate)
+        bucket[0] = min(bucket[0] + (now - bucket[1]) * bucket[2], burst)
+        bucket[1] = now
+        return bucket
+
+    @contextmanager
+    def _open(self):
+        """ Lock the buckets and save them afterwards. With a file, it is
+        locked against other processes as well.
+        """
+        with self._lock:
+            if self.path is None:
+                yield self._buckets
+                return
+
+            with open(self.path, 'a+') as bucket_file:
+                fcntl.flock(bucket_file, fcntl.LOCK_EX)
+                try:
+                    bucket_file.seek(0)
+                    try:
+                        buckets = json.load(bucket_file)
+                    except ValueError:
+                        # New or damaged, the buckets start out full
+                        buckets = {}
+
+                    yield buckets
+
+                    bucket_file.seek(0)
+                    bucket_file.truncate()
+                    json.dump(buckets, bucket_file)
+                    bucket_file.flush()
+                finally:
+                    fcntl.flock(bucket_file, fcntl.LOCK_UN)
+
+
+class RateLimitedConnection(object):
+    """ Wraps an EC2 connection so the calls in ACTIONS take a token first.
+    Everything else is passed through to the connection.
+    """
+    def __init__(self, connection, limiter, account, region):
+        """ Constructor
+
+        :type connection: boto.ec2.connection.EC2Connection
+        :param connection: The connection to wrap
+        :type limiter: RateLimiter
+        :param limiter: The rate limiter
+        :type account: str
+        :param account: The account the connection calls, for the buckets
+        :type region: str
+        :param region: The region the connection calls
+        """
+        self.connection = connection
+        self.limiter = limiter
+        self.key = '{0}/{1}'.format(account, region)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.connection, name)
+        if name not in ACTIONS:
+            return attribute
+
+        action = ACTIONS[name]
+
+        def call(*args, **kwargs):
+            """ Make the call once the rate limit allows it """
+            self.limiter.acquire(self.key, action)
+            try:
+                result = attribute(*args, **kwargs)
+            except Exception as error:
+                self.limiter.record(self.key, action, error)
+                raise
+
+            self.limiter.record(self.key, action)
+            return result
+
+        return call
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+""" Temporary credentials of assumed roles """
+import threading
+import urlparse
+
+from boto.regioninfo import RegionInfo
+from boto.sts import STSConnection
+
+from dynamic_ec2reservation.log_handler import LOGGER as logger
+
+# Credentials are renewed this many seconds before they expire, so a cycle
+# never starts with credentials that run out half way
+REFRESH_MARGIN = 300
+
+# Lifetime of the credentials asked for, in seconds
+SESSION_DURATION = 3600
+
+ROLE_SESSION_NAME = 'dynamic-ec2reservation'
+
+
+def get_endpoint(endpoint_url):
+    """ Split an endpoint URL into the arguments of a boto connection
+
+    :type endpoint_url: str
+    :param endpoint_url: e.g. http://localhost:5000
+    :returns: dict with host, port and is_secure
+    """
+    url = urlparse.urlparse(endpoint_url)
+    return {
+        'host': url.hostname,
+        'port': url.port,
+        'is_secure': url.scheme != 'http'
+    }
+
+
+class CredentialCache(object):
+    """ Assumes roles and keeps their credentials until shortly before they
+    expire. Roles are assumed once even when several threads ask for them
+    at the same time.
+    """
+    def __init__(self, aws_access_key_id=None, aws_secret_access_key=None,
+                 endpoint_url=None):
+        """ Constructor
+
+        :type aws_access_key_id: str
+        :param aws_access_key_id: AWS access key to assume the roles with,
+            or None to use boto's authentication handler
+        :type aws_secret_access_key: str
+        :param aws_secret_access_key: AWS secret key to assume the roles
+            with, or None to use boto's authentication handler
+        :type endpoint_url: str
+        :param endpoint_url: STS endpoint to use instead of AWS, e.g. a
+            local stub
+        """
+        self.aws_access_key_id = aws_access_key_id
+        self.aws_secret_access_key = aws_secret_access_key
+        self.endpoint_url = endpoint_url
+        # (role ARN, external id) -> boto.sts.credentials.Credentials
+        self._credentials = {}
+        self._role_locks = {}
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def get(self, role_arn, external_id=None):
+        """ Get credentials for a role, assuming it if there are none or
+        they are about to expire
+
+        :type role_arn: str
+        :param role_arn: The ARN of the role
+        :type external_id: str
+        :param external_id: The external id the role's trust policy asks for
+        :returns: boto.sts.credentials.Credentials
+        """
+        key = (role_arn, external_id)
+        with self._lock:
+            role_lock = self._role_locks.setdefault(key, threading.Lock())
+
+        with role_lock:
+            credentials = self._credentials.get(key)
+            if credentials is None or credentials.is_expired(REFRESH_MARGIN):
+                credentials = self._assume(role_arn, external_id)
+                self._credentials[key] = credentials
+
+            return credentials
+
+    def _assume(self, role_arn, external_id):
+        """ Assume a role
+
+        :type role_arn: str
+        :param role_arn: The ARN of the role
+        :type external_id: str
+        :param external_id: The external id, if any
+        :returns: boto.sts.credentials.Credentials
+        """
+        try:
+            role = self._get_connection().assume_role(
+                role_arn, ROLE_SESSION_NAME,
+                duration_seconds=SESSION_DURATION, external_id=external_id)
+        except Exception as err:
+            logger.error('Failed assuming role {0}: {1}'.format(
+                role_arn, err))
+            raise
+
+        logger.debug('Assumed role {0} until {1}'.format(
+            role_arn, role.credentials.expiration))
+        return role.credentials
+
+    def _get_connection(self):
+        """ Get the STS connection, connecting on first use
+
+        :returns: boto.sts.STSConnection
+        """
+        with self._lock:
+            if self._connection is None:
+                kwargs = {}
+                if self.endpoint_url:
+                    endpoint = get_endpoint(self.endpoint_url)
+                    kwargs = {
+                        'region': RegionInfo(
+                            name='us-east-1', endpoint=endpoint['host'],
+                            connection_cls=STSConnection),
+                        'port': endpoint['port'],
+                        'is_secure': endpoint['is_secure']
+                    }
+
+                self._connection = STSConnection(
+                    aws_access_key_id=self.aws_access_key_id,
+                    aws_secret_access_key=self.aws_secret_access_key,
+                    **kwargs)
+
+            return self._connection
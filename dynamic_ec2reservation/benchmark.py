@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark the rebalance cycle against simulated fleets
+
+Runs the full per-region rebalance pipeline against synthetic fleets of
+increasing size and reports wall time, CPU time, peak memory growth and EC2
+API calls for each cycle. Each fleet size runs in its own process so that
+peak memory figures do not carry over between sizes.
+
+Usage: python -m dynamic_ec2reservation.benchmark --sizes 1000,10000
+"""
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import resource
+import time
+
+from dynamic_ec2reservation import execute_region
+from dynamic_ec2reservation.config_handler import get_configuration
+from dynamic_ec2reservation.log_handler import configure_logging
+from dynamic_ec2reservation.simulation import generate_fleet
+
+DEFAULT_SIZES = '1000,10000,100000,1000000'
+REGION = 'us-east-1'
+
+
+def _split(value):
+    """ Split a comma separated option into a list """
+    return [item.strip() for item in value.split(',') if item.strip()] \
+        if value else None
+
+
+def _peak_rss_kb():
+    """ Peak resident set size of this process in kilobytes """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_size(size, options):
+    """ Generate a fleet and run rebalance cycles against it
+
+    :type size: int
+    :param size: Number of running instances
+    :type options: dict
+    :param options: Fleet and benchmark options
+    :returns: list of dicts, one per cycle
+    """
+    factory = generate_fleet(
+        size,
+        options['reservations'] or max(1, size // 100),
+        instance_types=options['instance_types'],
+        azs=options['azs'],
+        platforms=options['platforms'],
+        coverage=options['coverage'],
+        seed=options['seed'])
+    connection = factory(REGION)
+
+    results = []
+    for cycle in range(options['cycles']):
+        calls_before = connection.api_call_count
+        rss_before = _peak_rss_kb()
+        cpu_before = time.clock()
+        result = execute_region(REGION, factory)
+        results.append({
+            'cycle': cycle + 1,
+            'wall': result.duration,
+            'cpu': time.clock() - cpu_before,
+            'peak_kb': _peak_rss_kb() - rss_before,
+            'api_calls': connection.api_call_count - calls_before,
+            'error': result.error and str(result.error)
+        })
+
+    return results
+
+
+def main():
+    """ Run the benchmark suite """
+    parser = argparse.ArgumentParser(
+        description='Benchmark Dynamic EC2 Reservation against simulated fleets')
+    parser.add_argument(
+        '--sizes', default=DEFAULT_SIZES,
+        help='Comma separated running instance counts (default: {0})'.format(
+            DEFAULT_SIZES))
+    parser.add_argument(
+        '--reservations', type=int,
+        help='Reserved instance records per fleet (default: 1 per 100 instances)')
+    parser.add_argument(
+        '--instance-types',
+        help='Comma separated instance types to generate')
+    parser.add_argument(
+        '--azs',
+        help='Comma separated availability zones to generate')
+    parser.add_argument(
+        '--platforms',
+        help='Comma separated platforms to generate, linux and/or windows')
+    parser.add_argument(
+        '--coverage', type=float, default=0.7,
+        help='Fraction of running instances to reserve (default: 0.7)')
+    parser.add_argument(
+        '--cycles', type=int, default=2,
+        help='Rebalance cycles to run per fleet (default: 2)')
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='Random seed for fleet generation (default: 0)')
+    args = parser.parse_args()
+
+    get_configuration(['--run-once', '--log-level', 'warning'])
+    configure_logging()
+
+    options = {
+        'reservations': args.reservations,
+        'instance_types': _split(args.instance_types),
+        'azs': _split(args.azs),
+        'platforms': _split(args.platforms),
+        'coverage': args.coverage,
+        'cycles': args.cycles,
+        'seed': args.seed
+    }
+
+    print('{0:>10} {1:>6} {2:>10} {3:>10} {4:>12} {5:>10}'.format(
+        'instances', 'cycle', 'wall (s)', 'cpu (s)', 'peak (MB)', 'api calls'))
+    for size in [int(size) for size in _split(args.sizes)]:
+        pool = multiprocessing.Pool(processes=1, maxtasksperchild=1)
+        try:
+            results = pool.apply(run_size, (size, options))
+        finally:
+            pool.close()
+            pool.join()
+
+        for result in results:
+            print('{0:>10} {1:>6} {2:>10.3f} {3:>10.3f} {4:>12.1f} {5:>10}{6}'.format(
+                size, result['cycle'], result['wall'], result['cpu'],
+                result['peak_kb'] / 1024.0, result['api_calls'],
+                '  error: {0}'.format(result['error'])
+                if result['error'] else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Change plans
+
+The modifications a cycle worked out, saved as JSON so they can be reviewed
+and applied later without describing and computing everything again. Each
+region in a plan carries a fingerprint of the reservations it was computed
+from, and a plan is only applied to a region whose reservations still have
+the same fingerprint.
+
+A plan file looks like:
+
+{
+    "version": 1,
+    "created": 1500000000.0,
+    "regions": [{
+        "name": "us-east-1",
+        "region": "us-east-1",
+        "fingerprint": "9f86d08...",
+        "modifications": [{
+            "group": ["linux", "EC2-VPC", "m4.large"],
+            "reservation_ids": ["..."],
+            "configurations": [{
+                "platform": "linux",
+                "netloc": "EC2-VPC",
+                "instance_type": "m4.large",
+                "availability_zone": "us-east-1a",
+                "instance_count": 2
+            }]
+        }]
+    }]
+}
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from dynamic_ec2reservation.rebalance import (
+    PlannedModification, get_reserved_instance_key)
+
+PLAN_VERSION = 1
+
+
+def get_fingerprint(snapshot):
+    """ Get a fingerprint of the active reservations in a snapshot. It
+    changes whenever a reservation is added, expires or is modified.
+
+    :type snapshot: dynamic_ec2reservation.snapshot.InventorySnapshot
+    :param snapshot: The inventory snapshot of the region
+    :returns: str
+    """
+    reservations = sorted(
+        [ri.id] + list(get_reserved_instance_key(ri)) + [ri.instance_count]
+        for ri in snapshot.reserved_instances)
+    return hashlib.sha256(json.dumps(reservations)).hexdigest()
+
+
+def get_region_plan(name, region, fingerprint, modifications):
+    """ Describe the modifications of a region as part of a plan
+
+    :type name: str
+    :param name: The name the region is kept under, e.g. ACCOUNT/REGION
+    :type region: str
+    :param region: The AWS region
+    :type fingerprint: str
+    :param fingerprint: Fingerprint of the reservations, from
+        get_fingerprint
+    :type modifications: list of
+        dynamic_ec2reservation.rebalance.PlannedModification
+    :param modifications: The modifications
+    :returns: dict
+    """
+    return {
+        'name': name,
+        'region': region,
+        'fingerprint': fingerprint,
+        'modifications': [
+            {
+                'group': list(modification.group),
+                'reservation_ids': list(modification.reservation_ids),
+                'configurations': [
+                    {
+                        'platform': platform,
+                        'netloc': netloc,
+                        'instance_type': instance_type,
+                        'availability_zone': az,
+                        'instance_count': count
+                    }
+                    for (platform, netloc, instance_type, az), count
+                    in modification.configurations]
+            }
+            for modification in modifications]
+    }
+
+
+def get_modifications(region_plan):
+    """ Get the modifications of a region in a plan
+
+    :type region_plan: dict
+    :param region_plan: The region, as from get_region_plan
+    :returns: list of dynamic_ec2reservation.rebalance.PlannedModification
+    """
+    return [
+        PlannedModification(
+            tuple(modification['group']),
+            modification['reservation_ids'],
+            [((configuration['platform'], configuration['netloc'],
+               configuration['instance_type'],
+               configuration['availability_zone']),
+              configuration['instance_count'])
+             for configuration in modification['configurations']])
+        for modification in region_plan['modifications']]
+
+
+def write_plan(path, region_plans):
+    """ Write a plan file, replacing it atomically
+
+    :type path: str
+    :param path: The file to write
+    :type region_plans: list of dict
+    :param region_plans: The regions, from get_region_plan
+    """
+    path = os.path.expanduser(path)
+    handle, temporary = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'w') as plan_file:
+            json.dump({
+                'version': PLAN_VERSION,
+                'created': time.time(),
+                'regions': sorted(
+                    region_plans, key=lambda region_plan: region_plan['name'])
+            }, plan_file, indent=2, sort_keys=True)
+        os.rename(temporary, path)
+    except (IOError, OSError):
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+def read_plan(path):
+    """ Read a plan file
+
+    :type path: str
+    :param path: The file to read
+    :returns: dict
+    """
+    with open(os.path.expanduser(path)) as plan_file:
+        plan = json.load(plan_file)
+
+    if plan.get('version') != PLAN_VERSION:
+        raise ValueError('Unsupported plan version {0} in {1}'.format(
+            plan.get('version'), path))
+
+    return plan
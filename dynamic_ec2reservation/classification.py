@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+Platform classification
+
+Maps reserved instance product descriptions and running instance attributes
+to the (platform, netloc) part of an inventory key. There are only a few
+dozen distinct descriptions, so each one is classified once and looked up
+afterwards, and the keys built from them are interned so every inventory
+shares a single copy of each.
+
+Reservations only cover instances of the same platform, so SUSE, Red Hat
+and the SQL Server editions each get a platform of their own instead of
+being counted as plain linux or windows. The EC2 API version boto speaks
+does not report the platform details of running instances, so Red Hat and
+SUSE instances are told apart from plain linux by the image they were
+launched from.
+"""
+import re
+import threading
+
+from boto.exception import BotoServerError
+
+from dynamic_ec2reservation.log_handler import LOGGER as logger
+
+# Suffix of the product descriptions of reservations in EC2-VPC
+VPC_SUFFIX = ' (Amazon VPC)'
+
+# Reserved instance product descriptions, and the platform details EC2
+# reports for running instances, without VPC_SUFFIX -> platform
+PLATFORMS = {
+    'Linux/UNIX': 'linux',
+    'SUSE Linux': 'suse',
+    'Ubuntu Pro': 'ubuntu-pro',
+    'Red Hat Enterprise Linux': 'rhel',
+    'Red Hat Enterprise Linux with HA': 'rhel-ha',
+    'Red Hat BYOL Linux': 'rhel-byol',
+    'Red Hat Enterprise Linux with SQL Server Standard': 'rhel-sql-standard',
+    'Red Hat Enterprise Linux with SQL Server Web': 'rhel-sql-web',
+    'Red Hat Enterprise Linux with SQL Server Enterprise':
+        'rhel-sql-enterprise',
+    'Red Hat Enterprise Linux with HA with SQL Server Standard':
+        'rhel-ha-sql-standard',
+    'Red Hat Enterprise Linux with SQL Server Standard and HA':
+        'rhel-ha-sql-standard',
+    'Red Hat Enterprise Linux with HA with SQL Server Enterprise':
+        'rhel-ha-sql-enterprise',
+    'Red Hat Enterprise Linux with SQL Server Enterprise and HA':
+        'rhel-ha-sql-enterprise',
+    'Linux with SQL Server Standard': 'linux-sql-standard',
+    'Linux with SQL Server Web': 'linux-sql-web',
+    'Linux with SQL Server Enterprise': 'linux-sql-enterprise',
+    'SQL Server Standard': 'linux-sql-standard',
+    'SQL Server Web': 'linux-sql-web',
+    'SQL Server Enterprise': 'linux-sql-enterprise',
+    'Windows': 'windows',
+    'Windows BYOL': 'windows-byol',
+    'Windows with SQL Server Standard': 'windows-sql-standard',
+    'Windows with SQL Server Web': 'windows-sql-web',
+    'Windows with SQL Server Enterprise': 'windows-sql-enterprise'
+}
+
+# Platforms that run Windows, which EC2 reports as the windows platform of
+# a running instance
+WINDOWS_PLATFORMS = frozenset(
+    platform for platform in PLATFORMS.itervalues()
+    if platform.startswith('windows'))
+
+# The product description of each platform's reservations, leaving out the
+# names that only appear in the platform details of running instances
+DESCRIPTIONS = dict(
+    (platform, description) for description, platform in PLATFORMS.iteritems()
+    if not description.startswith('SQL Server') and
+    not description.endswith('and HA'))
+
+# Billing products of images -> the platform of the instances launched from
+# them, which inherit the billing products of the image
+BILLING_PRODUCTS = {
+    'bp-6fa54006': 'rhel'
+}
+
+# Patterns of image names and descriptions -> platform, for the images that
+# report no billing product
+IMAGE_PATTERNS = [
+    (re.compile(r'\bred ?hat\b|\brhel\b', re.IGNORECASE), 'rhel'),
+    (re.compile(r'\bsuse\b|\bsles\b', re.IGNORECASE), 'suse')
+]
+
+# Platform of the linux instances whose image cannot be described. No
+# reservation has it, so they are left out of the Linux/UNIX ones instead of
+# possibly being Red Hat or SUSE instances counted as plain linux.
+UNKNOWN_IMAGE_PLATFORM = 'unknown-linux'
+
+# Platforms a running instance gets from its platform attribute or image.
+# The others need the platform details, which boto's EC2 API version does
+# not return.
+INSTANCE_PLATFORMS = frozenset(['linux', 'windows', 'rhel', 'suse'])
+
+# DescribeImages accepts at most 200 values per filter
+MAX_IMAGE_IDS = 200
+
+# description -> (platform, netloc)
+__DESCRIPTIONS = {}
+# (platform attribute, in a VPC, platform details, image platform) ->
+# (platform, netloc)
+__INSTANCES = {}
+# image id -> platform of the instances launched from it. Images never
+# change, so each one is described once.
+__IMAGES = {}
+# Interned strings and inventory keys
+__STRINGS = {}
+__KEYS = {}
+__LOCK = threading.Lock()
+
+
+def classify_description(description):
+    """ Get the platform and network location of a reserved instance from
+    its product description, e.g. 'SUSE Linux (Amazon VPC)' is
+    ('suse', 'EC2-VPC'). Unknown descriptions get a platform made from the
+    description, so they are never mixed up with a known one.
+
+    :type description: str
+    :param description: The product description
+    :returns: tuple of (platform, netloc)
+    """
+    try:
+        return __DESCRIPTIONS[description]
+    except KeyError:
+        pass
+
+    netloc = 'EC2-Classic'
+    name = description.strip()
+    if name.endswith(VPC_SUFFIX):
+        netloc = 'EC2-VPC'
+        name = name[:-len(VPC_SUFFIX)]
+
+    platform = __get_platform(name)
+    with __LOCK:
+        return __DESCRIPTIONS.setdefault(
+            description, (__intern(platform), __intern(netloc)))
+
+
+def classify_instance(platform, vpc_id, platform_details=None,
+                      image_platform=None):
+    """ Get the platform and network location of a running instance
+
+    :type platform: str
+    :param platform: The platform attribute, windows or None
+    :type vpc_id: str
+    :param vpc_id: The VPC of the instance, if any
+    :type platform_details: str
+    :param platform_details: The platform details EC2 reports, e.g.
+        'Red Hat Enterprise Linux', if it reported any
+    :type image_platform: str
+    :param image_platform: The platform of the instance's image, from
+        get_image_platforms, if it was looked up
+    :returns: tuple of (platform, netloc)
+    """
+    lookup = (platform, bool(vpc_id), platform_details, image_platform)
+    try:
+        return __INSTANCES[lookup]
+    except KeyError:
+        pass
+
+    if platform_details:
+        name = __get_platform(platform_details)
+    elif platform == 'windows':
+        name = 'windows'
+    else:
+        name = image_platform or 'linux'
+
+    with __LOCK:
+        return __INSTANCES.setdefault(lookup, (
+            __intern(name), 'EC2-VPC' if vpc_id else 'EC2-Classic'))
+
+
+def needs_image(instance):
+    """ Whether the platform of a running instance depends on its image,
+    i.e. it is not windows and EC2 reported no platform details for it
+
+    :type instance: boto.ec2.instance.Instance
+    :param instance: The instance
+    :returns: bool
+    """
+    return instance.platform != 'windows' and \
+        not getattr(instance, 'platformDetails', None)
+
+
+def classify_image(image):
+    """ Get the platform of the instances launched from an image, from its
+    billing products or else its name and description. Images of neither
+    Red Hat nor SUSE are plain linux.
+
+    :type image: boto.ec2.image.Image
+    :param image: The image
+    :returns: str
+    """
+    for billing_product in getattr(image, 'billing_products', None) or []:
+        if billing_product in BILLING_PRODUCTS:
+            return BILLING_PRODUCTS[billing_product]
+
+    text = ' '.join(filter(None, [image.name, image.description]))
+    for pattern, platform in IMAGE_PATTERNS:
+        if pattern.search(text):
+            return platform
+
+    return 'linux'
+
+
+def get_image_platforms(snapshot, image_ids):
+    """ Get the platforms of the instances launched from some images,
+    describing the images not seen before. Instances of images that cannot
+    be described, e.g. because they were deregistered, get
+    UNKNOWN_IMAGE_PLATFORM. If the images cannot be described at all, e.g.
+    without permission to, the instances are counted as plain linux as
+    before, which is logged.
+
+    :type snapshot: dynamic_ec2reservation.snapshot.InventorySnapshot
+    :param snapshot: The inventory snapshot of the instances' region
+    :type image_ids: iterable
+    :param image_ids: The image ids
+    :returns: dict of image id -> platform
+    """
+    image_ids = set(image_id for image_id in image_ids if image_id)
+    unknown = sorted(image_ids.difference(__IMAGES))
+    for start in xrange(0, len(unknown), MAX_IMAGE_IDS):
+        batch = unknown[start:start + MAX_IMAGE_IDS]
+        try:
+            with snapshot.api_call('DescribeImages'):
+                images = snapshot.connection.get_all_images(
+                    filters={'image-id': batch})
+        except BotoServerError as error:
+            logger.warning(
+                'Cannot describe the images of running instances, counting '
+                'Red Hat and SUSE instances as plain linux: {0}'.format(
+                    error))
+            break
+
+        found = dict((image.id, classify_image(image)) for image in images)
+        missing = [image_id for image_id in batch if image_id not in found]
+        if missing:
+            logger.warning(
+                'Cannot describe images {0}, leaving their instances out of '
+                'the Linux/UNIX reservations as they may be Red Hat or '
+                'SUSE'.format(', '.join(missing)))
+
+        with __LOCK:
+            for image_id in batch:
+                __IMAGES[image_id] = __intern(
+                    found.get(image_id, UNKNOWN_IMAGE_PLATFORM))
+
+    return dict(
+        (image_id, __IMAGES[image_id])
+        for image_id in image_ids if image_id in __IMAGES)
+
+
+def intern_key(key):
+    """ Get the shared copy of an inventory key
+
+    :type key: tuple
+    :param key: (platform, netloc, instance_type, az)
+    :returns: tuple
+    """
+    try:
+        return __KEYS[key]
+    except KeyError:
+        with __LOCK:
+            return __KEYS.setdefault(key, tuple(key))
+
+
+def get_description(platform, netloc):
+    """ Get the reserved instance product description of a platform and
+    network location
+
+    :type platform: str
+    :param platform: The platform, e.g. linux or windows-sql-web
+    :type netloc: str
+    :param netloc: EC2-Classic or EC2-VPC
+    :returns: str
+    """
+    description = DESCRIPTIONS.get(platform, 'Linux/UNIX')
+    if netloc == 'EC2-VPC':
+        description += VPC_SUFFIX
+
+    return description
+
+
+def get_unmatched_platforms(reserved, running):
+    """ Get the platforms that are reserved but that no running instance
+    has, and that running instances only get from their platform details.
+    Unless EC2 reports those, the reservations are never rebalanced.
+
+    :type reserved: dynamic_ec2reservation.inventory.Inventory
+    :param reserved: The current reservations
+    :type running: dynamic_ec2reservation.inventory.Inventory
+    :param running: The running instances
+    :returns: list of str
+    """
+    running_platforms = set(key[0] for key in running)
+    return sorted(
+        set(key[0] for key in reserved) - running_platforms -
+        INSTANCE_PLATFORMS)
+
+
+def is_windows(platform):
+    """ Whether EC2 reports instances of a platform as windows
+
+    :type platform: str
+    :param platform: The platform
+    :returns: bool
+    """
+    return platform in WINDOWS_PLATFORMS
+
+
+def __get_platform(name):
+    """ Get the platform of a description without its VPC suffix, logging
+    descriptions that are not known
+
+    :type name: str
+    :param name: The description
+    :returns: str
+    """
+    if name in PLATFORMS:
+        return PLATFORMS[name]
+
+    platform = re.sub('[^a-z0-9]+', '-', name.lower()).strip('-')
+    logger.warning('Unknown platform "{0}", treating it as {1}'.format(
+        name, platform))
+    return platform
+
+
+def __intern(value):
+    """ Get the shared copy of a string. Must be called with the lock held.
+    """
+    return __STRINGS.setdefault(value, value)
@@ -13,12 +13,43 @@ DEFAULT_OPTIONS = {
         'dry_run': False,
         'pid_file_dir': '/tmp',
         'run_once': False,
+        'simulate': None,
+        'profile': False,
+        'profile_dir': None,
+        'state_file': None,
+        'plan': False,
+        'plan_out': None,
+        'apply_plan': None,
+        'what_if': None,
 
         # [global]
         'region': 'us-east-1',
+        'regions': None,
         'aws_access_key_id': None,
         'aws_secret_access_key': None,
-        'check_interval': 3600
+        'check_interval': 3600,
+        'min_check_interval': None,
+        'max_check_interval': None,
+        'instance_size_flexibility': False,
+        'max_concurrent_modifications': 4,
+        'max_modifications_per_cycle': None,
+        'modification_time_budget': None,
+        'max_concurrent_regions': 16,
+        'max_concurrent_requests': None,
+        'api_rate_limits': None,
+        'rate_limit_file': None,
+        'endpoint_url': None,
+        'only_types': None,
+        'only_platforms': None,
+        'describe_all_instances': False,
+        'event_source': None,
+        'event_window': 30,
+        'full_scan_interval': 10,
+        'metrics_file': None,
+        'metrics_port': None,
+        'plan_days': 30,
+        'plan_percentile': 20.0,
+        'price_file': None
         },
     'logging': {
         # [logging]
@@ -28,17 +59,22 @@ DEFAULT_OPTIONS = {
         }
     }
 
-def get_configuration():
-    """ Get the configuration from command line and config files """
+def get_configuration(args=None):
+    """ Get the configuration from command line and config files
+
+    :type args: list
+    :param args: Command line arguments to use instead of sys.argv
+    """
     # This is the dict we will return
     configuration = {
         'global': {},
         'logging': {},
-        'tables': {}
+        'tables': {},
+        'accounts': {}
     }
 
     # Read the command line options
-    cmd_line_options = command_line_parser.parse()
+    cmd_line_options = command_line_parser.parse(args)
 
     # If a configuration file is specified, read that as well
     conf_file_options = None
@@ -56,8 +92,13 @@ def get_configuration():
         cmd_line_options,
         conf_file_options)
 
+    # Extract the accounts
+    if conf_file_options:
+        configuration['accounts'] = conf_file_options.get('accounts', {})
+
     # Ensure some basic rules
     __check_logging_rules(configuration)
+    __check_global_rules(configuration)
 
     return configuration
 
@@ -104,6 +145,15 @@ def __get_logging_options(cmd_line_options, conf_file_options=None):
 
     return options
 
+def __check_global_rules(configuration):
+    """ Check that the global values are proper """
+    from dynamic_ec2reservation.aws.ratelimit import parse_rates
+    try:
+        parse_rates(configuration['global']['api_rate_limits'])
+    except ValueError as error:
+        print(error)
+        sys.exit(1)
+
 def __check_logging_rules(configuration):
     """ Check that the logging values are proper """
     valid_log_levels = [
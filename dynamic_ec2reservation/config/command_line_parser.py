@@ -5,8 +5,12 @@ import os.path
 import argparse
 import ConfigParser
 
-def parse():
-    """ Parse command line options """
+def parse(args=None):
+    """ Parse command line options
+
+    :type args: list
+    :param args: Arguments to parse instead of sys.argv
+    """
     parser = argparse.ArgumentParser(
         description='Dynamic EC2 Reservation - Auto rebalance EC2 reservations')
     parser.add_argument(
@@ -20,11 +24,34 @@ def parse():
         '--run-once',
         action='store_true',
         help='Run once and then exit Dynamic EC2 Reservation, instead of looping')
+    parser.add_argument(
+        '--plan-out',
+        help=(
+            'Write the modifications each cycle would make to this JSON '
+            'file instead of making them, with a fingerprint of the '
+            'reservations they are based on'))
+    parser.add_argument(
+        '--apply-plan',
+        help=(
+            'Submit the modifications in a file written by --plan-out and '
+            'exit, refusing regions whose reservations changed since'))
     parser.add_argument(
         '--check-interval',
         type=int,
         help="""How many seconds should we wait between
                 the checks (default: 300)""")
+    parser.add_argument(
+        '--min-check-interval',
+        type=int,
+        help=(
+            'Shortest interval the checks speed up to while reservations '
+            'keep changing (default: a quarter of --check-interval)'))
+    parser.add_argument(
+        '--max-check-interval',
+        type=int,
+        help=(
+            'Longest interval the checks slow down to while nothing changes '
+            '(default: four times --check-interval)'))
     parser.add_argument(
         '--log-file',
         help='Send output to the given log file')
@@ -66,12 +93,186 @@ def parse():
         '--pid-file-dir',
         default='/tmp',
         help='Directory where pid file is located in. Defaults to /tmp')
+    daemon_ag.add_argument(
+        '--state-file',
+        help=(
+            'SQLite file to keep state in across restarts. Defaults to '
+            'dynamic-ec2reservation.INSTANCE.db in the pid file directory'))
+    profile_ag = parser.add_argument_group('Profiling options')
+    profile_ag.add_argument(
+        '--profile',
+        action='store_true',
+        help=(
+            'Log the wall and CPU time, object count and memory change of '
+            'each stage of every cycle, and a rolling summary when looping'))
+    profile_ag.add_argument(
+        '--profile-dir',
+        help=(
+            'Profile the cycles under cProfile and write a report and the '
+            'stats of each cycle to this directory. Implies --profile'))
+    plan_ag = parser.add_argument_group('Planning options')
+    plan_ag.add_argument(
+        '--plan',
+        action='store_true',
+        help=(
+            'Print reservation purchase recommendations and idle '
+            'reservations from the running instance counts recorded in the '
+            'state file, then exit. Cycles only record the reserved instance '
+            'types unless they run with --describe-all-instances, so '
+            'purchases of other types are only recommended then'))
+    plan_ag.add_argument(
+        '--what-if',
+        help=(
+            'Print how many running instances of each fleet in this JSON '
+            'scenario file the current reservations would cover once '
+            'rebalanced, and how many reservations would move, then exit. '
+            'Fleets list their running instances like --simulate fixtures, '
+            'and are placed without instance size flexibility'))
+    plan_ag.add_argument(
+        '--plan-days',
+        type=int,
+        help='Number of days of recorded counts to plan from (default: 30)')
+    plan_ag.add_argument(
+        '--plan-percentile',
+        type=float,
+        help=(
+            'Percentile of the hourly counts to buy reservations up to. '
+            'Reservations used less than this percentage of the time are '
+            'flagged as idle (default: 20)'))
+    plan_ag.add_argument(
+        '--price-file',
+        help=(
+            'JSON file with the on demand and effective reserved hourly '
+            'price of each platform and instance type, to estimate the cost '
+            'impact of the recommendations and to submit the modifications '
+            'that save the most first'))
+    metrics_ag = parser.add_argument_group('Metrics options')
+    metrics_ag.add_argument(
+        '--metrics-file',
+        help=(
+            'Write Prometheus metrics to this file after every cycle, e.g. '
+            'for the node exporter textfile collector'))
+    metrics_ag.add_argument(
+        '--metrics-port',
+        type=int,
+        help='Serve Prometheus metrics over HTTP on this port')
     ec2_ag = parser.add_argument_group('EC2 options')
     ec2_ag.add_argument(
         '-r', '--region',
         help='AWS region to operate in (default: us-east-1')
+    ec2_ag.add_argument(
+        '--regions',
+        help=(
+            'Comma separated list of AWS regions to rebalance concurrently, '
+            'or "all" for every region enabled for the account. '
+            'Overrides --region'))
+    ec2_ag.add_argument(
+        '--instance-size-flexibility',
+        action='store_true',
+        default=None,
+        help=(
+            'Let Linux/UNIX reservations cover running instances of other '
+            'sizes in the same family, splitting or merging them as needed'))
+    ec2_ag.add_argument(
+        '--max-concurrent-modifications',
+        type=int,
+        help='Maximum number of reservation modifications to submit at once '
+             '(default: 4)')
+    ec2_ag.add_argument(
+        '--max-concurrent-requests',
+        type=int,
+        help=(
+            'Overlap the EC2 API calls of a cycle, with at most this many in '
+            'flight per region: the running instances of several instance '
+            'types are described at once, and alongside the reservations '
+            'with --describe-all-instances, while finished modifications are '
+            'followed up in the background (default: no overlap)'))
+    ec2_ag.add_argument(
+        '--api-rate-limits',
+        help=(
+            'EC2 API calls per second and burst of each account, region and '
+            'action, as a comma separated list of ACTION=RATE[/BURST], where '
+            '* is every other action and a rate of 0 is no limit (default: '
+            '*=5/20,ModifyReservedInstances=1/5)'))
+    ec2_ag.add_argument(
+        '--rate-limit-file',
+        help=(
+            'File the instances on this host share their API rate limits '
+            'through (default: dynamic-ec2reservation.ratelimit in the pid '
+            'file directory)'))
+    ec2_ag.add_argument(
+        '--max-modifications-per-cycle',
+        type=int,
+        help=(
+            'Maximum number of reservation modifications to submit per region '
+            'and cycle. The changes that save the most are submitted first '
+            'and the rest wait for the next cycle (default: no limit)'))
+    ec2_ag.add_argument(
+        '--modification-time-budget',
+        type=int,
+        help=(
+            'Seconds a cycle may spend submitting modifications in a region '
+            'before leaving the rest for the next cycle (default: no limit)'))
+    ec2_ag.add_argument(
+        '--max-concurrent-regions',
+        type=int,
+        help=(
+            'Maximum number of regions, over all accounts, to rebalance at '
+            'the same time (default: 16)'))
+    ec2_ag.add_argument(
+        '--endpoint-url',
+        help=(
+            'Send the EC2 and STS API calls to this URL instead of AWS, e.g. '
+            'a local stub such as http://localhost:5000'))
+    ec2_ag.add_argument(
+        '--only-types',
+        help=(
+            'Comma separated list of instance types to rebalance, leaving '
+            'the others alone. Shell style wildcards such as m4.* match '
+            'whole families'))
+    ec2_ag.add_argument(
+        '--only-platforms',
+        help=(
+            'Comma separated list of platforms to rebalance, e.g. linux, '
+            'windows, suse, rhel or windows-sql-standard'))
+    ec2_ag.add_argument(
+        '--describe-all-instances',
+        action='store_true',
+        default=None,
+        help=(
+            'Describe every running instance, not only the reserved types, '
+            'so --plan recommendations also cover types without '
+            'reservations'))
+    ec2_ag.add_argument(
+        '--event-source',
+        help=(
+            'Rebalance the affected instance types as soon as instance state '
+            'change events arrive, from file:PATH (one JSON event per line) '
+            'or unix:PATH (JSON datagrams). A full check still runs every '
+            '--check-interval seconds'))
+    ec2_ag.add_argument(
+        '--event-window',
+        type=int,
+        help=(
+            'Seconds to keep collecting events after the first one before '
+            'rebalancing (default: 30)'))
+    ec2_ag.add_argument(
+        '--full-scan-interval',
+        type=int,
+        help=(
+            'Number of event driven or incremental polling cycles after '
+            'which every running instance is described again, to correct '
+            'drift in the counts kept between them. Polling cycles less '
+            'than 45 minutes apart only describe the instances launched '
+            'or stopped since the last one; 0 describes every instance '
+            'every cycle (default: 10)'))
+    ec2_ag.add_argument(
+        '--simulate',
+        help=(
+            'Run against a simulated EC2 account loaded from a JSON or CSV '
+            'fixture instead of AWS'))
 
-    args = parser.parse_args()
+    args = parser.parse_args(args)
 
     # Print the version and quit
     if args.version:
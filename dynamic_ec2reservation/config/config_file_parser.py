@@ -103,11 +103,149 @@ def parse(config_path):
                     'required': False,
                     'type': 'str'
                 },
+                {
+                    'key': 'regions',
+                    'option': 'regions',
+                    'required': False,
+                    'type': 'str'
+                },
                 {
                     'key': 'check_interval',
                     'option': 'check-interval',
                     'required': False,
                     'type': 'int'
+                },
+                {
+                    'key': 'min_check_interval',
+                    'option': 'min-check-interval',
+                    'required': False,
+                    'type': 'int'
+                },
+                {
+                    'key': 'max_check_interval',
+                    'option': 'max-check-interval',
+                    'required': False,
+                    'type': 'int'
+                },
+                {
+                    'key': 'instance_size_flexibility',
+                    'option': 'instance-size-flexibility',
+                    'required': False,
+                    'type': 'bool'
+                },
+                {
+                    'key': 'max_concurrent_modifications',
+                    'option': 'max-concurrent-modifications',
+                    'required': False,
+                    'type': 'int'
+                },
+                {
+                    'key': 'max_concurrent_requests',
+                    'option': 'max-concurrent-requests',
+                    'required': False,
+                    'type': 'int'
+                },
+                {
+                    'key': 'api_rate_limits',
+                    'option': 'api-rate-limits',
+                    'required': False,
+                    'type': 'str'
+                },
+                {
+                    'key': 'rate_limit_file',
+                    'option': 'rate-limit-file',
+                    'required': False,
+                    'type': 'str'
+                },
+                {
+                    'key': 'max_modifications_per_cycle',
+                    'option': 'max-modifications-per-cycle',
+                    'required': False,
+                    'type': 'int'
+                },
+                {
+                    'key': 'modification_time_budget',
+                    'option': 'modification-time-budget',
+                    'required': False,
+                    'type': 'int'
+                },
+                {
+                    'key': 'max_concurrent_regions',
+                    'option': 'max-concurrent-regions',
+                    'required': False,
+                    'type': 'int'
+                },
+                {
+                    'key': 'endpoint_url',
+                    'option': 'endpoint-url',
+                    'required': False,
+                    'type': 'str'
+                },
+                {
+                    'key': 'only_types',
+                    'option': 'only-types',
+                    'required': False,
+                    'type': 'str'
+                },
+                {
+                    'key': 'only_platforms',
+                    'option': 'only-platforms',
+                    'required': False,
+                    'type': 'str'
+                },
+                {
+                    'key': 'describe_all_instances',
+                    'option': 'describe-all-instances',
+                    'required': False,
+                    'type': 'bool'
+                },
+                {
+                    'key': 'event_source',
+                    'option': 'event-source',
+                    'required': False,
+                    'type': 'str'
+                },
+                {
+                    'key': 'event_window',
+                    'option': 'event-window',
+                    'required': False,
+                    'type': 'int'
+                },
+                {
+                    'key': 'full_scan_interval',
+                    'option': 'full-scan-interval',
+                    'required': False,
+                    'type': 'int'
+                },
+                {
+                    'key': 'metrics_file',
+                    'option': 'metrics-file',
+                    'required': False,
+                    'type': 'str'
+                },
+                {
+                    'key': 'metrics_port',
+                    'option': 'metrics-port',
+                    'required': False,
+                    'type': 'int'
+                },
+                {
+                    'key': 'plan_days',
+                    'option': 'plan-days',
+                    'required': False,
+                    'type': 'int'
+                },
+                {
+                    'key': 'plan_percentile',
+                    'option': 'plan-percentile',
+                    'required': False,
+                    'type': 'float'
+                },
+                {
+                    'key': 'price_file',
+                    'option': 'price-file',
+                    'required': False,
+                    'type': 'str'
                 }
             ])
 
@@ -139,6 +277,39 @@ def parse(config_path):
                 }
             ])
 
+    #
+    # Handle [account: NAME]
+    #
+    accounts = {}
+    for section in config_file.sections():
+        if not section.startswith('account: '):
+            continue
+
+        accounts[section.split(':', 1)[1].strip()] = __parse_options(
+            config_file,
+            section,
+            [
+                {
+                    'key': 'role_arn',
+                    'option': 'role-arn',
+                    'required': False,
+                    'type': 'str'
+                },
+                {
+                    'key': 'external_id',
+                    'option': 'external-id',
+                    'required': False,
+                    'type': 'str'
+                },
+                {
+                    'key': 'regions',
+                    'option': 'regions',
+                    'required': False,
+                    'type': 'str'
+                }
+            ])
+
     return dict(
         global_config.items() +
-        logging_config.items())
+        logging_config.items() +
+        [('accounts', accounts)])
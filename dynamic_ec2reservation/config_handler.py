@@ -2,22 +2,42 @@
 """ Configuration handler """
 from  dynamic_ec2reservation import config
 
-CONFIGURATION = config.get_configuration()
+CONFIGURATION = None
+
+def get_configuration(args=None):
+    """ Returns the configuration, reading the command line and
+    configuration file on first use
+    :type args: list
+    :param args: Command line arguments to use instead of sys.argv
+    :returns: dict
+    """
+    global CONFIGURATION
+    if CONFIGURATION is None:
+        CONFIGURATION = config.get_configuration(args)
+
+    return CONFIGURATION
 
 def get_global_option(option):
     """ Returns the value of the option
     :returns: str or None
     """
     try:
-        return CONFIGURATION['global'][option]
+        return get_configuration()['global'][option]
     except KeyError:
         return None
 
+def get_accounts():
+    """ Returns the accounts to rebalance, from the [account: NAME] sections
+    of the configuration file
+    :returns: dict of account name -> options
+    """
+    return get_configuration().get('accounts') or {}
+
 def get_logging_option(option):
     """ Returns the value of the option
     :returns: str or None
     """
     try:
-        return CONFIGURATION['logging'][option]
+        return get_configuration()['logging'][option]
     except KeyError:
         return None
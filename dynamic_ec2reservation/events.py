@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+Instance state change events
+
+Feeds of instance launch and termination notifications, used to rebalance
+the affected groups soon after the fleet changes instead of waiting for the
+next full check. Events are JSON objects, either EventBridge "EC2 Instance
+State-change Notification" events or flat objects such as::
+
+    {"region": "us-east-1", "instance-id": "i-0123", "state": "running",
+     "instance-type": "m4.large", "availability-zone": "us-east-1a",
+     "platform": "linux", "vpc-id": "vpc-0123",
+     "time": "2017-12-22T18:43:48Z"}
+
+Only the instance id and state are required. Events without the instance
+type and AZ are resolved with a DescribeInstances call, and events without
+a time are taken to have happened when they are read. Flat events of Red
+Hat or SUSE instances need their "platform-details", as the platform is not
+looked up from the image of instances with an instance type and AZ.
+"""
+import calendar
+import collections
+import io
+import json
+import os
+import socket
+import threading
+import time
+import Queue
+
+from boto.exception import BotoServerError
+
+from dynamic_ec2reservation.classification import (
+    classify_instance, get_image_platforms, intern_key, needs_image)
+from dynamic_ec2reservation.log_handler import LOGGER as logger
+from dynamic_ec2reservation.snapshot import InventorySnapshot
+
+# Instance states that change the running instance counts
+STATES = frozenset(
+    ['pending', 'running', 'stopping', 'stopped', 'shutting-down',
+     'terminated'])
+
+# time is the Unix time the instance changed state
+InstanceEvent = collections.namedtuple(
+    'InstanceEvent', ['region', 'instance_id', 'state', 'key', 'time'])
+
+
+def parse_time(value):
+    """ Parse an ISO 8601 UTC timestamp as EC2 and EventBridge write them,
+    e.g. 2017-12-22T18:43:48Z or 2017-12-22T18:43:48.000Z
+
+    :type value: str
+    :param value: The timestamp
+    :returns: float, Unix time, or None if it cannot be parsed
+    """
+    try:
+        return float(calendar.timegm(
+            time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')))
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_event(data):
+    """ Parse a JSON instance state change event
+
+    :type data: str
+    :param data: The JSON encoded event
+    :returns: InstanceEvent, or None if the event is not an instance state
+        change
+    """
+    try:
+        event = json.loads(data)
+    except ValueError:
+        logger.warning('Ignoring malformed event: {0!r}'.format(data))
+        return None
+
+    if not isinstance(event, dict):
+        return None
+
+    detail = event.get('detail', event)
+
+    def get(name):
+        """ Read a field written with dashes or underscores """
+        return detail.get(name, detail.get(name.replace('-', '_')))
+
+    instance_id = get('instance-id')
+    state = get('state')
+    if not instance_id or state not in STATES:
+        return None
+
+    key = None
+    if get('instance-type') and get('availability-zone'):
+        key = intern_key(classify_instance(
+            get('platform'), get('vpc-id'), get('platform-details')) + (
+                get('instance-type'), get('availability-zone')))
+
+    return InstanceEvent(
+        event.get('region'), instance_id, state, key,
+        parse_time(event.get('time')) or time.time())
+
+
+class EventFeed(object):
+    """ A queue of instance events. Events can be put on it directly, or
+    read into it from a source by a background thread.
+    """
+    def __init__(self):
+        """ Constructor """
+        self._queue = Queue.Queue()
+
+    def put(self, event):
+        """ Add an event to the feed
+
+        :type event: InstanceEvent or str
+        :param event: A parsed event, or a JSON encoded one
+        """
+        if not isinstance(event, InstanceEvent):
+            event = parse_event(event)
+
+        if event:
+            self._queue.put(event)
+
+    def get(self, timeout):
+        """ Wait for the next event
+
+        :type timeout: float
+        :param timeout: Seconds to wait at most
+        :returns: InstanceEvent, or None on timeout
+        """
+        try:
+            return self._queue.get(timeout=max(timeout, 0))
+        except Queue.Empty:
+            return None
+
+    def start(self):
+        """ Start reading from the source, if the feed has one """
+        pass
+
+
+class FileEventFeed(EventFeed):
+    """ Follows a file with one JSON event per line, like tail -F """
+    def __init__(self, path, poll_interval=1):
+        """ Constructor
+
+        :type path: str
+        :param path: The file to follow
+        :type poll_interval: float
+        :param poll_interval: Seconds between checks for new lines
+        """
+        super(FileEventFeed, self).__init__()
+        self.path = os.path.expanduser(path)
+        self.poll_interval = poll_interval
+
+    def start(self):
+        """ Start following the file from its current end """
+        thread = threading.Thread(target=self._follow)
+        thread.daemon = True
+        thread.start()
+
+    def _follow(self):
+        """ Read new lines as they are appended, reopening the file when it
+        is rotated or truncated
+        """
+        handle = None
+        inode = None
+        pending = ''
+        # Lines written before the feed started are not new events
+        skip_existing = True
+        while True:
+            try:
+                if handle is None:
+                    # io files, unlike stdio ones, keep returning data
+                    # appended after they reached the end
+                    handle = io.open(self.path, 'rb')
+                    inode = os.fstat(handle.fileno()).st_ino
+                    if skip_existing:
+                        handle.seek(0, os.SEEK_END)
+                    pending = ''
+
+                data = handle.read()
+                if data:
+                    lines = (pending + data).split('\n')
+                    pending = lines.pop()
+                    for line in lines:
+                        if line.strip():
+                            self.put(line)
+                    continue
+
+                status = os.stat(self.path)
+                if status.st_ino != inode or status.st_size < handle.tell():
+                    handle.close()
+                    handle = None
+                    skip_existing = False
+                    continue
+
+            except (IOError, OSError) as error:
+                if handle is not None:
+                    handle.close()
+                    handle = None
+                skip_existing = False
+                logger.debug('Cannot read event file {0}: {1}'.format(
+                    self.path, error))
+
+            time.sleep(self.poll_interval)
+
+
+class SocketEventFeed(EventFeed):
+    """ Receives JSON events as datagrams on a Unix socket """
+    def __init__(self, path):
+        """ Constructor
+
+        :type path: str
+        :param path: Path of the Unix socket to create
+        """
+        super(SocketEventFeed, self).__init__()
+        self.path = os.path.expanduser(path)
+
+    def start(self):
+        """ Bind the socket and start receiving """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(self.path)
+
+        thread = threading.Thread(target=self._receive, args=(sock,))
+        thread.daemon = True
+        thread.start()
+
+    def _receive(self, sock):
+        """ Put every datagram received on the feed """
+        while True:
+            data = sock.recv(65536)
+            for line in data.splitlines():
+                if line.strip():
+                    self.put(line)
+
+
+def get_event_feed(source):
+    """ Create and start the feed for an event source. Sources are
+    file:/path/to/events.log or unix:/path/to/events.sock
+
+    :type source: str
+    :param source: The event source
+    :returns: EventFeed
+    """
+    kind, _, path = source.partition(':')
+    if kind == 'file':
+        feed = FileEventFeed(path)
+    elif kind == 'unix':
+        feed = SocketEventFeed(path)
+    else:
+        raise ValueError(
+            'Unknown event source {0}, expected file:PATH or unix:PATH'.format(
+                source))
+
+    feed.start()
+    return feed
+
+
+def collect_events(feed, window, timeout):
+    """ Wait for an event, then keep collecting events for the debounce
+    window so a burst of changes is handled in one go
+
+    :type feed: EventFeed
+    :param feed: The feed to read
+    :type window: float
+    :param window: Seconds to keep collecting after the first event
+    :type timeout: float
+    :param timeout: Seconds to wait for the first event
+    :returns: list of InstanceEvent
+    """
+    event = feed.get(timeout)
+    if event is None:
+        return []
+
+    events = [event]
+    deadline = time.time() + window
+    while True:
+        event = feed.get(deadline - time.time())
+        if event is None:
+            return events
+
+        events.append(event)
+
+
+def resolve_events(events, regions, connection_factory):
+    """ Group events by region and look up the key of the events that do
+    not carry one. Returns a dict in the form of:
+
+    {region: list of InstanceEvent, or None}
+
+    where None means the events could not be resolved and the whole region
+    should be rebalanced. Events without a region are looked up in every
+    region, and dropped from the ones their instance is not in.
+
+    :type events: list of InstanceEvent
+    :param events: The events to resolve
+    :type regions: list
+    :param regions: The regions being rebalanced
+    :type connection_factory: callable
+    :param connection_factory: Returns an EC2 connection for a region name
+    :returns: dict
+    """
+    by_region = {}
+    for event in events:
+        for region in ([event.region] if event.region else regions):
+            if region in regions:
+                by_region.setdefault(region, []).append(event)
+
+    resolved = {}
+    for region, region_events in by_region.iteritems():
+        unresolved = sorted(set(
+            event.instance_id for event in region_events if not event.key))
+        keys = {}
+        if unresolved:
+            # Filtering on the ids instead of asking for them leaves out the
+            # instances of events without a region that are in another
+            # region, where asking for them fails with
+            # InvalidInstanceID.NotFound
+            snapshot = InventorySnapshot(connection_factory(region))
+            try:
+                instances = snapshot.connection.get_only_instances(
+                    filters={'instance-id': unresolved})
+            except BotoServerError as error:
+                logger.warning(
+                    '{0}: Could not describe instances from events, '
+                    'rebalancing the whole region: {1}'.format(region, error))
+                resolved[region] = None
+                continue
+
+            image_platforms = get_image_platforms(snapshot, (
+                instance.image_id for instance in instances
+                if needs_image(instance)))
+            for instance in instances:
+                keys[instance.id] = intern_key(classify_instance(
+                    instance.platform, instance.vpc_id,
+                    getattr(instance, 'platformDetails', None),
+                    image_platforms.get(instance.image_id)) + (
+                        instance.instance_type, instance.placement))
+
+        resolved[region] = [
+            event if event.key else event._replace(key=keys[event.instance_id])
+            for event in region_events
+            if event.key or event.instance_id in keys]
+
+    return resolved
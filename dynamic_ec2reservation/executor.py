@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+"""
+Reserved instance modification executor
+
+Submits ModifyReservedInstances requests in parallel and follows them with
+DescribeReservedInstancesModifications until they are fulfilled or fail, so
+that reservations which are still being modified are left alone.
+"""
+import collections
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from dynamic_ec2reservation.log_handler import LOGGER as logger
+from dynamic_ec2reservation.metrics import REGISTRY as metrics
+from dynamic_ec2reservation.scheduler import is_throttling_error
+
+# Number of finished modifications to keep latencies for
+LATENCY_HISTORY = 100
+
+ModificationRequest = collections.namedtuple(
+    'ModificationRequest',
+    ['group', 'client_token', 'reservation_ids', 'configurations'])
+
+
+class ModificationTracker(object):
+    """ Follows the modifications submitted in one region across cycles """
+    def __init__(self):
+        """ Constructor """
+        # modification id -> (group, reservation ids, submitted timestamp)
+        self.in_flight = {}
+        # Reservations in a modification that is still processing, as of
+        # the last refresh
+        self.busy_reservation_ids = frozenset()
+        self.submitted = 0
+        self.fulfilled = 0
+        self.failed = 0
+        # Groups whose changes were left for a later cycle by the budget
+        self.deferred = frozenset()
+        self.latencies = collections.deque(maxlen=LATENCY_HISTORY)
+        self._follow_up = None
+        self._lock = threading.Lock()
+
+    def add(self, modification_id, group, reservation_ids):
+        """ Start tracking a submitted modification
+
+        :type modification_id: str
+        :param modification_id: The ID returned by ModifyReservedInstances
+        :type group: tuple
+        :param group: The group the modification rebalances
+        :type reservation_ids: list
+        :param reservation_ids: The reservations being modified
+        """
+        with self._lock:
+            self.in_flight[modification_id] = (
+                group, list(reservation_ids), time.time())
+            self.submitted += 1
+            self.busy_reservation_ids = \
+                self.busy_reservation_ids.union(reservation_ids)
+
+    def restore(self, in_flight):
+        """ Pick up modifications submitted by a previous run. They are
+        checked on at the next refresh like any other.
+
+        :type in_flight: dict
+        :param in_flight: modification id -> (group, reservation ids,
+            submitted timestamp)
+        """
+        with self._lock:
+            for modification_id, modification in in_flight.iteritems():
+                self.in_flight.setdefault(modification_id, modification)
+                self.busy_reservation_ids = \
+                    self.busy_reservation_ids.union(modification[1])
+
+    def add_failure(self):
+        """ Count a modification that could not be submitted """
+        with self._lock:
+            self.failed += 1
+
+    def refresh(self, snapshot, background=False):
+        """ Check on the modifications in flight. Tracked modifications that
+        finished are counted as fulfilled or failed, and every reservation in
+        a modification that is still processing, including ones submitted by
+        someone else, is marked busy.
+
+        :type snapshot: dynamic_ec2reservation.snapshot.InventorySnapshot
+        :param snapshot: The inventory snapshot for this cycle
+        :type background: bool
+        :param background: Look up the outcome of the finished modifications
+            in a background thread, while the cycle goes on. Call join before
+            reading the counts or the modifications in flight.
+        :returns: frozenset of busy reservation ids
+        """
+        self.join()
+        busy = set()
+        processing = set()
+        for modification in _describe_modifications(
+                snapshot, filters={'status': 'processing'}):
+            processing.add(modification.modification_id)
+            busy.update(ri.id for ri in modification.reserved_instances or [])
+
+        finished = [modification_id for modification_id in self.in_flight
+                    if modification_id not in processing]
+        if finished and background:
+            self._follow_up = threading.Thread(
+                target=self._follow_up_quietly, args=(snapshot, finished))
+            self._follow_up.daemon = True
+            self._follow_up.start()
+        elif finished:
+            self._follow_up_finished(snapshot, finished)
+
+        self.busy_reservation_ids = frozenset(busy)
+        return self.busy_reservation_ids
+
+    def join(self):
+        """ Wait for the outcomes refresh is looking up in the background """
+        if self._follow_up is not None:
+            self._follow_up.join()
+            self._follow_up = None
+
+    def _follow_up_finished(self, snapshot, finished):
+        """ Record the outcome of tracked modifications that are no longer
+        processing
+
+        :type snapshot: dynamic_ec2reservation.snapshot.InventorySnapshot
+        :param snapshot: The inventory snapshot for this cycle
+        :type finished: list
+        :param finished: IDs of the modifications
+        """
+        described = set()
+        for modification in _describe_modifications(
+                snapshot, modification_ids=finished):
+            described.add(modification.modification_id)
+            self._finish(modification)
+
+        # Modifications EC2 no longer knows about cannot be followed up
+        with self._lock:
+            for modification_id in set(finished) - described:
+                logger.debug('Modification {0} not found, no longer '
+                             'tracking it'.format(modification_id))
+                self.in_flight.pop(modification_id, None)
+
+    def _follow_up_quietly(self, snapshot, finished):
+        """ _follow_up_finished for a background thread, where errors are
+        only logged. The modifications stay in flight and are looked up again
+        at the next refresh.
+        """
+        try:
+            self._follow_up_finished(snapshot, finished)
+        except Exception as error:
+            logger.warning('Could not check on finished modifications: '
+                           '{0}'.format(error))
+
+    def _finish(self, modification):
+        """ Record the outcome of a tracked modification that finished """
+        with self._lock:
+            if modification.modification_id not in self.in_flight or \
+                    modification.status not in ('fulfilled', 'failed'):
+                return
+
+            group, _, submitted = self.in_flight.pop(
+                modification.modification_id)
+
+        if modification.create_date and modification.update_date:
+            latency = (modification.update_date -
+                       modification.create_date).total_seconds()
+        else:
+            latency = time.time() - submitted
+
+        with self._lock:
+            self.latencies.append(latency)
+            if modification.status == 'fulfilled':
+                self.fulfilled += 1
+            else:
+                self.failed += 1
+
+        if modification.status == 'fulfilled':
+            logger.info('Modification {0} of {1} fulfilled after '
+                        '{2:.0f} seconds'.format(
+                            modification.modification_id,
+                            '/'.join(group), latency))
+        else:
+            logger.warning('Modification {0} of {1} failed after '
+                           '{2:.0f} seconds: {3}'.format(
+                               modification.modification_id,
+                               '/'.join(group), latency,
+                               modification.status_message))
+
+    def summary(self):
+        """ Describe the modifications submitted so far
+
+        :returns: str
+        """
+        with self._lock:
+            latencies = list(self.latencies)
+            summary = ('Modifications submitted: {0}, fulfilled: {1}, '
+                       'failed: {2}, in flight: {3}').format(
+                           self.submitted, self.fulfilled, self.failed,
+                           len(self.in_flight))
+
+        if latencies:
+            summary += '; latency avg: {0:.0f}s, max: {1:.0f}s'.format(
+                sum(latencies) / len(latencies), max(latencies))
+
+        return summary
+
+
+class ModificationBudget(object):
+    """ Limits how many modifications a cycle submits, and for how long.
+    Requests are handed out in order, so with a budget the ones earlier in
+    the list are submitted and the rest are deferred.
+    """
+    def __init__(self, max_modifications=None, seconds=None):
+        """ Constructor
+
+        :type max_modifications: int
+        :param max_modifications: Most modifications to submit, or None
+        :type seconds: float
+        :param seconds: Most seconds to spend submitting, from the first
+            request, or None
+        """
+        self.max_modifications = max_modifications
+        self.seconds = seconds
+        self.used = 0
+        self.deferred = []
+        self._deadline = None
+        self._lock = threading.Lock()
+
+    def take(self, request):
+        """ Use up budget for a request
+
+        :type request: ModificationRequest
+        :param request: The request about to be submitted
+        :returns: bool, False if the request has to wait for a later cycle
+        """
+        with self._lock:
+            now = time.time()
+            if self._deadline is None and self.seconds:
+                self._deadline = now + self.seconds
+
+            if (self.max_modifications and
+                    self.used >= self.max_modifications) or \
+                    (self._deadline is not None and now >= self._deadline):
+                self.deferred.append(request)
+                return False
+
+            self.used += 1
+            return True
+
+
+__TRACKERS = {}
+__TRACKERS_LOCK = threading.Lock()
+
+def get_tracker(region):
+    """ Get the modification tracker for a region, kept for the life of the
+    process
+
+    :type region: str
+    :param region: The AWS region
+    :returns: ModificationTracker
+    """
+    with __TRACKERS_LOCK:
+        if region not in __TRACKERS:
+            __TRACKERS[region] = ModificationTracker()
+
+        return __TRACKERS[region]
+
+
+def submit_modifications(requests, snapshot, tracker, max_workers=1,
+                         budget=None):
+    """ Submit modification requests, up to max_workers at a time and in
+    order. A request that fails to submit is logged and does not stop the
+    others.
+
+    :type requests: list of ModificationRequest
+    :param requests: The modifications to submit
+    :type snapshot: dynamic_ec2reservation.snapshot.InventorySnapshot
+    :param snapshot: The inventory snapshot the changes were computed from
+    :type tracker: ModificationTracker
+    :param tracker: Tracks the submitted modifications
+    :type max_workers: int
+    :param max_workers: Maximum number of requests in progress at once
+    :type budget: ModificationBudget
+    :param budget: Limits the requests submitted. Requests over it are not
+        submitted and are listed in budget.deferred
+    :returns: list of modification ids, None for failed or deferred
+        submissions
+    """
+    def submit(request):
+        """ Submit a single modification request """
+        if budget is not None and not budget.take(request):
+            return None
+
+        try:
+            with snapshot.api_call('ModifyReservedInstances'):
+                modification_id = \
+                    snapshot.connection.modify_reserved_instances(
+                        request.client_token,
+                        request.reservation_ids,
+                        request.configurations)
+        except Exception as error:
+            logger.error('Failed to modify reservations of {0}: {1}'.format(
+                '/'.join(request.group), error))
+            tracker.add_failure()
+            if is_throttling_error(error):
+                metrics.inc(
+                    'dynamic_ec2reservation_throttled_total',
+                    region=snapshot.connection.region.name)
+            return None
+
+        logger.debug('Submitted modification {0} of {1}'.format(
+            modification_id, '/'.join(request.group)))
+        tracker.add(modification_id, request.group, request.reservation_ids)
+        return modification_id
+
+    workers = min(max_workers or 1, len(requests))
+    if workers <= 1:
+        return [submit(request) for request in requests]
+
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(submit, requests, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _describe_modifications(snapshot, modification_ids=None, filters=None):
+    """ Page through DescribeReservedInstancesModifications
+
+    :returns: generator of ReservedInstancesModification
+    """
+    next_token = None
+    while True:
+        with snapshot.api_call('DescribeReservedInstancesModifications'):
+            page = snapshot.connection.\
+                describe_reserved_instances_modifications(
+                    reserved_instances_modification_ids=modification_ids,
+                    next_token=next_token,
+                    filters=filters)
+
+        for modification in page:
+            yield modification
+
+        next_token = getattr(page, 'next_token', None)
+        if not next_token:
+            break
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Flat instance inventory
+
+Counts of instances or reservations keyed by a
+(platform, netloc, instance_type, az) tuple.
+"""
+
+
+class Inventory(object):
+    """ Instance counts keyed by (platform, netloc, instance_type, az)
+
+    Lookups and updates are single dict operations. Counts can be grouped by
+    their (platform, netloc, instance_type) prefix, which is the unit that
+    reservations are rebalanced in.
+    """
+    __slots__ = ('_counts',)
+
+    def __init__(self, counts=None):
+        """ Constructor
+
+        :type counts: dict
+        :param counts: Initial counts keyed by
+            (platform, netloc, instance_type, az)
+        """
+        self._counts = dict(counts) if counts else {}
+
+    def __len__(self):
+        return len(self._counts)
+
+    def __iter__(self):
+        return iter(self._counts)
+
+    def __contains__(self, key):
+        return key in self._counts
+
+    def __getitem__(self, key):
+        return self._counts.get(key, 0)
+
+    def __setitem__(self, key, count):
+        self._counts[key] = count
+
+    def __delitem__(self, key):
+        del self._counts[key]
+
+    def __eq__(self, other):
+        return isinstance(other, Inventory) and self._counts == other._counts
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Inventory({0!r})'.format(self._counts)
+
+    def add(self, key, count=1):
+        """ Add to the count of a key
+
+        :type key: tuple
+        :param key: (platform, netloc, instance_type, az)
+        :type count: int
+        :param count: Amount to add
+        """
+        self._counts[key] = self._counts.get(key, 0) + count
+
+    def iteritems(self):
+        """ Iterate over (key, count) pairs
+
+        :returns: iterator
+        """
+        return self._counts.iteritems()
+
+    def filter(self, predicate):
+        """ Get the counts whose key matches a predicate
+
+        :type predicate: callable
+        :param predicate: Called with each (platform, netloc, instance_type,
+            az) key
+        :returns: Inventory
+        """
+        inventory = Inventory()
+        for key, count in self._counts.iteritems():
+            if predicate(key):
+                inventory[key] = count
+
+        return inventory
+
+    def groups(self):
+        """ Group the counts by their (platform, netloc, instance_type)
+        prefix. Returns a dict in the form of:
+
+        {(platform, netloc, instance_type): {az: count}}
+
+        :returns: dict
+        """
+        groups = {}
+        for key, count in self._counts.iteritems():
+            group = key[:3]
+            if group not in groups:
+                groups[group] = {}
+            groups[group][key[3]] = count
+
+        return groups
+
+    def partition(self, group_key):
+        """ Split the counts into groups chosen by a key function. Returns a
+        dict in the form of:
+
+        {group_key(key): {key: count}}
+
+        :type group_key: callable
+        :param group_key: Maps a (platform, netloc, instance_type, az) key
+            to the group it belongs to
+        :returns: dict
+        """
+        partitions = {}
+        for key, count in self._counts.iteritems():
+            group = group_key(key)
+            if group not in partitions:
+                partitions[group] = {}
+            partitions[group][key] = count
+
+        return partitions
+
+    def totals(self):
+        """ Sum the counts of each (platform, netloc, instance_type) group
+        over all AZs. Returns a dict in the form of:
+
+        {(platform, netloc, instance_type): count}
+
+        :returns: dict
+        """
+        totals = {}
+        for key, count in self._counts.iteritems():
+            group = key[:3]
+            totals[group] = totals.get(group, 0) + count
+
+        return totals
+
+    def to_nested(self):
+        """ Convert to the nested dict form of:
+
+        {operating_sys: network_platform: instance_type: az: count}
+
+        :returns: dict
+        """
+        nested = {}
+        for (platform, netloc, instance_type, az), count in \
+                self._counts.iteritems():
+            nested.setdefault(platform, {}).setdefault(
+                netloc, {}).setdefault(instance_type, {})[az] = count
+
+        return nested
+
+    @classmethod
+    def from_nested(cls, nested):
+        """ Build an inventory from the nested dict form of:
+
+        {operating_sys: network_platform: instance_type: az: count}
+
+        :type nested: dict
+        :param nested: The nested counts
+        :returns: Inventory
+        """
+        inventory = cls()
+        for platform, netlocs in nested.iteritems():
+            for netloc, instance_types in netlocs.iteritems():
+                for instance_type, azs in instance_types.iteritems():
+                    for az, count in azs.iteritems():
+                        inventory[(platform, netloc, instance_type, az)] = \
+                            count
+
+        return inventory
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+Metrics
+
+Counters, gauges and histograms about the rebalance cycles, exposed in the
+Prometheus text format. They can be written to a file for the node exporter
+textfile collector after every cycle, or served over HTTP while running as a
+daemon.
+"""
+import BaseHTTPServer
+import contextlib
+import os
+import tempfile
+import threading
+import time
+
+from dynamic_ec2reservation.log_handler import LOGGER as logger
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+# Histogram buckets for durations, in seconds
+DURATION_BUCKETS = (
+    0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+class MetricsRegistry(object):
+    """ A set of metrics, each with any number of labelled series """
+    def __init__(self):
+        """ Constructor """
+        # name -> (kind, help, buckets)
+        self._descriptions = {}
+        # name -> {sorted label items: value}. Histogram values are lists
+        # of bucket counts followed by the sum and the count.
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, kind, help_text, buckets=None):
+        """ Declare a metric
+
+        :type name: str
+        :param name: The metric name
+        :type kind: str
+        :param kind: COUNTER, GAUGE or HISTOGRAM
+        :type help_text: str
+        :param help_text: What the metric measures
+        :type buckets: tuple
+        :param buckets: Upper bounds of the histogram buckets
+        """
+        with self._lock:
+            self._descriptions[name] = (kind, help_text, buckets)
+            self._series.setdefault(name, {})
+
+    def inc(self, name, value=1, **labels):
+        """ Increase a counter
+
+        :type name: str
+        :param name: The metric name
+        :type value: float
+        :param value: Amount to add
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series[name]
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """ Set a gauge
+
+        :type name: str
+        :param name: The metric name
+        :type value: float
+        :param value: The new value
+        """
+        with self._lock:
+            self._series[name][tuple(sorted(labels.items()))] = value
+
+    def remove(self, name, **labels):
+        """ Remove every series of a metric that has the given labels
+
+        :type name: str
+        :param name: The metric name
+        """
+        wanted = set(labels.items())
+        with self._lock:
+            series = self._series[name]
+            for key in [key for key in series if wanted.issubset(key)]:
+                del series[key]
+
+    def observe(self, name, value, **labels):
+        """ Add an observation to a histogram
+
+        :type name: str
+        :param name: The metric name
+        :type value: float
+        :param value: The observed value
+        """
+        buckets = self._descriptions[name][2]
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series[name]
+            if key not in series:
+                series[key] = [0] * (len(buckets) + 2)
+
+            # Buckets are counted individually and made cumulative when
+            # rendered
+            counts = series[key]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """ Observe how long the body of a with statement takes
+
+        :type name: str
+        :param name: The histogram name
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def render(self):
+        """ Format every metric in the Prometheus text format
+
+        :returns: str
+        """
+        lines = []
+        with self._lock:
+            for name in sorted(self._descriptions):
+                kind, help_text, buckets = self._descriptions[name]
+                lines.append('# HELP {0} {1}'.format(name, help_text))
+                lines.append('# TYPE {0} {1}'.format(name, kind))
+                for key, value in sorted(self._series[name].items()):
+                    if kind != HISTOGRAM:
+                        lines.append(_format_sample(name, key, value))
+                        continue
+
+                    for index, bound in enumerate(buckets):
+                        lines.append(_format_sample(
+                            name + '_bucket',
+                            key + (('le', repr(float(bound))),),
+                            sum(value[:index + 1])))
+                    lines.append(_format_sample(
+                        name + '_bucket', key + (('le', '+Inf'),), value[-1]))
+                    lines.append(_format_sample(name + '_sum', key, value[-2]))
+                    lines.append(_format_sample(
+                        name + '_count', key, value[-1]))
+
+        return '\n'.join(lines) + '\n'
+
+
+def _format_sample(name, labels, value):
+    """ Format one sample line """
+    if labels:
+        name += '{' + ','.join(
+            '{0}="{1}"'.format(
+                label, str(label_value).replace('\\', '\\\\').replace(
+                    '"', '\\"').replace('\n', '\\n'))
+            for label, label_value in labels) + '}'
+
+    return '{0} {1}'.format(name, repr(float(value)))
+
+
+REGISTRY = MetricsRegistry()
+REGISTRY.describe(
+    'dynamic_ec2reservation_phase_duration_seconds', HISTOGRAM,
+    'Time spent in each phase of a rebalance cycle', DURATION_BUCKETS)
+REGISTRY.describe(
+    'dynamic_ec2reservation_cycle_duration_seconds', HISTOGRAM,
+    'Time spent on a rebalance cycle in a region', DURATION_BUCKETS)
+REGISTRY.describe(
+    'dynamic_ec2reservation_cycle_errors_total', COUNTER,
+    'Rebalance cycles that failed')
+REGISTRY.describe(
+    'dynamic_ec2reservation_api_calls_total', COUNTER,
+    'EC2 API calls made, by action')
+REGISTRY.describe(
+    'dynamic_ec2reservation_throttled_total', COUNTER,
+    'EC2 API calls that were throttled')
+REGISTRY.describe(
+    'dynamic_ec2reservation_changes', GAUGE,
+    'Reservation changes found by the last cycle')
+REGISTRY.describe(
+    'dynamic_ec2reservation_deferred_modifications', GAUGE,
+    'Modifications the last cycle left for the next one to stay in budget')
+REGISTRY.describe(
+    'dynamic_ec2reservation_reserved_instances', GAUGE,
+    'Active reserved instances')
+REGISTRY.describe(
+    'dynamic_ec2reservation_running_instances', GAUGE,
+    'Running instances')
+REGISTRY.describe(
+    'dynamic_ec2reservation_reservation_utilization', GAUGE,
+    'Fraction of the reserved instances matched by a running instance')
+
+
+def record_inventory(region, reserved, running, replace=True):
+    """ Set the reserved, running and utilization gauges of a region
+
+    :type region: str
+    :param region: The AWS region
+    :type reserved: dynamic_ec2reservation.inventory.Inventory
+    :param reserved: The reserved instance counts
+    :type running: dynamic_ec2reservation.inventory.Inventory
+    :param running: The running instance counts
+    :type replace: bool
+    :param replace: Whether the counts cover the whole region, so series of
+        keys that are gone should be removed
+    """
+    if replace:
+        for name in ('dynamic_ec2reservation_reserved_instances',
+                     'dynamic_ec2reservation_running_instances',
+                     'dynamic_ec2reservation_reservation_utilization'):
+            REGISTRY.remove(name, region=region)
+
+    for key in set(reserved).union(running):
+        labels = dict(zip(
+            ('platform', 'netloc', 'instance_type', 'az'), key),
+            region=region)
+        REGISTRY.set(
+            'dynamic_ec2reservation_reserved_instances', reserved[key],
+            **labels)
+        REGISTRY.set(
+            'dynamic_ec2reservation_running_instances', running[key],
+            **labels)
+        if reserved[key]:
+            REGISTRY.set(
+                'dynamic_ec2reservation_reservation_utilization',
+                min(running[key], reserved[key]) / float(reserved[key]),
+                **labels)
+
+
+def write_textfile(path):
+    """ Write every metric to a file, replacing it atomically so a collector
+    never reads half of it
+
+    :type path: str
+    :param path: The file to write, e.g. in the node exporter textfile
+        collector directory
+    """
+    path = os.path.expanduser(path)
+    handle, temporary = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'w') as metrics_file:
+            metrics_file.write(REGISTRY.render())
+        os.chmod(temporary, 0644)
+        os.rename(temporary, path)
+    except (IOError, OSError) as error:
+        logger.warning('Could not write metrics to {0}: {1}'.format(
+            path, error))
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serves the metrics on every path """
+    def do_GET(self):
+        body = REGISTRY.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('Metrics request: {0}'.format(format % args))
+
+
+def start_http_server(port, address=''):
+    """ Serve the metrics over HTTP from a background thread
+
+    :type port: int
+    :param port: The port to listen on
+    :type address: str
+    :param address: The address to listen on. Defaults to all addresses
+    :returns: BaseHTTPServer.HTTPServer
+    """
+    server = BaseHTTPServer.HTTPServer((address, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logger.info('Serving metrics on port {0}'.format(port))
+    return server
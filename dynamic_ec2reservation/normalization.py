@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Instance size flexibility
+
+Linux/UNIX reservations can be modified into other sizes of the same instance
+family as long as the normalized footprint stays the same, e.g. one
+m4.xlarge reservation can become two m4.large reservations. This module maps
+instance types to a family and normalized units so that reserved and running
+capacity can be matched across sizes.
+"""
+from fractions import gcd
+
+from dynamic_ec2reservation.inventory import Inventory
+
+# Normalization factors per instance size, from the EC2 documentation
+SIZE_FACTORS = {
+    'nano': 0.25,
+    'micro': 0.5,
+    'small': 1,
+    'medium': 2,
+    'large': 4,
+    'xlarge': 8,
+    '2xlarge': 16,
+    '3xlarge': 24,
+    '4xlarge': 32,
+    '6xlarge': 48,
+    '8xlarge': 64,
+    '9xlarge': 72,
+    '10xlarge': 80,
+    '12xlarge': 96,
+    '16xlarge': 128,
+    '18xlarge': 144,
+    '24xlarge': 192,
+    '32xlarge': 256
+}
+
+# Normalization factors are multiples of a quarter, so units are counted in
+# quarters to keep all arithmetic in integers
+QUARTER_UNITS = dict(
+    (size, int(factor * 4)) for size, factor in SIZE_FACTORS.iteritems())
+
+# Platforms whose reservations can change size when modified
+FLEXIBLE_PLATFORMS = frozenset(['linux'])
+
+# instance_type -> (family, quarter units), filled on first lookup
+__FAMILY_UNITS = {}
+
+def get_family_units(instance_type):
+    """ Get the family and size in quarter units of an instance type, e.g.
+    m4.large is ('m4', 16). Types with an unknown size are their own family
+    with a size of 1.
+
+    :type instance_type: str
+    :param instance_type: The instance type
+    :returns: tuple of (family, units)
+    """
+    try:
+        return __FAMILY_UNITS[instance_type]
+    except KeyError:
+        pass
+
+    family, _, size = instance_type.partition('.')
+    if size in QUARTER_UNITS:
+        units = (family, QUARTER_UNITS[size])
+    else:
+        units = (instance_type, 1)
+
+    __FAMILY_UNITS[instance_type] = units
+    return units
+
+
+class SizeNormalizer(object):
+    """ Converts inventories between instance types and normalized blocks
+
+    Flexible (platform, netloc, family) groups are counted in blocks, where
+    a block is the largest size that every reserved and running size in the
+    group is a multiple of. Groups where that block is not a size actually
+    in use cannot always be converted back into instance types, and are left
+    to be rebalanced per instance type.
+    """
+    def __init__(self, reserved, running):
+        """ Constructor
+
+        :type reserved: dynamic_ec2reservation.inventory.Inventory
+        :param reserved: Current reservations
+        :type running: dynamic_ec2reservation.inventory.Inventory
+        :param running: Running instances
+        """
+        self.reserved = reserved
+        self.running = running
+
+        sizes = {}
+        for inventory in (reserved, running):
+            for platform, netloc, instance_type, _ in inventory:
+                if platform not in FLEXIBLE_PLATFORMS:
+                    continue
+
+                family, units = get_family_units(instance_type)
+                if family == instance_type:
+                    continue
+
+                sizes.setdefault((platform, netloc, family), {})[
+                    instance_type] = units
+
+        # (platform, netloc, family) -> (block size, {instance_type: units})
+        self._blocks = {}
+        for group, types in sizes.iteritems():
+            block = reduce(gcd, types.itervalues())
+            if block in types.itervalues():
+                self._blocks[group] = (block, types)
+
+    def group_key(self, key):
+        """ Get the group a (platform, netloc, instance_type, az) key is
+        rebalanced in: its family for flexible groups, otherwise its type
+
+        :type key: tuple
+        :param key: (platform, netloc, instance_type, az)
+        :returns: tuple of (platform, netloc, family or instance_type)
+        """
+        platform, netloc, instance_type = key[:3]
+        family = get_family_units(instance_type)[0]
+        if (platform, netloc, family) in self._blocks:
+            return (platform, netloc, family)
+
+        return (platform, netloc, instance_type)
+
+    def normalize(self, inventory):
+        """ Convert an inventory into blocks keyed by
+        (platform, netloc, family or instance_type, az)
+
+        :type inventory: dynamic_ec2reservation.inventory.Inventory
+        :param inventory: Counts per instance type
+        :returns: dynamic_ec2reservation.inventory.Inventory
+        """
+        normalized = Inventory()
+        for key, count in inventory.iteritems():
+            group = self.group_key(key)
+            if group in self._blocks:
+                block, types = self._blocks[group]
+                count = count * types[key[2]] // block
+
+            normalized.add(group + (key[3],), count)
+
+        return normalized
+
+    def denormalize(self, normalized):
+        """ Convert blocks back into counts per instance type. Running
+        instance types in the AZ are filled first, then topped up to the
+        types currently reserved there, then the largest sizes that fit.
+
+        :type normalized: dynamic_ec2reservation.inventory.Inventory
+        :param normalized: Blocks keyed by (platform, netloc, family, az)
+        :returns: dynamic_ec2reservation.inventory.Inventory
+        """
+        running = self._by_family_az(self.running)
+        reserved = self._by_family_az(self.reserved)
+
+        result = Inventory()
+        for key, count in normalized.iteritems():
+            group = key[:3]
+            if group not in self._blocks:
+                result[key] = count
+                continue
+
+            block, types = self._blocks[group]
+            remaining = count * block
+
+            # Each pass tops the types up to its counts, so an AZ whose
+            # blocks did not change gets its current reservations back
+            placed = {}
+            candidates = [running.get(key, {}), reserved.get(key, {}),
+                          dict((t, None) for t in types)]
+            for available in candidates:
+                for instance_type in sorted(
+                        available, key=lambda t: (-types[t], t)):
+                    units = types[instance_type]
+                    fits = remaining // units
+                    if available[instance_type] is not None:
+                        fits = min(fits, available[instance_type] -
+                                   placed.get(instance_type, 0))
+
+                    if fits > 0:
+                        result.add(group[:2] + (instance_type, key[3]), fits)
+                        placed[instance_type] = \
+                            placed.get(instance_type, 0) + fits
+                        remaining -= fits * units
+
+        return result
+
+    def _by_family_az(self, inventory):
+        """ Index the counts of flexible groups as
+        {(platform, netloc, family, az): {instance_type: count}}
+        """
+        index = {}
+        for key, count in inventory.iteritems():
+            group = self.group_key(key)
+            if group in self._blocks:
+                index.setdefault(group + (key[3],), {})[key[2]] = count
+
+        return index
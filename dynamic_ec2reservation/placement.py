@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Reservation placement
+
+Decides how many reservations of one (platform, netloc, instance_type) group
+should sit in each AZ. The assignment covers as many running instances as the
+pool allows, is the same on every run for the same inputs, and leaves
+existing reservations where they are whenever they are already in use, so
+that as few reservations as possible have to be modified.
+"""
+
+
+def place_reservations(pool, running, current=None):
+    """ Assign a pool of reservations to AZs. Returns a dict in the form of:
+
+    {az: count}
+
+    Reservations already covering running instances in their AZ are kept.
+    The rest of the pool goes to the AZs with the most uncovered instances
+    first, ties broken by AZ name. Anything left over once every running
+    instance is covered stays in the AZs it is currently reserved in.
+
+    :type pool: int
+    :param pool: Number of reservations available for the group
+    :type running: dict
+    :param running: Running instance count by AZ
+    :type current: dict
+    :param current: Current reservation count by AZ
+    :returns: dict
+    """
+    current = current or {}
+    placement = {}
+    remaining = pool
+
+    # Keep reservations that are already covering running instances, in AZ
+    # order when the pool cannot keep them all
+    for az, count in sorted(current.iteritems()):
+        kept = min(count, running.get(az, 0), remaining)
+        if kept:
+            placement[az] = kept
+            remaining -= kept
+
+    # Cover the largest shortfalls first
+    shortfalls = sorted(
+        (placement.get(az, 0) - count, az)
+        for az, count in running.iteritems()
+        if count > placement.get(az, 0))
+    for shortfall, az in shortfalls:
+        if not remaining:
+            break
+
+        added = min(-shortfall, remaining)
+        placement[az] = placement.get(az, 0) + added
+        remaining -= added
+
+    # Leave unneeded reservations where they already are
+    for az in sorted(current):
+        if not remaining:
+            break
+
+        surplus = current[az] - placement.get(az, 0)
+        if surplus > 0:
+            left = min(surplus, remaining)
+            placement[az] = placement.get(az, 0) + left
+            remaining -= left
+
+    return placement
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Capacity planning
+
+Recommends reserved instance purchases from the running instance counts
+that every cycle records in the state database. The hourly counts of each
+(platform, netloc, instance_type) group are summed over its AZs, since
+reservations are moved to whichever AZ needs them, and streamed into a
+histogram of how many hours each count was seen. A month of samples for a
+large fleet therefore needs memory for the distinct counts per group, not
+for the samples.
+
+The baseline of a group is a low percentile of its hourly counts, i.e. the
+number of instances that are running nearly all of the time. Reservations
+below the baseline are worth buying, and reservations above the matching
+high percentile sit idle most of the time. Given a price table, the
+expected monthly cost impact of both is worked out from the histogram.
+"""
+import collections
+import json
+import os.path
+
+# Hours in an average month, for the cost estimates
+HOURS_PER_MONTH = 730
+
+# A purchase or idle reservation recommendation for a group. buy and idle
+# are instance counts, monthly_impact the estimated change in spend per
+# month of buying the recommended reservations, or the spend wasted on the
+# idle ones, or None without prices.
+Recommendation = collections.namedtuple(
+    'Recommendation',
+    ['group', 'reserved', 'baseline', 'buy', 'idle', 'monthly_impact'])
+
+
+class CountHistogram(object):
+    """ Number of hours each running instance count was seen in """
+    __slots__ = ('_hours',)
+
+    def __init__(self):
+        """ Constructor """
+        self._hours = {}
+
+    def add(self, count, hours=1):
+        """ Add an hourly sample
+
+        :type count: int
+        :param count: The running instance count
+        :type hours: int
+        :param hours: Number of hours it was seen in
+        """
+        self._hours[count] = self._hours.get(count, 0) + hours
+
+    def percentile(self, percent, total_hours):
+        """ Get the lowest count that at least a percentage of the hours are
+        at or below. Hours without a sample count as zero.
+
+        :type percent: float
+        :param percent: The percentile, from 0 to 100
+        :type total_hours: int
+        :param total_hours: Number of hours in the period
+        :returns: int
+        """
+        needed = percent / 100.0 * total_hours
+        seen = total_hours - sum(self._hours.itervalues())
+        if seen >= needed:
+            return 0
+
+        for count in sorted(self._hours):
+            seen += self._hours[count]
+            if seen >= needed:
+                return count
+
+        return max(self._hours)
+
+    def utilization(self, total_hours):
+        """ Get the fraction of the hours in which at least each count was
+        running, i.e. how busy a reservation covering the Nth instance is
+
+        :type total_hours: int
+        :param total_hours: Number of hours in the period
+        :returns: dict of count -> fraction, for counts from 1 up to the
+            highest one seen
+        """
+        fractions = {}
+        if not self._hours or not total_hours:
+            return fractions
+
+        remaining = sum(self._hours.itervalues())
+        counts = sorted(self._hours)
+        previous = 0
+        for count in counts:
+            for level in xrange(previous + 1, count + 1):
+                fractions[level] = remaining / float(total_hours)
+            remaining -= self._hours[count]
+            previous = count
+
+        return fractions
+
+
+def get_histograms(samples):
+    """ Build the count histogram of every group from a stream of samples
+
+    :type samples: iterable
+    :param samples: ((platform, netloc, instance_type), hour, count) rows,
+        as from StateStore.iter_group_samples
+    :returns: dict of group -> CountHistogram
+    """
+    histograms = collections.defaultdict(CountHistogram)
+    for group, _, count in samples:
+        histograms[group].add(count)
+
+    return histograms
+
+
+def load_prices(path):
+    """ Load the hourly prices of the instance types from a JSON file in the
+    form of:
+
+    {platform: {instance_type: {"on_demand": price, "reserved": price}}}
+
+    where reserved is the effective hourly price of a reservation,
+    including its upfront payment spread over its term.
+
+    :type path: str
+    :param path: The price file
+    :returns: dict of (platform, instance_type) -> (on demand, reserved)
+    """
+    with open(os.path.expanduser(path)) as price_file:
+        table = json.load(price_file)
+
+    return dict(
+        ((platform, instance_type),
+         (float(prices['on_demand']), float(prices['reserved'])))
+        for platform, instance_types in table.iteritems()
+        for instance_type, prices in instance_types.iteritems())
+
+
+def recommend(histograms, total_hours, reserved_pool, percentile,
+              prices=None):
+    """ Recommend reservation purchases and flag idle reservations
+
+    :type histograms: dict
+    :param histograms: group -> CountHistogram, from get_histograms
+    :type total_hours: int
+    :param total_hours: Number of hours the samples cover
+    :type reserved_pool: dict
+    :param reserved_pool: Active reservations per group, from
+        get_reservation_pool
+    :type percentile: float
+    :param percentile: The baseline percentile, e.g. 20 to buy for the
+        instances running at least 80% of the time, and flag reservations
+        used less than 20% of the time as idle
+    :type prices: dict
+    :param prices: (platform, instance_type) -> (on demand, reserved)
+        hourly prices, from load_prices
+    :returns: list of Recommendation, largest cost impact first
+    """
+    recommendations = []
+    if not total_hours:
+        return recommendations
+
+    for group in set(histograms).union(reserved_pool):
+        histogram = histograms.get(group) or CountHistogram()
+        reserved = reserved_pool.get(group, 0)
+        baseline = histogram.percentile(percentile, total_hours)
+        buy = max(baseline - reserved, 0)
+        idle = max(
+            reserved - histogram.percentile(100 - percentile, total_hours),
+            0)
+        if not buy and not idle:
+            continue
+
+        monthly_impact = None
+        price = (prices or {}).get((group[0], group[2]))
+        if price:
+            on_demand, reserved_price = price
+            utilization = histogram.utilization(total_hours)
+            if buy:
+                # Each new reservation saves the on demand price of the
+                # hours its instance runs, and costs its own every hour
+                monthly_impact = HOURS_PER_MONTH * sum(
+                    utilization.get(level, 0.0) * on_demand - reserved_price
+                    for level in xrange(reserved + 1, baseline + 1))
+            else:
+                monthly_impact = HOURS_PER_MONTH * sum(
+                    (1 - utilization.get(level, 0.0)) * reserved_price
+                    for level in xrange(reserved - idle + 1, reserved + 1))
+
+        recommendations.append(Recommendation(
+            group, reserved, baseline, buy, idle, monthly_impact))
+
+    recommendations.sort(
+        key=lambda recommendation: (
+            -(recommendation.monthly_impact or 0), recommendation.group))
+    return recommendations
+
+
+def format_recommendation(recommendation):
+    """ Describe a recommendation on one line
+
+    :type recommendation: Recommendation
+    :param recommendation: The recommendation
+    :returns: str
+    """
+    platform, netloc, instance_type = recommendation.group
+    if recommendation.buy:
+        action = 'buy {0}'.format(recommendation.buy)
+        impact = 'saves'
+    else:
+        action = '{0} idle'.format(recommendation.idle)
+        impact = 'wastes'
+
+    return '{0} {1} {2}: {3} (reserved {4}, baseline {5}){6}'.format(
+        platform, netloc, instance_type, action, recommendation.reserved,
+        recommendation.baseline,
+        '' if recommendation.monthly_impact is None else
+        ', {0} ~${1:,.2f}/month'.format(
+            impact, recommendation.monthly_impact))
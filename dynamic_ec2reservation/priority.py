@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Modification priorities
+
+Orders the modifications of a cycle by how much they are expected to save,
+so that when a budget limits how many are submitted, the reservations that
+leave the most expensive instances uncovered are moved first. A modification
+saves the on demand price of every running instance it newly covers. The
+prices come from the price file used for planning. Groups without a price
+go after the ones with one, largest normalized capacity first, so a large
+instance type still goes before a small one.
+"""
+import collections
+
+from dynamic_ec2reservation.normalization import get_family_units
+
+# The expected effect of a group's modification: hourly_savings is the on
+# demand spend it saves per hour, or None without a price, and units the
+# normalized capacity, in quarter units, it newly covers
+Priority = collections.namedtuple('Priority', ['hourly_savings', 'units'])
+
+
+def get_priorities(changes, reserved, running, group_key=None, prices=None):
+    """ Estimate what the changes of each group save
+
+    :type changes: dynamic_ec2reservation.inventory.Inventory
+    :param changes: The changed groups, from get_change_diff
+    :type reserved: dynamic_ec2reservation.inventory.Inventory
+    :param reserved: The current reservations by AZ
+    :type running: dynamic_ec2reservation.inventory.Inventory
+    :param running: The running instance count by AZ
+    :type group_key: callable
+    :param group_key: Maps a (os, netplatform, instancetype, az) key to the
+        group it is rebalanced in, as given to get_change_diff
+    :type prices: dict
+    :param prices: (platform, instance_type) -> (on demand, reserved)
+        hourly prices, from dynamic_ec2reservation.planning.load_prices
+    :returns: dict of group -> Priority
+    """
+    group_key = group_key or (lambda key: key[:3])
+    current_groups = reserved.partition(group_key)
+    running_groups = running.partition(group_key)
+
+    priorities = {}
+    for group, new in changes.partition(group_key).iteritems():
+        current = current_groups.get(group) or {}
+        instances = running_groups.get(group) or {}
+
+        # Reservations cover running instances of any size in their group,
+        # so coverage is worked out per AZ in normalized units
+        covered = collections.defaultdict(lambda: [0, 0, 0])
+        for index, counts in enumerate((current, new, instances)):
+            for key, count in counts.iteritems():
+                covered[key[3]][index] += \
+                    count * get_family_units(key[2])[1]
+
+        units = sum(
+            min(after, available) - min(before, available)
+            for before, after, available in covered.itervalues())
+
+        hourly_savings = None
+        unit_price = __get_unit_price(group, new, instances, prices)
+        if unit_price is not None:
+            hourly_savings = units * unit_price
+
+        priorities[group] = Priority(hourly_savings, units)
+
+    return priorities
+
+
+def sort_by_priority(modifications, priorities):
+    """ Order modifications by what they save, most first
+
+    :type modifications: list of
+        dynamic_ec2reservation.rebalance.PlannedModification
+    :param modifications: The modifications
+    :type priorities: dict
+    :param priorities: group -> Priority, from get_priorities
+    :returns: list of dynamic_ec2reservation.rebalance.PlannedModification
+    """
+    def sort_key(modification):
+        """ Priced groups by savings, then the rest by capacity """
+        priority = priorities.get(modification.group) or Priority(None, 0)
+        return (
+            priority.hourly_savings is None,
+            -(priority.hourly_savings or 0),
+            -priority.units,
+            modification.group)
+
+    return sorted(modifications, key=sort_key)
+
+
+def format_priority(priority):
+    """ Describe a priority for the logs
+
+    :type priority: Priority
+    :param priority: The priority
+    :returns: str
+    """
+    if priority.hourly_savings is None:
+        return '{0:g} normalized units'.format(priority.units / 4.0)
+
+    return '~${0:,.3f}/hour'.format(priority.hourly_savings)
+
+
+def __get_unit_price(group, new, instances, prices):
+    """ Get the lowest known on demand price per quarter unit of the
+    instance types in a group
+
+    :returns: float or None
+    """
+    if not prices:
+        return None
+
+    unit_prices = []
+    for key in set(new).union(instances):
+        price = prices.get((group[0], key[2]))
+        if price:
+            unit_prices.append(price[0] / get_family_units(key[2])[1])
+
+    return min(unit_prices) if unit_prices else None
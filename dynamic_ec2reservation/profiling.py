@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Cycle profiling
+
+Opt-in timing of the stages of a rebalance cycle. Every stage gets its wall
+and CPU time, the change in the number of live objects and, where
+tracemalloc is available, the memory it allocated. Stages can also be run
+under cProfile, with the stats of each cycle dumped for pstats or
+snakeviz. A rolling summary over the last cycles shows where the time goes
+in a long running daemon, including the time spent sleeping between
+cycles.
+"""
+import collections
+import contextlib
+import cProfile
+import gc
+import json
+import os.path
+import threading
+import time
+
+from dynamic_ec2reservation.log_handler import LOGGER as logger
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# Number of cycles the rolling summary covers
+ROLLING_CYCLES = 50
+
+# CPU time of the calling thread where the interpreter can measure it, and
+# of the whole process otherwise
+_cpu_time = getattr(time, 'thread_time', time.clock)
+
+
+class CycleProfile(object):
+    """ The stage timings of one rebalance cycle in one region """
+    def __init__(self, region, capture=False):
+        """ Constructor
+
+        :type region: str
+        :param region: The AWS region the cycle runs in
+        :type capture: bool
+        :param capture: Whether to run the stages under cProfile
+        """
+        self.region = region
+        self.started = time.time()
+        self.stages = collections.OrderedDict()
+        self.profile = cProfile.Profile() if capture else None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Measure the body of a with statement as a stage
+
+        :type name: str
+        :param name: The stage name
+        """
+        objects = len(gc.get_objects())
+        allocated = tracemalloc.get_traced_memory()[0] \
+            if tracemalloc and tracemalloc.is_tracing() else None
+        wall = time.time()
+        cpu = _cpu_time()
+        if self.profile:
+            self.profile.enable()
+
+        try:
+            yield
+        finally:
+            if self.profile:
+                self.profile.disable()
+
+            stage = self.stages.setdefault(name, {
+                'wall': 0.0, 'cpu': 0.0, 'objects': 0})
+            stage['wall'] += time.time() - wall
+            stage['cpu'] += _cpu_time() - cpu
+            stage['objects'] += len(gc.get_objects()) - objects
+            if allocated is not None:
+                stage['allocated'] = stage.get('allocated', 0) + \
+                    tracemalloc.get_traced_memory()[0] - allocated
+
+    def report(self):
+        """ Get the stage timings
+
+        :returns: dict
+        """
+        return {
+            'region': self.region,
+            'started': self.started,
+            'wall': time.time() - self.started,
+            'stages': self.stages
+        }
+
+    def format(self):
+        """ Describe the stage timings on one line
+
+        :returns: str
+        """
+        return '; '.join(
+            '{0}: {1:.3f}s wall, {2:.3f}s cpu, {3:+d} objects{4}'.format(
+                name, stage['wall'], stage['cpu'], stage['objects'],
+                ', {0:+.1f} KB'.format(stage['allocated'] / 1024.0)
+                if 'allocated' in stage else '')
+            for name, stage in self.stages.iteritems())
+
+
+class ProfileSummary(object):
+    """ Rolling stage timings over the last cycles """
+    def __init__(self, cycles=ROLLING_CYCLES):
+        """ Constructor
+
+        :type cycles: int
+        :param cycles: Number of cycles to keep
+        """
+        self.cycles = 0
+        self._stages = collections.defaultdict(
+            lambda: collections.deque(maxlen=cycles))
+        self._lock = threading.Lock()
+
+    def add(self, profile):
+        """ Add the timings of a finished cycle
+
+        :type profile: CycleProfile
+        :param profile: The cycle
+        """
+        with self._lock:
+            self.cycles += 1
+            for name, stage in profile.stages.iteritems():
+                self._stages[name].append(stage['wall'])
+
+    def add_sleep(self, seconds):
+        """ Add the time slept between two cycles
+
+        :type seconds: float
+        :param seconds: The time slept
+        """
+        with self._lock:
+            self._stages['sleep'].append(seconds)
+
+    def format(self):
+        """ Describe the wall time of each stage over the kept cycles
+
+        :returns: str
+        """
+        with self._lock:
+            stages = dict(
+                (name, sorted(walls))
+                for name, walls in self._stages.iteritems() if walls)
+
+        return '; '.join(
+            '{0}: avg {1:.3f}s, p95 {2:.3f}s, max {3:.3f}s'.format(
+                name, sum(walls) / len(walls),
+                walls[min(int(len(walls) * 0.95), len(walls) - 1)],
+                walls[-1])
+            for name, walls in sorted(stages.iteritems()))
+
+
+SUMMARY = ProfileSummary()
+
+
+def start_tracing():
+    """ Start tracing memory allocations, where tracemalloc is available.
+    Without it, stages only report the change in live objects.
+    """
+    if tracemalloc and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def write_report(directory, profile):
+    """ Append the report of a cycle to profile.jsonl in a directory, and
+    dump its cProfile stats next to it if they were captured
+
+    :type directory: str
+    :param directory: The directory to write to
+    :type profile: CycleProfile
+    :param profile: The finished cycle
+    """
+    directory = os.path.expanduser(directory)
+    try:
+        with open(os.path.join(directory, 'profile.jsonl'), 'a') as report:
+            report.write(json.dumps(profile.report()) + '\n')
+
+        if profile.profile:
+            profile.profile.dump_stats(os.path.join(
+                directory, '{0}-{1}-{2:03d}.prof'.format(
+                    # Accounts are named ACCOUNT/REGION
+                    profile.region.replace('/', '_'),
+                    time.strftime(
+                        '%Y%m%dT%H%M%S', time.gmtime(profile.started)),
+                    int(profile.started * 1000) % 1000)))
+    except (IOError, OSError) as error:
+        logger.warning('Could not write profile to {0}: {1}'.format(
+            directory, error))
@@ -5,213 +5,496 @@ Core logic to do a rebalance of instances based on their OS type, network
 location and instance type.
 """
 
-from copy import deepcopy
+import time
+from collections import namedtuple
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from boto.ec2.reservedinstance import ReservedInstancesConfiguration
-from dynamic_ec2reservation.aws.ec2 import EC2_CONNECTION as conn
-
-def get_reservation_pool():
+from dynamic_ec2reservation.classification import (
+    classify_description, classify_instance, get_image_platforms,
+    intern_key, is_windows, needs_image)
+from dynamic_ec2reservation.events import parse_time
+from dynamic_ec2reservation.executor import (
+    ModificationRequest, ModificationTracker, submit_modifications)
+from dynamic_ec2reservation.inventory import Inventory
+from dynamic_ec2reservation.log_handler import LOGGER as logger
+from dynamic_ec2reservation.normalization import (
+    SizeNormalizer, get_family_units)
+from dynamic_ec2reservation.placement import place_reservations
+from dynamic_ec2reservation.selection import ReservationIndex
+
+# DescribeInstances accepts at most 1000 results per call
+DESCRIBE_INSTANCES_PAGE_SIZE = 1000
+
+# DescribeInstances accepts at most 200 values per filter
+MAX_FILTER_VALUES = 200
+
+# The states of instances that are no longer running, or about to stop
+DEPARTED_STATES = ['shutting-down', 'terminated', 'stopping', 'stopped']
+
+# The only attributes of a running instance that rebalancing looks at
+RunningInstance = namedtuple(
+    'RunningInstance', ['platform', 'netloc', 'instance_type', 'az'])
+
+# A modification worked out from the changes of a group: the reservations
+# to modify and the list of ((os, netplatform, instancetype, az), count)
+# configurations they become
+PlannedModification = namedtuple(
+    'PlannedModification', ['group', 'reservation_ids', 'configurations'])
+
+def get_reservation_pool(instances):
     """ Get a pool of servers that are available to rebalance. Returns a dict in
     the form of:
 
-    {operating_sys: network_platform: instance_type: sum(instance_count per AZ)}
+    {(operating_sys, network_platform, instance_type): sum(instance_count per AZ)}
 
+    :type instances: dynamic_ec2reservation.inventory.Inventory
+    :param instances: The current reservations, from get_reserved_instances
     :returns: dict
     """
-    instances = get_reserved_instances()
-
-    pool = deepcopy(instances)
-    for platform in instances.keys():
-        for netloc in instances[platform].keys():
-            for instance_type in instances[platform][netloc].keys():
-                pool[platform][netloc][instance_type] = \
-                    sum(instances[platform][netloc][instance_type].values())
-
-    return pool
-
-def get_reserved_instances():
-    """ Get currently active reservations per AZ. Returns a dict in the form
-    of:
+    return instances.totals()
 
-    {operating_sys: network_platform: instance_type: az: count}
+def get_reserved_instance_key(ri):
+    """ Get the (operating_sys, network_platform, instance_type, az) key of a
+    reserved instance
 
-    :returns: dict
+    :type ri: boto.ec2.reservedinstance.ReservedInstance
+    :param ri: The reserved instance
+    :returns: tuple
     """
-    pool = {}
-
-    reserved_instances = conn.get_all_reserved_instances(
-        filters={'state':'active'})
-
-    for ri in reserved_instances:
-        netloc = 'EC2-Classic'
-        platform = 'linux'
-
-        if 'Amazon VPC' in ri.description:
-            netloc = 'EC2-VPC'
-
-        if 'Windows' in ri.description:
-            platform = 'windows'
-
-        if platform not in pool.keys():
-            pool[platform] = {}
-
-        if netloc not in pool[platform].keys():
-            pool[platform][netloc] = {}
+    platform, netloc = classify_description(ri.description)
+    return intern_key(
+        (platform, netloc, ri.instance_type, ri.availability_zone))
 
-        if ri.instance_type not in pool[platform][netloc].keys():
-            pool[platform][netloc][ri.instance_type] = {}
+def get_reserved_instances(snapshot):
+    """ Get currently active reservations per AZ. Returns an Inventory keyed
+    by (operating_sys, network_platform, instance_type, az).
 
-        if ri.availability_zone not in pool[platform][netloc][ri.instance_type].keys():
-            pool[platform][netloc][ri.instance_type][ri.availability_zone] = 0
+    :type snapshot: dynamic_ec2reservation.snapshot.InventorySnapshot
+    :param snapshot: The inventory snapshot for this cycle
+    :returns: dynamic_ec2reservation.inventory.Inventory
+    """
+    pool = Inventory()
 
-        pool[platform][netloc][ri.instance_type][ri.availability_zone] += ri.instance_count
+    for ri in snapshot.reserved_instances:
+        pool.add(get_reserved_instance_key(ri), ri.instance_count)
 
     return pool
 
-def get_running_instances():
-    """ Get currently running servers. Returns a dict in the form of:
-
-    {operating_sys: network_platform: instance_type: az: count}
-
-    :returns: dict
+def iter_running_instances(snapshot, page_size=DESCRIBE_INSTANCES_PAGE_SIZE,
+                           filters=None):
+    """ Page through the running instances, yielding a compact record for
+    each one. Only one page of boto Instance objects is held at a time.
+
+    :type snapshot: dynamic_ec2reservation.snapshot.InventorySnapshot
+    :param snapshot: The inventory snapshot for this cycle
+    :type page_size: int
+    :param page_size: Number of instances to request per DescribeInstances call
+    :type filters: dict
+    :param filters: Extra DescribeInstances filters, e.g. instance-type
+    :returns: generator of RunningInstance
     """
-    pool = {}
-
-    instances = conn.get_only_instances(filters={'instance-state-name':'running'})
-
-    for i in instances:
-        netloc = 'EC2-Classic'
-        platform = 'linux'
-
-        if i.vpc_id:
-            netloc = 'EC2-VPC'
-
-        if i.platform == 'windows':
-            platform = 'windows'
-
-        if not platform in pool.keys():
-            pool[platform] = {}
+    filters = dict(filters or {}, **{'instance-state-name': 'running'})
+    for _, key, _ in iter_instances(snapshot, filters, page_size):
+        yield key
+
+def iter_instances(snapshot, filters, page_size=DESCRIBE_INSTANCES_PAGE_SIZE):
+    """ Page through the instances matching some filters, whatever their
+    state, yielding their ID, compact record and launch time. Launch times
+    are left as EC2 writes them, which sort in time order, as parsing every
+    one of them would slow down a full scan several times over. The images
+    of the linux instances on a page are looked up before they are
+    classified.
+
+    :type snapshot: dynamic_ec2reservation.snapshot.InventorySnapshot
+    :param snapshot: The inventory snapshot for this cycle
+    :type filters: dict
+    :param filters: DescribeInstances filters
+    :type page_size: int
+    :param page_size: Number of instances to request per DescribeInstances call
+    :returns: generator of (instance id, RunningInstance, ISO 8601 time
+        the instance was last started)
+    """
+    next_token = None
+
+    while True:
+        with snapshot.api_call('DescribeInstances'):
+            page = snapshot.connection.get_all_reservations(
+                filters=filters,
+                max_results=page_size,
+                next_token=next_token)
+
+        image_platforms = get_image_platforms(snapshot, (
+            i.image_id for reservation in page for i in reservation.instances
+            if needs_image(i)))
+        for reservation in page:
+            for i in reservation.instances:
+                platform, netloc = classify_instance(
+                    i.platform, i.vpc_id, getattr(i, 'platformDetails', None),
+                    image_platforms.get(i.image_id))
+                yield i.id, intern_key(RunningInstance(
+                    platform, netloc, i.instance_type, i.placement)), \
+                    i.launch_time
+
+        next_token = page.next_token
+        if not next_token:
+            break
+
+def get_running_instances(snapshot, filters=None, shards=1,
+                          launched_since=None, launched=None):
+    """ Get currently running servers. Returns an Inventory keyed by
+    (operating_sys, network_platform, instance_type, az).
+
+    Instances are counted page by page as they are described, so memory use
+    does not grow with the size of the fleet. With more than one shard, the
+    instance types in the filters are split between shards that page
+    through their instances at the same time.
+
+    :type snapshot: dynamic_ec2reservation.snapshot.InventorySnapshot
+    :param snapshot: The inventory snapshot for this cycle
+    :type filters: dict
+    :param filters: Extra DescribeInstances filters, e.g. instance-type
+    :type shards: int
+    :param shards: Most DescribeInstances calls to page through at once
+    :type launched_since: float
+    :param launched_since: Unix time from which launched instances are
+        collected into launched
+    :type launched: dict
+    :param launched: If given, filled with instance id -> key of the
+        running instances launched since launched_since
+    :returns: dynamic_ec2reservation.inventory.Inventory
+    """
+    instance_types = (filters or {}).get('instance-type') or []
+    if not isinstance(instance_types, list):
+        instance_types = [instance_types]
+    shards = min(shards or 1, len(instance_types))
+    if shards <= 1:
+        pool = Inventory()
+        running = dict(filters or {}, **{'instance-state-name': 'running'})
+        if launched is not None:
+            launched_since = time.strftime(
+                '%Y-%m-%dT%H:%M:%S', time.gmtime(launched_since))
+        for instance_id, key, launch_time in iter_instances(
+                snapshot, running):
+            pool.add(key)
+            if launched is not None and launch_time >= launched_since:
+                launched[instance_id] = key
+
+        return pool
+
+    def count(shard):
+        """ Count the running instances of one shard """
+        # Each shard fills its own dict, they are merged afterwards
+        shard_launched = {} if launched is not None else None
+        return get_running_instances(
+            snapshot, dict(filters, **{'instance-type': shard}),
+            launched_since=launched_since,
+            launched=shard_launched), shard_launched
+
+    workers = ThreadPool(shards)
+    try:
+        counts = workers.map(
+            count, [instance_types[index::shards]
+                    for index in xrange(shards)], chunksize=1)
+    finally:
+        workers.close()
+        workers.join()
+
+    pool = Inventory()
+    for shard, shard_launched in counts:
+        for key, number in shard.iteritems():
+            pool.add(key, number)
+        if launched is not None:
+            launched.update(shard_launched)
 
-        if netloc not in pool[platform].keys():
-            pool[platform][netloc] = {}
+    return pool
 
-        if i.instance_type not in pool[platform][netloc].keys():
-            pool[platform][netloc][i.instance_type] = {}
+def get_instance_changes(snapshot, filters, since):
+    """ Get the instances launched, and the ones stopped or terminated,
+    since a point in time, for bringing running instance counts up to date
+    without describing every instance.
+
+    DescribeInstances only filters launch times by pattern, so every
+    instance launched on the days since then is returned, including ones
+    that were already counted. Stopped and terminated instances cannot be
+    filtered by when they stopped, so they are all returned, and EC2 only
+    lists terminated ones for about an hour after they terminate.
+
+    :type snapshot: dynamic_ec2reservation.snapshot.InventorySnapshot
+    :param snapshot: The inventory snapshot for this cycle
+    :type filters: dict
+    :param filters: Extra DescribeInstances filters, e.g. instance-type, as
+        used for counting the instances
+    :type since: float
+    :param since: Unix time of the last describe
+    :returns: tuple of (dict of instance id -> (RunningInstance, launch
+        time) of running instances launched, the same of the instances no
+        longer running, from get_departed_instances)
+    """
+    first = datetime.utcfromtimestamp(since).toordinal()
+    last = datetime.utcnow().toordinal()
+    launch_days = [
+        '{0}T*'.format(datetime.fromordinal(day).strftime('%Y-%m-%d'))
+        for day in xrange(first, last + 1)]
+
+    launched = dict(
+        (instance_id, (key, parse_time(launch_time)))
+        for instance_id, key, launch_time in iter_instances(
+            snapshot, dict(filters or {}, **{
+                'instance-state-name': 'running',
+                'launch-time': launch_days})))
+
+    return launched, get_departed_instances(snapshot, filters)
+
+def get_departed_instances(snapshot, filters):
+    """ Get the instances that are stopping, stopped or terminated
+
+    :type snapshot: dynamic_ec2reservation.snapshot.InventorySnapshot
+    :param snapshot: The inventory snapshot for this cycle
+    :type filters: dict
+    :param filters: Extra DescribeInstances filters, e.g. instance-type, as
+        used for counting the instances
+    :returns: dict of instance id -> (RunningInstance, launch time)
+    """
+    return dict(
+        (instance_id, (key, parse_time(launch_time)))
+        for instance_id, key, launch_time in iter_instances(
+            snapshot, dict(filters or {}, **{
+                'instance-state-name': DEPARTED_STATES})))
+
+def get_instance_filters(reserved, flexible=False):
+    """ Get DescribeInstances filters that leave out running instances no
+    reservation could cover, so they are not sent by EC2 at all. Instances
+    are limited to the reserved instance types, or with instance size
+    flexibility to every size of the reserved Linux/UNIX families, and to
+    Windows when only Windows platforms are reserved. EC2 has no filter for
+    Linux/UNIX or for being in a VPC, so those are still told apart
+    locally. With more instance types than a filter takes, every instance
+    type is described.
+
+    :type reserved: dynamic_ec2reservation.inventory.Inventory
+    :param reserved: The current reservations, from get_reserved_instances
+    :type flexible: bool
+    :param flexible: Whether instance size flexibility is enabled
+    :returns: dict, or None when there are no reservations and no instance
+        needs to be described
+    """
+    if not reserved:
+        return None
 
-        if not i.placement in pool[platform][netloc][i.instance_type].keys():
-            pool[platform][netloc][i.instance_type][i.placement] = 0
+    filters = {}
+    instance_types = set()
+    for platform, _, instance_type, _ in reserved:
+        family = get_family_units(instance_type)[0]
+        if flexible and platform == 'linux' and family != instance_type:
+            instance_types.add(family + '.*')
+        else:
+            instance_types.add(instance_type)
 
-        pool[platform][netloc][i.instance_type][i.placement] += 1
+    if len(instance_types) <= MAX_FILTER_VALUES:
+        filters['instance-type'] = sorted(instance_types)
 
-    return pool
+    if all(is_windows(key[0]) for key in reserved):
+        filters['platform'] = 'windows'
 
-def get_changes(reserved_pool, instances):
-    """ Builds a dictionary of what the reservations "should" be. Returns a
-    dict in the form of:
+    return filters
 
-    {operating_sys: network_platform: instance_type: az: count}
+def get_changes(reserved_pool, instances, reserved=None):
+    """ Builds an inventory of what the reservations "should" be, keyed by
+    (operating_sys, network_platform, instance_type, az).
 
     :type reserved_pool: dict
     :param reserved_pool: The pool of reserved instances by OS/network/type
-    :type instances: dict
+    :type instances: dynamic_ec2reservation.inventory.Inventory
     :param instances: The currently running instance count by AZ
-    :returns: dict
+    :type reserved: dynamic_ec2reservation.inventory.Inventory
+    :param reserved: The current reservations by AZ. Reservations that are
+        already in use are left in place, and unused ones stay where they are
+    :returns: dynamic_ec2reservation.inventory.Inventory
     """
-    result = deepcopy(instances)
+    result = Inventory()
+    current_groups = reserved.groups() if reserved is not None else {}
 
-    for platform in instances.keys():
-        if platform not in reserved_pool.keys():
-            del result[platform]
+    for group, azs in instances.groups().iteritems():
+        pool = reserved_pool.get(group, 0)
+        if not pool:
             continue
-        for netloc in instances[platform].keys():
-            if netloc not in reserved_pool[platform].keys():
-                del result[platform][netloc]
-                continue
 
-            for instance_type in instances[platform][netloc].keys():
-                if instance_type not in reserved_pool[platform][netloc].keys():
-                    del result[platform][netloc][instance_type]
-                    continue
+        placement = place_reservations(pool, azs, current_groups.get(group))
+        for az, count in placement.iteritems():
+            result[group + (az,)] = count
 
-                for az in instances[platform][netloc][instance_type].keys():
-                    if reserved_pool[platform][netloc][instance_type] == 0:
-                        del result[platform][netloc][instance_type][az]
-                        continue
+    return result
+
+def get_size_flexible_changes(reserved, instances):
+    """ Builds an inventory of what the reservations "should" be, letting
+    reservations cover running instances of any size in the same family.
+    Capacity is placed in normalized units and then split or merged back
+    into instance types. Returns a tuple of the changes and the group key to
+    diff and execute them with.
 
-                    reserve_count = min(
-                        reserved_pool[platform][netloc][instance_type],
-                        result[platform][netloc][instance_type][az])
+    :type reserved: dynamic_ec2reservation.inventory.Inventory
+    :param reserved: The current reservations by AZ
+    :type instances: dynamic_ec2reservation.inventory.Inventory
+    :param instances: The currently running instance count by AZ
+    :returns: tuple of (Inventory, callable)
+    """
+    normalizer = SizeNormalizer(reserved, instances)
+    normalized_reserved = normalizer.normalize(reserved)
 
-                    reserved_pool[platform][netloc][instance_type] -= reserve_count
-                    result[platform][netloc][instance_type][az] = reserve_count
+    changes = get_changes(
+        get_reservation_pool(normalized_reserved),
+        normalizer.normalize(instances),
+        normalized_reserved)
 
-    return result
+    return normalizer.denormalize(changes), normalizer.group_key
 
-def get_change_diff(current, new):
-    """ Takes two os:netplatform:instancetype:az dictionaries and returns only
-    keys where the descendents are different.
+def get_change_diff(current, new, group_key=None):
+    """ Takes two inventories and returns the entries of new for only the
+    groups whose counts are different. Groups are
+    (os, netplatform, instancetype) unless group_key says otherwise.
 
-    :type current: dict
+    :type current: dynamic_ec2reservation.inventory.Inventory
     :param current: The current list of instances.
-    :type new: dict
+    :type new: dynamic_ec2reservation.inventory.Inventory
     :param new: The new list of instances.
-    :returns: dict
+    :type group_key: callable
+    :param group_key: Maps a (os, netplatform, instancetype, az) key to the
+        group it is rebalanced in
+    :returns: dynamic_ec2reservation.inventory.Inventory
     """
-    result = deepcopy(new)
+    result = Inventory()
     if current == new:
-        return {}
+        return result
 
-    for platform in current.keys():
-        if current[platform] == new.get(platform):
-            del result[platform]
+    group_key = group_key or __instance_type_group
+    current_groups = current.partition(group_key)
+    for group, counts in new.partition(group_key).iteritems():
+        if current_groups.get(group) == counts:
             continue
 
-        for netloc in current[platform].keys():
-            if current[platform][netloc] == new[platform].get(netloc):
-                del result[platform][netloc]
-                continue
-
-            for instance_type in current[platform][netloc].keys():
-                if current[platform][netloc][instance_type] == \
-                        new[platform][netloc].get(instance_type):
-                    del result[platform][netloc][instance_type]
-                    continue
+        for key, count in counts.iteritems():
+            result[key] = count
 
     return result
 
-def execute_changes(changes):
-    """ Takes an EC2 connection and a list of changes to make, then converts
-    the list into operations on actual EC2 reservations. The calling user or
-    role must have the ec2:ModifyReservedInstances permission.
+def execute_changes(changes, snapshot, group_key=None, tracker=None,
+                    max_workers=1, budget=None):
+    """ Takes a list of changes to make and the snapshot they were computed
+    from, then converts the list into operations on actual EC2 reservations.
+    Each group of changes is one modification of the fewest reservations
+    that have to move, and groups are submitted in parallel. Groups with
+    reservations that are still being modified are skipped. The calling
+    user or role must have the ec2:ModifyReservedInstances permission.
 
-    :type changes: dict
+    :type changes: dynamic_ec2reservation.inventory.Inventory
     :param changes: The list of reservations to set.
-    :returns: dict
+    :type snapshot: dynamic_ec2reservation.snapshot.InventorySnapshot
+    :param snapshot: The inventory snapshot the changes were computed from
+    :type group_key: callable
+    :param group_key: Maps a (os, netplatform, instancetype, az) key to the
+        group it is rebalanced in, as given to get_change_diff
+    :type tracker: dynamic_ec2reservation.executor.ModificationTracker
+    :param tracker: Tracks modifications in flight across cycles
+    :type max_workers: int
+    :param max_workers: Maximum number of modifications to submit at once
+    :type budget: dynamic_ec2reservation.executor.ModificationBudget
+    :param budget: Limits the modifications submitted this cycle
+    :returns: list of modification ids, None for failed or deferred
+        submissions
+    """
+    tracker = tracker or ModificationTracker()
+    return submit_planned_modifications(
+        get_modifications(changes, snapshot, group_key, tracker),
+        snapshot, tracker, max_workers, budget)
+
+def get_modifications(changes, snapshot, group_key=None, tracker=None):
+    """ Work out the modifications that make a list of changes, without
+    submitting them. Groups with reservations that are still being modified
+    are skipped.
+
+    :type changes: dynamic_ec2reservation.inventory.Inventory
+    :param changes: The list of reservations to set.
+    :type snapshot: dynamic_ec2reservation.snapshot.InventorySnapshot
+    :param snapshot: The inventory snapshot the changes were computed from
+    :type group_key: callable
+    :param group_key: Maps a (os, netplatform, instancetype, az) key to the
+        group it is rebalanced in, as given to get_change_diff
+    :type tracker: dynamic_ec2reservation.executor.ModificationTracker
+    :param tracker: Tracks modifications in flight across cycles
+    :returns: list of PlannedModification
+    """
+    group_key = group_key or __instance_type_group
+    tracker = tracker or ModificationTracker()
+
+    index = ReservationIndex()
+    for ri in snapshot.reserved_instances:
+        key = get_reserved_instance_key(ri)
+        index.add(group_key(key), key, ri)
+
+    modifications = []
+    for group, counts in changes.partition(group_key).iteritems():
+        busy = tracker.busy_reservation_ids.intersection(
+            index.reservation_ids(group))
+        if busy:
+            logger.info(
+                'Skipping {0}: reservations still being modified: {1}'.format(
+                    '/'.join(group), ', '.join(sorted(busy))))
+            continue
+
+        reservation_ids, configurations = index.select(group, counts)
+        if not reservation_ids:
+            continue
+
+        modifications.append(PlannedModification(
+            group, reservation_ids, configurations))
+
+    return modifications
+
+def submit_planned_modifications(modifications, snapshot, tracker,
+                                 max_workers=1, budget=None):
+    """ Submit planned modifications to EC2, in order
+
+    :type modifications: list of PlannedModification
+    :param modifications: The modifications, from get_modifications
+    :type snapshot: dynamic_ec2reservation.snapshot.InventorySnapshot
+    :param snapshot: The inventory snapshot of the region
+    :type tracker: dynamic_ec2reservation.executor.ModificationTracker
+    :param tracker: Tracks modifications in flight across cycles
+    :type max_workers: int
+    :param max_workers: Maximum number of modifications to submit at once
+    :type budget: dynamic_ec2reservation.executor.ModificationBudget
+    :param budget: Limits the modifications submitted this cycle
+    :returns: list of modification ids, None for failed or deferred
+        submissions
     """
-    reserved_instances = conn.get_all_reserved_instances(
-        filters={'state':'active'})
-
-    for platform, reservations in changes.iteritems():
-        for netloc in reservations.keys():
-            for instance_type in reservations[netloc].keys():
-                reservation_ids = [r.id for r in reserved_instances \
-                        if platform in r.description.lower() and r.instance_type == instance_type]
-                reservedinstancesconfigurations = []
-                for az, count in reservations[netloc][instance_type].iteritems():
-                    reservedinstancesconfigurations.append(
-                        ReservedInstancesConfiguration(
-                            connection=conn,
-                            availability_zone=az,
-                            platform=netloc,
-                            instance_type=instance_type,
-                            instance_count=count
-                            ))
-                conn.modify_reserved_instances(
-                    "dynamic-reservation-{0}-{1}-{2}".format(
-                        netloc,
-                        instance_type,
-                        repr(datetime.utcnow())
-                        ),
-                    reservation_ids,
-                    reservedinstancesconfigurations
-                    )
+    conn = snapshot.connection
+    requests = []
+    for group, reservation_ids, configurations in modifications:
+        reservedinstancesconfigurations = []
+        for (_, netloc, instance_type, az), count in configurations:
+            reservedinstancesconfigurations.append(
+                ReservedInstancesConfiguration(
+                    connection=conn,
+                    availability_zone=az,
+                    platform=netloc,
+                    instance_type=instance_type,
+                    instance_count=count
+                    ))
+        requests.append(ModificationRequest(
+            group,
+            "dynamic-reservation-{0}-{1}-{2}".format(
+                group[1],
+                group[2],
+                repr(datetime.utcnow())
+                ),
+            reservation_ids,
+            reservedinstancesconfigurations
+            ))
+
+    return submit_modifications(
+        requests, snapshot, tracker, max_workers, budget)
+
+def __instance_type_group(key):
+    """ Group a key by (os, netplatform, instancetype) """
+    return key[:3]
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Check scheduler
+
+Decides how long to wait between rebalance cycles. The interval shrinks
+while reservations keep needing changes or the fleet is churning, grows
+again after a run of cycles that changed nothing, and is replaced by a
+jittered exponential backoff while cycles fail, e.g. because EC2 throttles
+the API calls. A region, or account region, that fails while others do
+not backs off on its own and is skipped until it is due again, so the
+healthy ones stay on the normal interval. Wake-ups are aligned to a per
+instance phase, so several daemons started with different --instance names
+spread their checks out instead of calling the API in the same second.
+"""
+import random
+import time
+import zlib
+
+from boto.exception import BotoServerError
+
+from dynamic_ec2reservation.log_handler import LOGGER as logger
+
+# Error codes EC2 uses when API calls are throttled
+THROTTLING_CODES = frozenset(
+    ['RequestLimitExceeded', 'Throttling', 'ThrottlingException'])
+
+# Number of cycles in a row without changes before the interval grows
+IDLE_CYCLES = 3
+
+# Fraction of the running instances that have to change between full scans
+# for the fleet to count as churning
+CHURN_THRESHOLD = 0.01
+
+# Backoff after the first failed cycle, in seconds. It doubles with every
+# failure in a row, up to the longest check interval.
+BACKOFF_BASE = 10
+
+
+def is_throttling_error(error):
+    """ Whether an exception means the API calls were throttled
+
+    :type error: Exception
+    :param error: The exception
+    :returns: bool
+    """
+    return isinstance(error, BotoServerError) and \
+        error.error_code in THROTTLING_CODES
+
+
+class Scheduler(object):
+    """ Adaptive check interval with backoff on errors """
+    def __init__(self, check_interval, min_interval=None, max_interval=None,
+                 instance='default'):
+        """ Constructor
+
+        :type check_interval: int
+        :param check_interval: The interval to start from, in seconds
+        :type min_interval: int
+        :param min_interval: Shortest interval. Defaults to a quarter of the
+            check interval, and is at least a second
+        :type max_interval: int
+        :param max_interval: Longest interval. Defaults to four times the
+            check interval, and is at least the shortest one
+        :type instance: str
+        :param instance: The name of this instance, which picks its phase
+        """
+        self.min_interval = max(min_interval or check_interval // 4, 1)
+        self.max_interval = max(
+            max_interval or check_interval * 4, self.min_interval)
+        self.interval = min(
+            max(check_interval, self.min_interval), self.max_interval)
+        self.idle_cycles = 0
+        self.failures = 0
+        # target name -> (failures in a row, time it is due again)
+        self.target_failures = {}
+        # Offset of this instance's wake-ups, as a fraction of the interval
+        self.phase = (zlib.crc32(instance) & 0xffffffff) / float(2 ** 32)
+
+    def record(self, changes=0, churn=0.0, errors=()):
+        """ Record the outcome of a cycle
+
+        :type changes: int
+        :param changes: Number of reservation changes the cycle found
+        :type churn: float
+        :param churn: Fraction of the running instances that changed since
+            the last cycle
+        :type errors: list of Exception
+        :param errors: The errors the cycle ran into
+        """
+        if errors:
+            self.failures += 1
+            if any(is_throttling_error(error) for error in errors):
+                logger.warning('EC2 API calls are being throttled')
+            return
+
+        self.failures = 0
+        if changes or churn >= CHURN_THRESHOLD:
+            self.idle_cycles = 0
+            self.interval = max(self.interval // 2, self.min_interval)
+            return
+
+        self.idle_cycles += 1
+        if self.idle_cycles >= IDLE_CYCLES:
+            self.idle_cycles = 0
+            self.interval = min(self.interval * 2, self.max_interval)
+
+    def record_target(self, name, error=None):
+        """ Record the outcome of a cycle in one region. A failed region is
+        not due again until its own backoff has passed.
+
+        :type name: str
+        :param name: The region, or ACCOUNT/REGION
+        :type error: Exception
+        :param error: The error the region ran into, if any
+        """
+        if not error:
+            self.target_failures.pop(name, None)
+            return
+
+        failures = self.target_failures.get(name, (0, 0))[0] + 1
+        self.target_failures[name] = (
+            failures, time.time() + self._get_backoff(failures))
+
+    def is_due(self, name):
+        """ Whether a region is due for a cycle, i.e. is not backing off
+
+        :type name: str
+        :param name: The region, or ACCOUNT/REGION
+        :returns: bool
+        """
+        return self.target_failures.get(name, (0, 0))[1] <= time.time()
+
+    def _get_backoff(self, failures):
+        """ Get a jittered backoff after some failures in a row
+
+        :returns: float, in seconds
+        """
+        backoff = min(BACKOFF_BASE * 2 ** (failures - 1), self.max_interval)
+        return random.uniform(backoff / 2.0, backoff)
+
+    def next_delay(self):
+        """ Seconds to wait before the next cycle. After failures this is a
+        jittered backoff, otherwise the time until the next wake-up of this
+        instance's phase.
+
+        :returns: float
+        """
+        if self.failures:
+            return self._get_backoff(self.failures)
+
+        now = time.time()
+        offset = self.phase * self.interval
+        return self.interval - (now - offset) % self.interval
+
+    def wait(self):
+        """ Sleep until the next cycle
+
+        :returns: float, the seconds slept
+        """
+        delay = self.next_delay()
+        if self.failures:
+            logger.info('Backing off {0:.0f} seconds after {1} failed '
+                        'cycles'.format(delay, self.failures))
+        else:
+            logger.debug('Sleeping {0:.0f} seconds until next check'.format(
+                delay))
+
+        time.sleep(delay)
+        return delay
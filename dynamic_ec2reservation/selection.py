@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Reservation selection
+
+Chooses which reserved instances a modification has to touch. Only the
+reservations in AZs that give up capacity are modified, and of those as few
+as possible, so the rest of the group is left alone.
+"""
+
+
+class ReservationIndex(object):
+    """ Active reservations indexed by group and then by
+    (platform, netloc, instance_type, az)
+    """
+    def __init__(self):
+        """ Constructor """
+        # group -> {key: [reserved instance, ...]}
+        self._groups = {}
+
+    def add(self, group, key, ri):
+        """ Add a reservation to the index
+
+        :type group: tuple
+        :param group: The group the reservation is rebalanced in
+        :type key: tuple
+        :param key: (platform, netloc, instance_type, az) of the reservation
+        :type ri: boto.ec2.reservedinstance.ReservedInstance
+        :param ri: The reservation
+        """
+        self._groups.setdefault(group, {}).setdefault(key, []).append(ri)
+
+    def reservation_ids(self, group):
+        """ Get the ids of all reservations in a group
+
+        :type group: tuple
+        :param group: The group
+        :returns: list of str
+        """
+        return [ri.id for ris in self._groups.get(group, {}).itervalues()
+                for ri in ris]
+
+    def counts(self, group):
+        """ Get the reserved instance count per key of a group
+
+        :type group: tuple
+        :param group: The group
+        :returns: dict of {(platform, netloc, instance_type, az): count}
+        """
+        return dict(
+            (key, sum(ri.instance_count for ri in ris))
+            for key, ris in self._groups.get(group, {}).iteritems())
+
+    def select(self, group, target):
+        """ Work out the smallest modification that moves a group from its
+        current reservations to the target counts. Returns the ids of the
+        reservations to modify and the target configurations for them, as a
+        list of ((platform, netloc, instance_type, az), count).
+
+        For every key with more reservations than it should have, the fewest
+        reservations that together hold the surplus are picked, largest
+        first, with the last pick being the smallest reservation that still
+        covers what is left. Whatever the picked reservations hold beyond
+        the surplus is configured back into their own key, and every key
+        that is short gets its shortfall.
+
+        :type group: tuple
+        :param group: The group
+        :type target: dict
+        :param target: Target counts keyed by
+            (platform, netloc, instance_type, az)
+        :returns: tuple of (list of str, list of tuples)
+        """
+        reservations = self._groups.get(group, {})
+        current = self.counts(group)
+
+        selected = []
+        configurations = []
+        for key in sorted(current):
+            surplus = current[key] - target.get(key, 0)
+            if surplus <= 0:
+                continue
+
+            picked = _cover(reservations[key], surplus)
+            selected.extend(ri.id for ri in picked)
+
+            kept = sum(ri.instance_count for ri in picked) - surplus
+            if kept:
+                configurations.append((key, kept))
+
+        for key in sorted(target):
+            shortfall = target[key] - current.get(key, 0)
+            if shortfall > 0:
+                configurations.append((key, shortfall))
+
+        return selected, configurations
+
+
+def _cover(reservations, count):
+    """ Pick the fewest reservations whose instance counts add up to at
+    least count, preferring the least left over
+
+    :type reservations: list
+    :param reservations: Reservations to pick from
+    :type count: int
+    :param count: Instance count to cover
+    :returns: list of reservations
+    """
+    candidates = sorted(reservations, key=lambda ri: (-ri.instance_count, ri.id))
+
+    picked = []
+    remaining = count
+    while remaining > 0:
+        # The smallest reservation that covers the rest on its own
+        covering = [ri for ri in candidates if ri.instance_count >= remaining]
+        if covering:
+            picked.append(covering[-1])
+            break
+
+        picked.append(candidates.pop(0))
+        remaining -= picked[-1].instance_count
+
+    return picked
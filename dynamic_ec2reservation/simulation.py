@@ -0,0 +1,516 @@
+# -*- coding: utf-8 -*-
+"""
+Offline simulation of an EC2 account
+
+A local stand-in for the boto EC2 connection, holding a fleet of running
+instances and reserved instances loaded from a JSON/CSV fixture or generated
+synthetically. Running instances are stored as counts per
+(platform, netloc, instance_type, az) and only materialised one
+DescribeInstances page at a time, so very large fleets can be simulated.
+"""
+import bisect
+import csv
+import fnmatch
+import json
+import os.path
+import random
+import threading
+from datetime import datetime
+
+from dynamic_ec2reservation.classification import (
+    DESCRIPTIONS, get_description, is_windows)
+from dynamic_ec2reservation.normalization import get_family_units
+
+DEFAULT_INSTANCE_TYPES = ['t2.micro', 't2.medium', 'm4.large', 'm4.xlarge',
+                          'c4.large', 'c4.2xlarge', 'r3.large', 'r3.xlarge']
+DEFAULT_AZS = ['us-east-1a', 'us-east-1b', 'us-east-1c', 'us-east-1d']
+DEFAULT_PLATFORMS = ['linux', 'windows']
+
+
+class SimulatedReservedInstance(object):
+    """ The attributes of boto.ec2.reservedinstance.ReservedInstance that
+    rebalancing uses
+    """
+    __slots__ = ('id', 'instance_type', 'availability_zone',
+                 'instance_count', 'description', 'state')
+
+    def __init__(self, id, instance_type, availability_zone, instance_count,
+                 description, state='active'):
+        self.id = id
+        self.instance_type = instance_type
+        self.availability_zone = availability_zone
+        self.instance_count = instance_count
+        self.description = description
+        self.state = state
+
+    def __repr__(self):
+        return 'ReservedInstance:{0}'.format(self.id)
+
+
+class SimulatedInstance(object):
+    """ The attributes of boto.ec2.instance.Instance that rebalancing uses """
+    __slots__ = ('id', 'instance_type', 'placement', 'vpc_id', 'platform',
+                 'platformDetails')
+
+    # The simulated fleet is running from before any cycle
+    launch_time = '2000-01-01T00:00:00.000Z'
+    # Simulated instances report their platform details, so their images are
+    # never looked up
+    image_id = None
+
+    def __init__(self, id, instance_type, placement, vpc_id, platform,
+                 platform_details=None):
+        self.id = id
+        self.instance_type = instance_type
+        self.placement = placement
+        self.vpc_id = vpc_id
+        self.platform = platform
+        self.platformDetails = platform_details
+
+
+class SimulatedReservation(object):
+    """ A DescribeInstances reservation holding a page of instances """
+    __slots__ = ('instances',)
+
+    def __init__(self, instances):
+        self.instances = instances
+
+
+class SimulatedReservedInstancesModification(object):
+    """ The attributes of
+    boto.ec2.reservedinstance.ReservedInstancesModification that
+    rebalancing uses
+    """
+    def __init__(self, modification_id, reserved_instances, status,
+                 client_token):
+        self.modification_id = modification_id
+        self.reserved_instances = reserved_instances
+        self.status = status
+        self.status_message = None
+        self.client_token = client_token
+        self.target_configurations = []
+        self.create_date = datetime.utcnow()
+        self.update_date = self.create_date
+
+
+class SimulatedRegion(object):
+    """ The attributes of boto.ec2.regioninfo.RegionInfo that are used """
+    def __init__(self, name):
+        self.name = name
+
+
+class ResultSet(list):
+    """ A page of results with the token for the next page """
+    next_token = None
+
+
+class SimulatedEC2Connection(object):
+    """ Stands in for boto.ec2.connection.EC2Connection in one region
+
+    Modifications are fulfilled once the fulfilment delay has passed: the
+    source reservations are retired and new active reservations are created
+    from the target configurations. Every call is counted per EC2 API
+    action.
+    """
+    def __init__(self, region, running=None, reserved=None,
+                 fulfilment_delay=0):
+        """ Constructor
+
+        :type region: str
+        :param region: The region name this connection pretends to be in
+        :type running: dict
+        :param running: Running instance counts keyed by
+            (platform, netloc, instance_type, az)
+        :type reserved: list
+        :param reserved: SimulatedReservedInstance objects
+        :type fulfilment_delay: float
+        :param fulfilment_delay: Seconds a modification stays processing
+        """
+        self.region = SimulatedRegion(region)
+        self.fulfilment_delay = fulfilment_delay
+        self.reserved_instances = list(reserved or [])
+        self.modifications = []
+        self.api_calls = {}
+        self._lock = threading.Lock()
+        self._ri_ids = len(self.reserved_instances)
+        self.set_running(running or {})
+
+    def set_running(self, running):
+        """ Replace the running instance counts
+
+        :type running: dict
+        :param running: Running instance counts keyed by
+            (platform, netloc, instance_type, az)
+        """
+        self._running_keys = sorted(key for key in running if running[key])
+        self._running_offsets = []
+        total = 0
+        for key in self._running_keys:
+            self._running_offsets.append(total)
+            total += running[key]
+        self._running_counts = dict(
+            (key, running[key]) for key in self._running_keys)
+        self.running_count = total
+
+    def _record(self, action):
+        """ Count a call to an API action """
+        with self._lock:
+            self.api_calls[action] = self.api_calls.get(action, 0) + 1
+
+    @property
+    def api_call_count(self):
+        """ Total number of API calls made on this connection
+
+        :returns: int
+        """
+        return sum(self.api_calls.values())
+
+    def get_all_regions(self, region_names=None, filters=None, dry_run=False):
+        self._record('DescribeRegions')
+        return [self.region]
+
+    def get_all_reserved_instances(self, reserved_instances_id=None,
+                                   filters=None, dry_run=False):
+        self._record('DescribeReservedInstances')
+        with self._lock:
+            self._fulfil_due()
+
+        states = (filters or {}).get('state')
+        if states and not isinstance(states, list):
+            states = [states]
+
+        result = ResultSet(
+            ri for ri in self.reserved_instances
+            if (not states or ri.state in states) and
+            (not reserved_instances_id or ri.id in reserved_instances_id))
+        return result
+
+    def get_all_reservations(self, instance_ids=None, filters=None,
+                             dry_run=False, max_results=None, next_token=None):
+        self._record('DescribeInstances')
+        filters = filters or {}
+        if filters.get('instance-state-name') not in \
+                (None, 'running', ['running']):
+            return ResultSet()
+
+        launch_times = filters.get('launch-time')
+        if launch_times:
+            if not isinstance(launch_times, list):
+                launch_times = [launch_times]
+            if not any(fnmatch.fnmatchcase(SimulatedInstance.launch_time,
+                                           launch_time)
+                       for launch_time in launch_times):
+                return ResultSet()
+
+        instance_ids = instance_ids or filters.get('instance-id')
+        if instance_ids:
+            return ResultSet([SimulatedReservation(
+                [self._get_instance(int(instance_id[2:], 16))
+                 for instance_id in instance_ids
+                 if 0 <= int(instance_id[2:], 16) < self.running_count])])
+
+        keys = self._running_keys
+        instance_types = filters.get('instance-type')
+        if instance_types:
+            if not isinstance(instance_types, list):
+                instance_types = [instance_types]
+            keys = [key for key in keys
+                    if any(fnmatch.fnmatchcase(key[2], instance_type)
+                           for instance_type in instance_types)]
+
+        platforms = filters.get('platform')
+        if platforms:
+            if not isinstance(platforms, list):
+                platforms = [platforms]
+            keys = [key for key in keys
+                    if ('windows' if is_windows(key[0]) else 'linux')
+                    in platforms]
+
+        # The matching instances are numbered consecutively for paging
+        start = int(next_token or 0)
+        size = max_results or 1000
+        instances = []
+        skipped = 0
+        for key in keys:
+            count = self._running_counts[key]
+            if skipped + count > start and len(instances) < size:
+                first = max(start - skipped, 0)
+                offset = self._running_offsets[
+                    bisect.bisect_left(self._running_keys, key)]
+                for index in xrange(
+                        first, min(count, first + size - len(instances))):
+                    instances.append(self._make_instance(key, offset + index))
+            skipped += count
+
+        result = ResultSet([SimulatedReservation(instances)])
+        if start + len(instances) < skipped:
+            result.next_token = str(start + len(instances))
+
+        return result
+
+    def _get_instance(self, offset):
+        """ Build the running instance at an offset """
+        position = bisect.bisect_right(self._running_offsets, offset) - 1
+        return self._make_instance(self._running_keys[position], offset)
+
+    @staticmethod
+    def _make_instance(key, offset):
+        """ Build a running instance, with its id derived from its offset """
+        platform, netloc, instance_type, az = key
+        return SimulatedInstance(
+            'i-{0:08x}'.format(offset),
+            instance_type,
+            az,
+            'vpc-00000001' if netloc == 'EC2-VPC' else None,
+            'windows' if is_windows(platform) else None,
+            DESCRIPTIONS.get(platform))
+
+    def get_only_instances(self, instance_ids=None, filters=None,
+                           dry_run=False, max_results=None):
+        instances = []
+        next_token = None
+        while True:
+            page = self.get_all_reservations(
+                instance_ids=instance_ids, filters=filters,
+                max_results=max_results, next_token=next_token)
+            for reservation in page:
+                instances.extend(reservation.instances)
+            next_token = page.next_token
+            if not next_token:
+                return instances
+
+    def modify_reserved_instances(self, client_token, reserved_instance_ids,
+                                  target_configurations):
+        self._record('ModifyReservedInstances')
+        with self._lock:
+            sources = [ri for ri in self.reserved_instances
+                       if ri.id in reserved_instance_ids and
+                       ri.state == 'active']
+            if len(sources) != len(set(reserved_instance_ids)):
+                raise ValueError(
+                    'Reserved instances are not all active: {0}'.format(
+                        ', '.join(reserved_instance_ids)))
+
+            modifying = set(
+                ri.id for m in self.modifications if m.status == 'processing'
+                for ri in m.reserved_instances)
+            if modifying.intersection(reserved_instance_ids):
+                raise ValueError(
+                    'Reserved instances are already being modified: '
+                    '{0}'.format(', '.join(
+                        sorted(modifying.intersection(reserved_instance_ids)))))
+
+            if _footprint(sources) != _footprint(target_configurations):
+                raise ValueError(
+                    'Target configurations do not match the normalized '
+                    'footprint of the reserved instances')
+
+            modification = SimulatedReservedInstancesModification(
+                'rimod-sim-{0:08x}'.format(len(self.modifications) + 1),
+                sources, 'processing', client_token)
+            modification.target_configurations = list(target_configurations)
+            self.modifications.append(modification)
+            self._fulfil_due()
+
+        return modification.modification_id
+
+    def _fulfil_due(self):
+        """ Fulfil the modifications that have been processing for longer
+        than the fulfilment delay. Must be called with the lock held.
+        """
+        now = datetime.utcnow()
+        for modification in self.modifications:
+            if modification.status != 'processing' or \
+                    (now - modification.create_date).total_seconds() < \
+                    self.fulfilment_delay:
+                continue
+
+            description = modification.reserved_instances[0].description
+            for ri in modification.reserved_instances:
+                ri.state = 'retired'
+
+            for configuration in modification.target_configurations:
+                self._ri_ids += 1
+                self.reserved_instances.append(SimulatedReservedInstance(
+                    'ri-sim-{0:08x}'.format(self._ri_ids),
+                    configuration.instance_type,
+                    configuration.availability_zone,
+                    configuration.instance_count,
+                    description))
+
+            modification.status = 'fulfilled'
+            modification.update_date = now
+
+    def describe_reserved_instances_modifications(
+            self, reserved_instances_modification_ids=None, next_token=None,
+            filters=None):
+        self._record('DescribeReservedInstancesModifications')
+        with self._lock:
+            self._fulfil_due()
+
+        statuses = (filters or {}).get('status')
+        if statuses and not isinstance(statuses, list):
+            statuses = [statuses]
+
+        return ResultSet(
+            m for m in self.modifications
+            if (not statuses or m.status in statuses) and
+            (not reserved_instances_modification_ids or
+             m.modification_id in reserved_instances_modification_ids))
+
+
+def _footprint(reservations):
+    """ Sum the normalized units of reservations or target configurations
+    per instance family
+    """
+    footprint = {}
+    for reservation in reservations:
+        family, units = get_family_units(reservation.instance_type)
+        footprint[family] = footprint.get(family, 0) + \
+            units * reservation.instance_count
+
+    return footprint
+
+
+class SimulatedConnectionFactory(object):
+    """ Hands out one simulated connection per region, each built from the
+    same fleet description
+    """
+    def __init__(self, running, reserved, fulfilment_delay=0):
+        """ Constructor
+
+        :type running: dict
+        :param running: Running instance counts keyed by
+            (platform, netloc, instance_type, az)
+        :type reserved: list
+        :param reserved: Tuples of
+            (platform, netloc, instance_type, az, instance_count)
+        :type fulfilment_delay: float
+        :param fulfilment_delay: Seconds a modification stays processing
+        """
+        self.running = running
+        self.reserved = reserved
+        self.fulfilment_delay = fulfilment_delay
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, region):
+        with self._lock:
+            if region not in self._connections:
+                self._connections[region] = SimulatedEC2Connection(
+                    region, self.running, [
+                        SimulatedReservedInstance(
+                            'ri-sim-{0:08x}'.format(index),
+                            instance_type,
+                            az,
+                            count,
+                            get_description(platform, netloc))
+                        for index, (platform, netloc, instance_type, az, count)
+                        in enumerate(self.reserved)],
+                    self.fulfilment_delay)
+
+            return self._connections[region]
+
+
+def load_fixture(path):
+    """ Load a fleet from a fixture file. JSON fixtures look like::
+
+        {"running": [{"platform": "linux", "netloc": "EC2-VPC",
+                      "instance_type": "m4.large",
+                      "availability_zone": "us-east-1a", "count": 3}],
+         "reserved": [... same fields ...]}
+
+    CSV fixtures have a header row of kind followed by the same fields,
+    where kind is either running or reserved.
+
+    :type path: str
+    :param path: Path to a .json or .csv fixture
+    :returns: SimulatedConnectionFactory
+    """
+    path = os.path.expanduser(path)
+    entries = {'running': [], 'reserved': []}
+
+    with open(path) as fixture:
+        if path.lower().endswith('.csv'):
+            for row in csv.DictReader(fixture):
+                entries[row['kind'].strip()].append(row)
+        else:
+            data = json.load(fixture)
+            for kind in entries:
+                entries[kind] = data.get(kind, [])
+
+    running = {}
+    for entry in entries['running']:
+        key = (entry['platform'], entry['netloc'], entry['instance_type'],
+               entry['availability_zone'])
+        running[key] = running.get(key, 0) + int(entry['count'])
+
+    reserved = [
+        (entry['platform'], entry['netloc'], entry['instance_type'],
+         entry['availability_zone'], int(entry['count']))
+        for entry in entries['reserved']]
+
+    return SimulatedConnectionFactory(running, reserved)
+
+
+def generate_fleet(instance_count, reservation_count,
+                   instance_types=None, azs=None, platforms=None,
+                   coverage=0.7, seed=0):
+    """ Generate a synthetic fleet. Running instances are spread at random
+    over the platforms, VPC, instance types and AZs. Reservations cover
+    roughly the coverage fraction of each group, but are placed in random
+    AZs so that there is rebalancing to do.
+
+    :type instance_count: int
+    :param instance_count: Number of running instances
+    :type reservation_count: int
+    :param reservation_count: Number of reserved instance records
+    :type instance_types: list
+    :param instance_types: Instance types to use
+    :type azs: list
+    :param azs: Availability zones to use
+    :type platforms: list
+    :param platforms: Platforms to use, e.g. linux, windows or rhel
+    :type coverage: float
+    :param coverage: Fraction of running instances to reserve
+    :type seed: int
+    :param seed: Random seed, so fleets are reproducible
+    :returns: SimulatedConnectionFactory
+    """
+    rand = random.Random(seed)
+    instance_types = instance_types or DEFAULT_INSTANCE_TYPES
+    azs = azs or DEFAULT_AZS
+    platforms = platforms or DEFAULT_PLATFORMS
+
+    keys = [(platform, 'EC2-VPC', instance_type, az)
+            for platform in platforms
+            for instance_type in instance_types
+            for az in azs]
+    weights = [rand.random() for _ in keys]
+    total_weight = sum(weights)
+
+    running = {}
+    assigned = 0
+    for key, weight in zip(keys, weights):
+        count = int(instance_count * weight / total_weight)
+        running[key] = count
+        assigned += count
+    for _ in range(instance_count - assigned):
+        key = rand.choice(keys)
+        running[key] += 1
+
+    groups = {}
+    for key, count in running.items():
+        groups[key[:3]] = groups.get(key[:3], 0) + count
+    group_keys = sorted(groups)
+
+    reserved = []
+    if reservation_count:
+        per_reservation = max(
+            1, int(instance_count * coverage / reservation_count))
+        for _ in range(reservation_count):
+            platform, netloc, instance_type = rand.choice(group_keys)
+            reserved.append((platform, netloc, instance_type,
+                             rand.choice(azs), per_reservation))
+
+    return SimulatedConnectionFactory(running, reserved)
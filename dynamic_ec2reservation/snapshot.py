@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Per-cycle snapshot of the EC2 reservation inventory
+"""
+import threading
+from contextlib import contextmanager
+
+
+class InventorySnapshot(object):
+    """ A point-in-time view of the reserved instances in a region
+
+    The active reservations are fetched from EC2 once and then shared by
+    every step of a rebalance cycle, so the pool, the diff and the executed
+    changes are all based on the same data. Every EC2 API call made on
+    behalf of the cycle is counted per action, and can be limited to a
+    number of calls in flight at once when the cycle overlaps them.
+    """
+    def __init__(self, connection, max_concurrent_requests=None):
+        """ Constructor
+
+        :type connection: boto.ec2.connection.EC2Connection
+        :param connection: The EC2 connection to use for this cycle
+        :type max_concurrent_requests: int
+        :param max_concurrent_requests: Most API calls in flight at once, or
+            None for no limit
+        """
+        self.connection = connection
+        self.max_concurrent_requests = max_concurrent_requests
+        self.api_calls = {}
+        self._api_calls_lock = threading.Lock()
+        self._requests = None
+        if max_concurrent_requests:
+            self._requests = threading.BoundedSemaphore(
+                max_concurrent_requests)
+        self._reserved_instances = None
+
+    def record_api_call(self, action):
+        """ Count an EC2 API call made during this cycle
+
+        :type action: str
+        :param action: The EC2 API action name, e.g. DescribeInstances
+        """
+        with self._api_calls_lock:
+            self.api_calls[action] = self.api_calls.get(action, 0) + 1
+
+    @contextmanager
+    def api_call(self, action):
+        """ Count an EC2 API call and hold one of the request slots while
+        it is made, e.g.:
+
+            with snapshot.api_call('DescribeInstances'):
+                page = snapshot.connection.get_all_reservations()
+
+        :type action: str
+        :param action: The EC2 API action name, e.g. DescribeInstances
+        """
+        self.record_api_call(action)
+        if self._requests is None:
+            yield
+            return
+
+        with self._requests:
+            yield
+
+    @property
+    def api_call_count(self):
+        """ Total number of EC2 API calls made during this cycle
+
+        :returns: int
+        """
+        return sum(self.api_calls.values())
+
+    @property
+    def reserved_instances(self):
+        """ The active reserved instances, fetched on first access
+
+        :returns: list of boto.ec2.reservedinstance.ReservedInstance
+        """
+        if self._reserved_instances is None:
+            with self.api_call('DescribeReservedInstances'):
+                self._reserved_instances = \
+                    self.connection.get_all_reserved_instances(
+                        filters={'state': 'active'})
+
+        return self._reserved_instances
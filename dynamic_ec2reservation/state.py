@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent state
+
+A small SQLite database that keeps what a Dynamic EC2 Reservation instance
+knows between runs: the running instance counts of the last scan in each
+region, with the instances the counts track by id, the modifications still
+in flight and when each group was last changed. A restarted daemon picks up
+from there instead of starting cold, and a --run-once invocation follows up
+on what the previous one submitted and only describes the instances
+launched and stopped since.
+"""
+import json
+import os.path
+import sqlite3
+import threading
+
+from dynamic_ec2reservation.inventory import Inventory
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS inventory (
+    region TEXT NOT NULL,
+    platform TEXT NOT NULL,
+    netloc TEXT NOT NULL,
+    instance_type TEXT NOT NULL,
+    az TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (region, platform, netloc, instance_type, az)
+);
+CREATE TABLE IF NOT EXISTS scans (
+    region TEXT PRIMARY KEY,
+    scanned_at REAL NOT NULL,
+    incremental_cycles INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS deltas (
+    region TEXT PRIMARY KEY,
+    updated_at REAL NOT NULL,
+    filters TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tracked_instances (
+    region TEXT NOT NULL,
+    instance_id TEXT NOT NULL,
+    platform TEXT NOT NULL,
+    netloc TEXT NOT NULL,
+    instance_type TEXT NOT NULL,
+    az TEXT NOT NULL,
+    counted INTEGER NOT NULL,
+    PRIMARY KEY (region, instance_id)
+);
+CREATE TABLE IF NOT EXISTS modifications (
+    modification_id TEXT PRIMARY KEY,
+    region TEXT NOT NULL,
+    instance_group TEXT NOT NULL,
+    reservation_ids TEXT NOT NULL,
+    submitted_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS changes (
+    region TEXT NOT NULL,
+    instance_group TEXT NOT NULL,
+    changed_at REAL NOT NULL,
+    PRIMARY KEY (region, instance_group)
+);
+CREATE TABLE IF NOT EXISTS series (
+    series_id INTEGER PRIMARY KEY,
+    region TEXT NOT NULL,
+    platform TEXT NOT NULL,
+    netloc TEXT NOT NULL,
+    instance_type TEXT NOT NULL,
+    az TEXT NOT NULL,
+    UNIQUE (region, platform, netloc, instance_type, az)
+);
+CREATE TABLE IF NOT EXISTS samples (
+    series_id INTEGER NOT NULL,
+    hour INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (series_id, hour)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sample_hours (
+    region TEXT NOT NULL,
+    hour INTEGER NOT NULL,
+    PRIMARY KEY (region, hour)
+) WITHOUT ROWID;
+"""
+
+# Hours of running instance samples to keep, a little over a year
+SAMPLE_RETENTION_HOURS = 400 * 24
+
+
+def get_state_path(pid_file_dir, instance):
+    """ Get the path of the state database of an instance, next to its pid
+    file
+
+    :type pid_file_dir: str
+    :param pid_file_dir: The directory of the pid file
+    :type instance: str
+    :param instance: The name of the Dynamic EC2 Reservation instance
+    :returns: str
+    """
+    return os.path.join(
+        os.path.expanduser(pid_file_dir),
+        'dynamic-ec2reservation.{0}.db'.format(instance))
+
+
+class StateStore(object):
+    """ The state of one Dynamic EC2 Reservation instance on disk """
+    def __init__(self, path):
+        """ Constructor
+
+        :type path: str
+        :param path: The SQLite database file, created if missing
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.executescript(SCHEMA)
+        # (region, platform, netloc, instance_type, az) -> series id
+        self._series = {}
+
+    def close(self):
+        """ Close the database """
+        with self._lock:
+            self._connection.close()
+
+    def save_inventory(self, region, running, scanned_at, incremental_cycles,
+                       tracked=None):
+        """ Replace the running instance counts of a region
+
+        :type region: str
+        :param region: The AWS region
+        :type running: dynamic_ec2reservation.inventory.Inventory
+        :param running: The running instance counts
+        :type scanned_at: float
+        :param scanned_at: Timestamp of the last full scan
+        :type incremental_cycles: int
+        :param incremental_cycles: Incremental cycles since the full scan
+        :type tracked: tuple
+        :param tracked: (updated_at, filters, instances) the counts can be
+            brought up to date from, as from InventoryStore.get_tracked, or
+            None
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                'DELETE FROM inventory WHERE region = ?', (region,))
+            self._connection.executemany(
+                'INSERT INTO inventory VALUES (?, ?, ?, ?, ?, ?)',
+                ((region,) + key + (count,)
+                 for key, count in running.iteritems()))
+            self._connection.execute(
+                'INSERT OR REPLACE INTO scans VALUES (?, ?, ?)',
+                (region, scanned_at, incremental_cycles))
+            self._connection.execute(
+                'DELETE FROM deltas WHERE region = ?', (region,))
+            self._connection.execute(
+                'DELETE FROM tracked_instances WHERE region = ?', (region,))
+            if tracked is not None:
+                updated_at, filters, instances = tracked
+                self._connection.execute(
+                    'INSERT INTO deltas VALUES (?, ?, ?)',
+                    (region, updated_at, json.dumps(filters)))
+                self._connection.executemany(
+                    'INSERT INTO tracked_instances '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    ((region, instance_id) + key + (int(counted),)
+                     for instance_id, (key, counted) in instances.iteritems()))
+
+    def load_inventory(self, region):
+        """ Get the running instance counts saved for a region
+
+        :type region: str
+        :param region: The AWS region
+        :returns: tuple of (Inventory, scanned_at, incremental_cycles,
+            tracked), where tracked is (updated_at, filters, instances) or
+            None, or None if nothing was saved
+        """
+        with self._lock:
+            scan = self._connection.execute(
+                'SELECT scanned_at, incremental_cycles FROM scans '
+                'WHERE region = ?', (region,)).fetchone()
+            if scan is None:
+                return None
+
+            running = Inventory()
+            for row in self._connection.execute(
+                    'SELECT platform, netloc, instance_type, az, count '
+                    'FROM inventory WHERE region = ?', (region,)):
+                running[tuple(row[:4])] = row[4]
+
+            tracked = None
+            delta = self._connection.execute(
+                'SELECT updated_at, filters FROM deltas WHERE region = ?',
+                (region,)).fetchone()
+            if delta is not None:
+                tracked = (delta[0], json.loads(delta[1]), dict(
+                    (row[0], (tuple(row[1:5]), bool(row[5])))
+                    for row in self._connection.execute(
+                        'SELECT instance_id, platform, netloc, '
+                        'instance_type, az, counted FROM tracked_instances '
+                        'WHERE region = ?', (region,))))
+
+        return running, scan[0], scan[1], tracked
+
+    def save_modifications(self, region, in_flight):
+        """ Replace the modifications in flight in a region
+
+        :type region: str
+        :param region: The AWS region
+        :type in_flight: dict
+        :param in_flight: modification id -> (group, reservation ids,
+            submitted timestamp), as kept by the ModificationTracker
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                'DELETE FROM modifications WHERE region = ?', (region,))
+            self._connection.executemany(
+                'INSERT INTO modifications VALUES (?, ?, ?, ?, ?)',
+                ((modification_id, region, json.dumps(group),
+                  json.dumps(reservation_ids), submitted)
+                 for modification_id, (group, reservation_ids, submitted)
+                 in in_flight.iteritems()))
+
+    def load_modifications(self, region):
+        """ Get the modifications saved as in flight in a region
+
+        :type region: str
+        :param region: The AWS region
+        :returns: dict of modification id -> (group, reservation ids,
+            submitted timestamp)
+        """
+        with self._lock:
+            return dict(
+                (modification_id, (
+                    tuple(json.loads(group)), json.loads(reservation_ids),
+                    submitted))
+                for modification_id, group, reservation_ids, submitted
+                in self._connection.execute(
+                    'SELECT modification_id, instance_group, '
+                    'reservation_ids, submitted_at FROM modifications '
+                    'WHERE region = ?', (region,)))
+
+    def record_changes(self, region, groups, changed_at):
+        """ Record when groups were last changed
+
+        :type region: str
+        :param region: The AWS region
+        :type groups: list of tuple
+        :param groups: The groups that were changed
+        :type changed_at: float
+        :param changed_at: Timestamp of the change
+        """
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO changes VALUES (?, ?, ?)',
+                ((region, json.dumps(group), changed_at)
+                 for group in groups))
+
+    def load_changes(self, region):
+        """ Get when each group of a region was last changed
+
+        :type region: str
+        :param region: The AWS region
+        :returns: dict of group -> timestamp
+        """
+        with self._lock:
+            return dict(
+                (tuple(json.loads(group)), changed_at)
+                for group, changed_at in self._connection.execute(
+                    'SELECT instance_group, changed_at FROM changes '
+                    'WHERE region = ?', (region,)))
+
+    def record_sample(self, region, running, sampled_at):
+        """ Record the running instance counts of a region in the hourly
+        time series. Samples taken in the same hour keep the highest count
+        of each key, and keys that are not running are not stored at all.
+
+        :type region: str
+        :param region: The AWS region
+        :type running: dynamic_ec2reservation.inventory.Inventory
+        :param running: The running instance counts
+        :type sampled_at: float
+        :param sampled_at: Timestamp of the counts
+        """
+        hour = int(sampled_at // 3600)
+        with self._lock, self._connection:
+            samples = [
+                (self._get_series_id(region, key), count)
+                for key, count in running.iteritems() if count > 0]
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO samples VALUES (?, ?, 0)',
+                ((series_id, hour) for series_id, _ in samples))
+            self._connection.executemany(
+                'UPDATE samples SET count = MAX(count, ?) '
+                'WHERE hour = ? AND series_id = ?',
+                ((count, hour, series_id) for series_id, count in samples))
+
+            # Prune old samples once per hour, when it is first recorded
+            if self._connection.execute(
+                    'INSERT OR IGNORE INTO sample_hours VALUES (?, ?)',
+                    (region, hour)).rowcount:
+                self._connection.execute(
+                    'DELETE FROM samples WHERE series_id IN ('
+                    'SELECT series_id FROM series WHERE region = ?) '
+                    'AND hour < ?', (region, hour - SAMPLE_RETENTION_HOURS))
+                self._connection.execute(
+                    'DELETE FROM sample_hours WHERE region = ? AND hour < ?',
+                    (region, hour - SAMPLE_RETENTION_HOURS))
+
+    def count_sample_hours(self, region, since):
+        """ Count the hours with samples in a region
+
+        :type region: str
+        :param region: The AWS region
+        :type since: float
+        :param since: Timestamp to count from
+        :returns: int
+        """
+        with self._lock:
+            return self._connection.execute(
+                'SELECT COUNT(*) FROM sample_hours '
+                'WHERE region = ? AND hour >= ?',
+                (region, int(since // 3600))).fetchone()[0]
+
+    def iter_group_samples(self, region, since):
+        """ Iterate over the hourly running instance counts of a region
+        summed over the AZs of each (platform, netloc, instance_type)
+        group. The rows are read from the database as they are consumed.
+        Hours in which a group had nothing running are left out.
+
+        :type region: str
+        :param region: The AWS region
+        :type since: float
+        :param since: Timestamp to start from
+        :returns: iterator of ((platform, netloc, instance_type), hour,
+            count)
+        """
+        with self._lock:
+            cursor = self._connection.execute(
+                'SELECT platform, netloc, instance_type, hour, SUM(count) '
+                'FROM samples JOIN series USING (series_id) '
+                'WHERE region = ? AND hour >= ? '
+                'GROUP BY platform, netloc, instance_type, hour',
+                (region, int(since // 3600)))
+
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(1000)
+            if not rows:
+                return
+
+            for platform, netloc, instance_type, hour, count in rows:
+                yield (platform, netloc, instance_type), hour, count
+
+    def _get_series_id(self, region, key):
+        """ Get the id of the series of a key, creating it if needed. Must
+        be called with the lock held.
+
+        :type region: str
+        :param region: The AWS region
+        :type key: tuple
+        :param key: (platform, netloc, instance_type, az)
+        :returns: int
+        """
+        series = (region,) + tuple(key)
+        if series not in self._series:
+            self._connection.execute(
+                'INSERT OR IGNORE INTO series (region, platform, netloc, '
+                'instance_type, az) VALUES (?, ?, ?, ?, ?)', series)
+            self._series[series] = self._connection.execute(
+                'SELECT series_id FROM series WHERE region = ? AND '
+                'platform = ? AND netloc = ? AND instance_type = ? AND '
+                'az = ?', series).fetchone()[0]
+
+        return self._series[series]
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental inventory store
+
+Keeps the running instance counts of a region between cycles. A full scan
+describes every running instance and replaces the counts; in between,
+instance state change events, or the instances launched and stopped since
+the last describe, are applied to them as deltas, so a cycle only costs as
+much as the churn since the last one. Deltas can still miss instances, so
+a full scan is forced every few incremental cycles.
+
+An instance in a delta was counted by the full scan if it was running
+before the scan started, which its launch time, or the time of its event,
+tells. Only the instances that time cannot tell about are kept by id:
+those launched just before the scan, those that were already stopped when
+it ran, and those counted up or down since. That keeps the store small
+whatever the size of the fleet, while no instance is counted twice, e.g.
+when its launch event arrives after a full scan already counted it.
+"""
+import threading
+import time
+
+from dynamic_ec2reservation.inventory import Inventory
+
+# States that add an instance to the running counts, and states that take it
+# out again. The states in between are not counted twice.
+UP_STATES = frozenset(['running'])
+DOWN_STATES = frozenset(['stopped', 'terminated'])
+
+# Longest time since the last describe that the counts are brought up to
+# date from the instances launched and stopped since, in seconds. EC2 only
+# lists terminated instances for about an hour, so after that the
+# terminations could be missed and a full scan is made instead.
+MAX_MERGE_AGE = 45 * 60
+
+# Instances launched this many seconds before a full scan started may be
+# missing from it, as DescribeInstances is eventually consistent and clocks
+# drift, so the scan keeps their ids
+LAUNCH_MARGIN = 15 * 60
+
+
+class InventoryStore(object):
+    """ The last known running instance counts of one region """
+    def __init__(self, full_scan_interval=10):
+        """ Constructor
+
+        :type full_scan_interval: int
+        :param full_scan_interval: Number of incremental cycles after which
+            a full scan is due
+        """
+        self.full_scan_interval = full_scan_interval
+        self.running = None
+        self.scanned_at = None
+        # When the counts were last brought up to date by a describe
+        self.updated_at = None
+        self.incremental_cycles = 0
+        # instance id -> (key, whether it is counted) of the instances whose
+        # launch time does not tell, or None when instances are not tracked
+        self._instances = None
+        # The describe filters of the full scan
+        self._filters = None
+        # When instances are not tracked, the instances already counted up
+        # or down since the last full scan
+        self._up = set()
+        self._down = set()
+        self._lock = threading.Lock()
+
+    def needs_full_scan(self):
+        """ Whether the counts are missing or due to be corrected
+
+        :returns: bool
+        """
+        return self.running is None or \
+            self.incremental_cycles >= self.full_scan_interval
+
+    def can_merge(self, filters):
+        """ Whether the counts can be brought up to date with the instances
+        launched and stopped since the last describe, instead of a full
+        scan
+
+        :type filters: dict
+        :param filters: The DescribeInstances filters the cycle would use
+        :returns: bool
+        """
+        with self._lock:
+            return self._instances is not None and \
+                self._filters == filters and \
+                not self.needs_full_scan() and \
+                time.time() - self.updated_at < MAX_MERGE_AGE
+
+    @property
+    def tracks_instances(self):
+        """ Whether full scans should collect the instances to track, which
+        is only worth it when incremental cycles can follow
+
+        :returns: bool
+        """
+        return self.full_scan_interval > 0
+
+    def replace(self, running, scanned_at=None, instances=None,
+                filters=None):
+        """ Replace the counts with the result of a full scan
+
+        :type running: dynamic_ec2reservation.inventory.Inventory
+        :param running: All running instances in the region
+        :type scanned_at: float
+        :param scanned_at: When the scan started. Defaults to now
+        :type instances: dict
+        :param instances: instance id -> (key, whether it is counted) of
+            the running instances launched less than LAUNCH_MARGIN before
+            the scan and of the instances that were not running, if the
+            scan collected them
+        :type filters: dict
+        :param filters: The DescribeInstances filters of the scan
+        :returns: int, the number of instances that differ from the counts
+            being replaced
+        """
+        with self._lock:
+            changed = 0
+            if self.running is not None:
+                changed = sum(
+                    abs(running[key] - self.running[key])
+                    for key in set(running).union(self.running))
+
+            self.running = Inventory(running.iteritems())
+            self.scanned_at = self.updated_at = scanned_at or time.time()
+            self.incremental_cycles = 0
+            self._instances = dict(instances) if instances is not None \
+                else None
+            self._filters = filters
+            self._up.clear()
+            self._down.clear()
+
+        return changed
+
+    def merge(self, launched, departed):
+        """ Count an incremental cycle and apply the instances launched and
+        stopped or terminated since the last describe. Only possible when
+        can_merge says so.
+
+        :type launched: dict
+        :param launched: instance id -> (key, launch time) of running
+            instances launched since the last describe
+        :type departed: dict
+        :param departed: instance id -> (key, launch time) of instances that
+            are no longer running
+        :returns: int, the number of instances counted up or down
+        """
+        changed = 0
+        with self._lock:
+            self.incremental_cycles += 1
+            self.updated_at = time.time()
+            for instance_id, (key, launched_at) in launched.iteritems():
+                changed += self._count_up(instance_id, key, launched_at)
+            for instance_id, (key, launched_at) in departed.iteritems():
+                changed += self._count_down(instance_id, key, launched_at)
+
+        return changed
+
+    def get_tracked(self):
+        """ Get what the counts can be brought up to date from, for saving
+
+        :returns: tuple of (updated_at, filters, dict of instance id ->
+            (key, whether it is counted)), or None when instances are not
+            tracked
+        """
+        with self._lock:
+            if self._instances is None:
+                return None
+
+            return self.updated_at, self._filters, dict(self._instances)
+
+    def restore(self, running, scanned_at, incremental_cycles, tracked=None):
+        """ Pick up counts saved by a previous run, unless this one already
+        has counts of its own
+
+        :type running: dynamic_ec2reservation.inventory.Inventory
+        :param running: The saved running instance counts
+        :type scanned_at: float
+        :param scanned_at: Timestamp of the full scan they come from
+        :type incremental_cycles: int
+        :param incremental_cycles: Incremental cycles since that full scan
+        :type tracked: tuple
+        :param tracked: (updated_at, filters, instances), as from
+            get_tracked, so the next cycle can be incremental
+        """
+        with self._lock:
+            if self.running is None:
+                self.running = running
+                self.scanned_at = self.updated_at = scanned_at
+                self.incremental_cycles = incremental_cycles
+                if tracked is not None and self.tracks_instances:
+                    self.updated_at, self._filters, self._instances = tracked
+
+    def apply(self, events):
+        """ Apply instance state change events to the counts. Events are
+        ignored until the first full scan.
+
+        :type events: list of dynamic_ec2reservation.events.InstanceEvent
+        :param events: Events with their key resolved
+        :returns: set of the (platform, netloc, instance_type) groups whose
+            counts changed
+        """
+        touched = set()
+        with self._lock:
+            if self.running is None:
+                return touched
+
+            for event in events:
+                if event.state in UP_STATES:
+                    counted = self._count_up(
+                        event.instance_id, event.key, event.time)
+                elif event.state in DOWN_STATES:
+                    counted = self._count_down(
+                        event.instance_id, event.key, stopped_at=event.time)
+                else:
+                    continue
+
+                if counted:
+                    touched.add(event.key[:3])
+
+        return touched
+
+    def _is_counted(self, instance_id, launched_at=None, stopped_at=None):
+        """ Whether a tracked instance is in the counts. Instances that are
+        not tracked by id were counted by the full scan if they started
+        running well before it, and stopped after it started. Must be
+        called with the lock held.
+
+        :type launched_at: float
+        :param launched_at: When the instance started running, if known
+        :type stopped_at: float
+        :param stopped_at: When the instance stopped, if it did
+        :returns: bool
+        """
+        if instance_id in self._instances:
+            return self._instances[instance_id][1]
+
+        return (launched_at is None or
+                launched_at < self.scanned_at - LAUNCH_MARGIN) and \
+            (stopped_at is None or stopped_at >= self.scanned_at)
+
+    def _count_up(self, instance_id, key, launched_at):
+        """ Count a running instance, unless it already is. Must be called
+        with the lock held.
+
+        :type launched_at: float
+        :param launched_at: When the instance started running
+        :returns: int, 1 if it was counted
+        """
+        if self._instances is not None:
+            if self._is_counted(instance_id, launched_at):
+                return 0
+            self._instances[instance_id] = (key, True)
+        elif instance_id in self._up:
+            return 0
+        else:
+            self._up.add(instance_id)
+            self._down.discard(instance_id)
+
+        self.running.add(key)
+        return 1
+
+    def _count_down(self, instance_id, key, launched_at=None,
+                    stopped_at=None):
+        """ Stop counting an instance, if it is counted. Must be called with
+        the lock held.
+
+        :type launched_at: float
+        :param launched_at: When the instance started running, if known
+        :type stopped_at: float
+        :param stopped_at: When the instance stopped, if known
+        :returns: int, 1 if it was counted down
+        """
+        if self._instances is not None:
+            if not self._is_counted(instance_id, launched_at, stopped_at):
+                return 0
+            key = self._instances.get(instance_id, (key,))[0]
+            self._instances[instance_id] = (key, False)
+        elif instance_id in self._down:
+            return 0
+        else:
+            self._down.add(instance_id)
+            self._up.discard(instance_id)
+
+        if self.running[key] > 1:
+            self.running.add(key, -1)
+        elif key in self.running:
+            del self.running[key]
+        return 1
+
+    def get_running(self, predicate):
+        """ Count an incremental cycle and get the counts it covers
+
+        :type predicate: callable
+        :param predicate: Called with each (platform, netloc, instance_type,
+            az) key
+        :returns: dynamic_ec2reservation.inventory.Inventory
+        """
+        with self._lock:
+            self.incremental_cycles += 1
+            return self.running.filter(predicate)
+
+
+__STORES = {}
+__STORES_LOCK = threading.Lock()
+
+def get_store(region, full_scan_interval=10):
+    """ Get the inventory store for a region, kept for the life of the
+    process
+
+    :type region: str
+    :param region: The AWS region
+    :type full_scan_interval: int
+    :param full_scan_interval: Number of incremental cycles after which a
+        full scan is due
+    :returns: InventoryStore
+    """
+    with __STORES_LOCK:
+        if region not in __STORES:
+            __STORES[region] = InventoryStore(full_scan_interval)
+
+        return __STORES[region]
@@ -18,12 +18,16 @@ setup(
     keywords="ec2 aws reservations amazon web services",
     platforms=['Any'],
     packages=['dynamic_ec2reservation'],
+    test_suite='tests',
     scripts=['dynamic-ec2reservation'],
     include_package_data=True,
     zip_safe=True,
     install_requires=[
         'boto >= 2.29.1'
     ],
+    extras_require={
+        'numpy': ['numpy']
+    },
     classifiers=[
         'Development Status :: 2 - Pre-Alpha',
         'Environment :: Console',
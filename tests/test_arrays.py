@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+""" Tests for the array backed inventories """
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from dynamic_ec2reservation import arrays, rebalance
+from dynamic_ec2reservation.inventory import Inventory
+
+GROUPS = [('linux', 'EC2-VPC', 'm4.large'), ('linux', 'EC2-VPC', 'c4.large'),
+          ('windows', 'EC2-VPC', 'm4.large')]
+AZS = ['us-east-1a', 'us-east-1b', 'us-east-1c', 'us-east-1d']
+
+
+def random_inventory(rand, density=0.5, most=6):
+    """ Counts for a random subset of the keys of GROUPS and AZS """
+    inventory = Inventory()
+    for group in GROUPS:
+        for az in AZS:
+            if rand.random() < density:
+                inventory[group + (az,)] = rand.randint(1, most)
+    return inventory
+
+
+def fleets(count=50, seed=0):
+    """ Random (reservations, running instances) pairs """
+    rand = random.Random(seed)
+    return [(random_inventory(rand), random_inventory(rand))
+            for _ in xrange(count)]
+
+
+def covered(reserved, running):
+    """ The running instances the rebalanced reservations cover, worked
+    out with the dict based functions
+    """
+    changes = rebalance.get_changes(reserved.totals(), running, reserved)
+    return sum(min(count, running[key]) for key, count in changes.iteritems())
+
+
+class EquivalenceTests(object):
+    """ get_changes, get_change_diff and get_scenario_coverage give the
+    results of the dict based functions
+    """
+    def test_get_changes(self):
+        for reserved, running in fleets():
+            pool = reserved.totals()
+            self.assertEqual(
+                arrays.get_changes(pool, running, reserved),
+                rebalance.get_changes(pool, running, reserved))
+
+    def test_get_change_diff(self):
+        for reserved, running in fleets():
+            changes = rebalance.get_changes(
+                reserved.totals(), running, reserved)
+            self.assertEqual(
+                arrays.get_change_diff(reserved, changes),
+                rebalance.get_change_diff(reserved, changes))
+
+    def test_get_scenario_coverage(self):
+        rand = random.Random(1)
+        for reserved, _ in fleets(10):
+            scenarios = [random_inventory(rand) for _ in xrange(5)]
+            self.assertEqual(
+                arrays.get_scenario_coverage(reserved, scenarios),
+                [covered(reserved, running) for running in scenarios])
+
+    def test_no_scenarios(self):
+        reserved = Inventory([(GROUPS[0] + (AZS[0],), 2)])
+        self.assertEqual(arrays.get_scenario_coverage(reserved, []), [])
+        self.assertEqual(
+            arrays.get_scenario_coverage(Inventory(), [reserved]), [0])
+
+
+@unittest.skipIf(arrays.numpy is None, 'NumPy is not installed')
+class NumpyEquivalenceTest(EquivalenceTests, unittest.TestCase):
+    """ The equivalence tests with NumPy """
+
+
+class FallbackEquivalenceTest(EquivalenceTests, unittest.TestCase):
+    """ The equivalence tests with the fallback to the dict based functions
+    """
+    def setUp(self):
+        self.numpy = arrays.numpy
+        arrays.numpy = None
+
+    def tearDown(self):
+        arrays.numpy = self.numpy
+
+
+class LoadScenariosTest(unittest.TestCase):
+    """ load_scenarios """
+    def test_load_scenarios(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'scenarios.json')
+            entry = {'platform': 'linux', 'netloc': 'EC2-VPC',
+                     'instance_type': 'm4.large',
+                     'availability_zone': 'us-east-1a', 'count': 2}
+            with open(path, 'w') as scenario_file:
+                json.dump({'b': [entry, entry], 'a': [dict(entry, count=0)]},
+                          scenario_file)
+
+            self.assertEqual(
+                arrays.load_scenarios(path),
+                [('a', Inventory()),
+                 ('b', Inventory([(GROUPS[0] + ('us-east-1a',), 4)]))])
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+""" Tests for change plans """
+import collections
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from dynamic_ec2reservation.changeplan import (
+    PLAN_VERSION, get_fingerprint, get_modifications, get_region_plan,
+    read_plan, write_plan)
+from dynamic_ec2reservation.rebalance import PlannedModification
+from dynamic_ec2reservation.simulation import SimulatedReservedInstance
+
+Snapshot = collections.namedtuple('Snapshot', ['reserved_instances'])
+
+MODIFICATION = PlannedModification(
+    ('linux', 'EC2-VPC', 'm4.large'),
+    ['ri-1'],
+    [(('linux', 'EC2-VPC', 'm4.large', 'us-east-1a'), 1),
+     (('linux', 'EC2-VPC', 'm4.large', 'us-east-1b'), 2)])
+
+
+def reservation(ri_id, availability_zone='us-east-1a', instance_count=3):
+    """ An active Linux/UNIX (Amazon VPC) m4.large reservation """
+    return SimulatedReservedInstance(
+        ri_id, 'm4.large', availability_zone, instance_count,
+        'Linux/UNIX (Amazon VPC)')
+
+
+class GetFingerprintTest(unittest.TestCase):
+    """ get_fingerprint """
+    def test_order_does_not_matter(self):
+        self.assertEqual(
+            get_fingerprint(Snapshot([reservation('ri-1'),
+                                      reservation('ri-2')])),
+            get_fingerprint(Snapshot([reservation('ri-2'),
+                                      reservation('ri-1')])))
+
+    def test_modified_reservation(self):
+        fingerprint = get_fingerprint(Snapshot([reservation('ri-1')]))
+        self.assertNotEqual(
+            fingerprint,
+            get_fingerprint(Snapshot([reservation('ri-1', 'us-east-1b')])))
+        self.assertNotEqual(
+            fingerprint,
+            get_fingerprint(Snapshot([reservation('ri-1', instance_count=2)])))
+        self.assertNotEqual(
+            fingerprint, get_fingerprint(Snapshot([reservation('ri-2')])))
+
+
+class PlanFileTest(unittest.TestCase):
+    """ get_region_plan, get_modifications, write_plan and read_plan """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'plan.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        write_plan(self.path, [
+            get_region_plan('prod/us-west-2', 'us-west-2', 'b', []),
+            get_region_plan(
+                'prod/us-east-1', 'us-east-1', 'a', [MODIFICATION])])
+
+        plan = read_plan(self.path)
+        self.assertEqual(plan['version'], PLAN_VERSION)
+        self.assertEqual(
+            [region_plan['name'] for region_plan in plan['regions']],
+            ['prod/us-east-1', 'prod/us-west-2'])
+        self.assertEqual(plan['regions'][0]['fingerprint'], 'a')
+        self.assertEqual(
+            get_modifications(plan['regions'][0]), [MODIFICATION])
+        self.assertEqual(os.listdir(self.directory), ['plan.json'])
+
+    def test_unsupported_version(self):
+        with open(self.path, 'w') as plan_file:
+            json.dump({'version': PLAN_VERSION + 1, 'regions': []}, plan_file)
+
+        self.assertRaises(ValueError, read_plan, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
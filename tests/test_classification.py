@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+""" Tests for platform classification """
+import unittest
+
+from boto.ec2.image import Image
+from boto.exception import BotoServerError
+
+from dynamic_ec2reservation.classification import (
+    UNKNOWN_IMAGE_PLATFORM, classify_description, classify_image,
+    classify_instance, get_description, get_image_platforms,
+    get_unmatched_platforms, intern_key, is_windows)
+from dynamic_ec2reservation.inventory import Inventory
+from dynamic_ec2reservation.snapshot import InventorySnapshot
+
+
+def image(image_id, name, description=None, billing_products=()):
+    """ An image as DescribeImages returns it """
+    result = Image()
+    result.id = image_id
+    result.name = name
+    result.description = description
+    result.billing_products.extend(billing_products)
+    return result
+
+
+class ImageConnection(object):
+    """ Describes some images, or fails to describe any """
+    def __init__(self, images=(), error=None):
+        self.images = dict((image.id, image) for image in images)
+        self.error = error
+        self.calls = 0
+
+    def get_all_images(self, filters=None):
+        self.calls += 1
+        if self.error:
+            raise self.error
+        return [self.images[image_id] for image_id in filters['image-id']
+                if image_id in self.images]
+
+
+class ClassifyDescriptionTest(unittest.TestCase):
+    """ classify_description """
+    def test_known_descriptions(self):
+        self.assertEqual(
+            classify_description('Linux/UNIX'), ('linux', 'EC2-Classic'))
+        self.assertEqual(
+            classify_description('SUSE Linux (Amazon VPC)'),
+            ('suse', 'EC2-VPC'))
+        self.assertEqual(
+            classify_description(
+                'Windows with SQL Server Standard (Amazon VPC)'),
+            ('windows-sql-standard', 'EC2-VPC'))
+
+    def test_unknown_description(self):
+        self.assertEqual(
+            classify_description('Plan 9 (Amazon VPC)'),
+            ('plan-9', 'EC2-VPC'))
+
+    def test_round_trip(self):
+        for platform in ('linux', 'rhel-ha', 'windows-byol'):
+            for netloc in ('EC2-Classic', 'EC2-VPC'):
+                self.assertEqual(
+                    classify_description(get_description(platform, netloc)),
+                    (platform, netloc))
+
+
+class ClassifyInstanceTest(unittest.TestCase):
+    """ classify_instance """
+    def test_platform_attribute(self):
+        self.assertEqual(
+            classify_instance(None, 'vpc-1'), ('linux', 'EC2-VPC'))
+        self.assertEqual(
+            classify_instance('windows', None), ('windows', 'EC2-Classic'))
+
+    def test_platform_details(self):
+        self.assertEqual(
+            classify_instance(None, 'vpc-1', 'Red Hat Enterprise Linux'),
+            ('rhel', 'EC2-VPC'))
+        self.assertEqual(
+            classify_instance(
+                'windows', 'vpc-1', 'Windows with SQL Server Web'),
+            ('windows-sql-web', 'EC2-VPC'))
+
+    def test_image_platform(self):
+        self.assertEqual(
+            classify_instance(None, 'vpc-1', image_platform='suse'),
+            ('suse', 'EC2-VPC'))
+        self.assertEqual(
+            classify_instance('windows', 'vpc-1', image_platform='rhel'),
+            ('windows', 'EC2-VPC'))
+
+
+class ClassifyImageTest(unittest.TestCase):
+    """ classify_image """
+    def test_billing_products(self):
+        self.assertEqual(
+            classify_image(image(
+                'ami-1', 'golden-2017', billing_products=['bp-6fa54006'])),
+            'rhel')
+
+    def test_names(self):
+        self.assertEqual(
+            classify_image(image(
+                'ami-1', 'RHEL-7.4_HVM_GA-20170808-x86_64-2-Hourly2-GP2',
+                'Provided by Red Hat, Inc.')),
+            'rhel')
+        self.assertEqual(
+            classify_image(image(
+                'ami-2', 'suse-sles-12-sp3-v20171107-hvm-ssd-x86_64')),
+            'suse')
+        self.assertEqual(
+            classify_image(image(
+                'ami-3', 'amzn-ami-hvm-2017.09.1.x86_64-gp2',
+                'Amazon Linux AMI 2017.09.1 x86_64 HVM GP2')),
+            'linux')
+
+
+class GetImagePlatformsTest(unittest.TestCase):
+    """ get_image_platforms """
+    def test_describes_each_image_once(self):
+        connection = ImageConnection([
+            image('ami-11', 'RHEL-7.4_HVM_GA'),
+            image('ami-12', 'amzn-ami-hvm')])
+        snapshot = InventorySnapshot(connection)
+
+        expected = {
+            'ami-11': 'rhel',
+            'ami-12': 'linux',
+            'ami-13': UNKNOWN_IMAGE_PLATFORM}
+        self.assertEqual(
+            get_image_platforms(snapshot, ['ami-11', 'ami-12', 'ami-13']),
+            expected)
+        self.assertEqual(
+            get_image_platforms(snapshot, ['ami-13', 'ami-12', 'ami-11']),
+            expected)
+        self.assertEqual(connection.calls, 1)
+        self.assertEqual(snapshot.api_calls, {'DescribeImages': 1})
+
+    def test_cannot_describe(self):
+        snapshot = InventorySnapshot(ImageConnection(
+            error=BotoServerError(403, 'Forbidden')))
+        self.assertEqual(get_image_platforms(snapshot, ['ami-21']), {})
+        self.assertEqual(
+            classify_instance(None, 'vpc-1', image_platform=None),
+            ('linux', 'EC2-VPC'))
+
+
+class HelpersTest(unittest.TestCase):
+    """ intern_key, is_windows and get_unmatched_platforms """
+    def test_intern_key(self):
+        key = intern_key(('linux', 'EC2-VPC', 'm4.large', 'us-east-1a'))
+        self.assertIs(
+            intern_key(('linux', 'EC2-VPC', 'm4.large', 'us-east-1a')), key)
+
+    def test_is_windows(self):
+        self.assertTrue(is_windows('windows-sql-enterprise'))
+        self.assertFalse(is_windows('rhel'))
+
+    def test_unmatched_platforms(self):
+        reserved = Inventory()
+        reserved[('rhel', 'EC2-VPC', 'm4.large', 'a')] = 1
+        reserved[('rhel-ha', 'EC2-VPC', 'm4.large', 'a')] = 1
+        reserved[('suse', 'EC2-VPC', 'm4.large', 'a')] = 1
+        reserved[('windows', 'EC2-VPC', 'm4.large', 'a')] = 1
+        running = Inventory()
+        running[('suse', 'EC2-VPC', 'm4.large', 'a')] = 1
+
+        self.assertEqual(
+            get_unmatched_platforms(reserved, running), ['rhel-ha'])
+
+
+if __name__ == '__main__':
+    unittest.main()
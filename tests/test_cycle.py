@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+""" Tests for rebalance cycles against simulated fleets """
+import os
+import shutil
+import tempfile
+import unittest
+
+import dynamic_ec2reservation
+from dynamic_ec2reservation import config, config_handler, execute_region
+from dynamic_ec2reservation import get_scheduler, get_state
+from dynamic_ec2reservation import rebalance_regions
+from dynamic_ec2reservation.inventory import Inventory
+from dynamic_ec2reservation.rebalance import (
+    MAX_FILTER_VALUES, get_instance_filters)
+from dynamic_ec2reservation.simulation import SimulatedConnectionFactory
+
+
+def configure(**options):
+    """ Replace the configuration with the defaults and some options """
+    configuration = {
+        'global': dict(config.DEFAULT_OPTIONS['global'], **options),
+        'logging': dict(config.DEFAULT_OPTIONS['logging']),
+        'tables': {},
+        'accounts': {}
+    }
+    configuration['global']['dry_run'] = options.get('dry_run', True)
+    config_handler.CONFIGURATION = configuration
+
+
+class CycleTest(unittest.TestCase):
+    """ Base for tests that run cycles with a throwaway state file """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.directory, 'state.db')
+        self.configuration = config_handler.CONFIGURATION
+
+    def tearDown(self):
+        config_handler.CONFIGURATION = self.configuration
+        shutil.rmtree(self.directory)
+
+
+class SimulatedStateTest(CycleTest):
+    """ get_state with simulated fleets """
+    def test_simulated_fleet_keeps_no_state(self):
+        configure(state_file=self.state_file, run_once=True)
+        factory = SimulatedConnectionFactory(
+            {('linux', 'EC2-VPC', 'm4.large', 'us-east-1a'): 2},
+            [('linux', 'EC2-VPC', 'm4.large', 'us-east-1b', 2)])
+
+        self.assertEqual(get_state(factory), None)
+        result = execute_region('us-east-1', factory, name='simulated-state')
+        self.assertEqual(result.error, None)
+        self.assertFalse(os.path.exists(self.state_file))
+
+
+def moved_fleet(instance_types):
+    """ A fleet with one instance of each type in us-east-1a, reserved in
+    us-east-1b
+    """
+    return SimulatedConnectionFactory(
+        dict((('linux', 'EC2-VPC', instance_type, 'us-east-1a'), 1)
+             for instance_type in instance_types),
+        [('linux', 'EC2-VPC', instance_type, 'us-east-1b', 1)
+         for instance_type in instance_types])
+
+
+class GetInstanceFiltersTest(unittest.TestCase):
+    """ get_instance_filters """
+    def test_no_reservations(self):
+        self.assertEqual(get_instance_filters(Inventory()), None)
+
+    def test_instance_types(self):
+        reserved = Inventory([
+            (('linux', 'EC2-VPC', 'm4.large', 'us-east-1a'), 1),
+            (('windows', 'EC2-VPC', 'c4.large', 'us-east-1a'), 1)])
+        self.assertEqual(
+            get_instance_filters(reserved),
+            {'instance-type': ['c4.large', 'm4.large']})
+        self.assertEqual(
+            get_instance_filters(reserved, flexible=True),
+            {'instance-type': ['c4.large', 'm4.*']})
+
+    def test_too_many_instance_types(self):
+        reserved = Inventory(
+            (('windows', 'EC2-VPC', 'm{0}.large'.format(index), 'us-east-1a'),
+             1)
+            for index in xrange(MAX_FILTER_VALUES + 1))
+        self.assertEqual(
+            get_instance_filters(reserved), {'platform': 'windows'})
+
+
+class FilterLimitTest(CycleTest):
+    """ Cycles with as many reserved instance types as a filter takes, and
+    one more
+    """
+    def run_cycle(self, type_count):
+        configure(run_once=True)
+        instance_types = [
+            'm{0}.large'.format(index) for index in xrange(type_count)]
+        return execute_region(
+            'us-east-1', moved_fleet(instance_types),
+            name='filter-limit-{0}'.format(type_count))
+
+    def test_at_limit(self):
+        result = self.run_cycle(MAX_FILTER_VALUES)
+        self.assertEqual(result.error, None)
+        self.assertEqual(result.changes, MAX_FILTER_VALUES)
+
+    def test_above_limit(self):
+        result = self.run_cycle(MAX_FILTER_VALUES + 1)
+        self.assertEqual(result.error, None)
+        self.assertEqual(result.changes, MAX_FILTER_VALUES + 1)
+
+
+
+class BrokenRegionFactory(SimulatedConnectionFactory):
+    """ A simulated fleet where one region cannot be connected to """
+    def __init__(self, broken, *args):
+        super(BrokenRegionFactory, self).__init__(*args)
+        self.broken = broken
+        self.calls = []
+
+    def __call__(self, region):
+        self.calls.append(region)
+        if region == self.broken:
+            raise ValueError('{0} is broken'.format(region))
+        return super(BrokenRegionFactory, self).__call__(region)
+
+
+class RegionBackoffTest(CycleTest):
+    """ Backing off a failing region without the healthy ones """
+    def test_broken_region_backs_off_alone(self):
+        configure(regions='ap-south-9,us-west-9', instance='backoff-test',
+                  check_interval=400)
+        factory = BrokenRegionFactory(
+            'ap-south-9',
+            {('linux', 'EC2-VPC', 'm4.large', 'us-west-9a'): 1}, [])
+        record_cycle = getattr(dynamic_ec2reservation, '__record_cycle')
+        scheduler = get_scheduler()
+
+        results = rebalance_regions(factory)
+        record_cycle(scheduler, results)
+        self.assertEqual(
+            sorted((result.region, bool(result.error)) for result in results),
+            [('ap-south-9', True), ('us-west-9', False)])
+        self.assertEqual(scheduler.failures, 0)
+        self.assertTrue(scheduler.next_delay() <= 400)
+
+        del factory.calls[:]
+        results = rebalance_regions(factory)
+        self.assertEqual(
+            [result.region for result in results], ['us-west-9'])
+        self.assertEqual(set(factory.calls), set(['us-west-9']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+""" Tests for the modification executor """
+import unittest
+
+from dynamic_ec2reservation.executor import ModificationTracker
+from dynamic_ec2reservation.inventory import Inventory
+from dynamic_ec2reservation.rebalance import (
+    get_modifications, submit_planned_modifications)
+from dynamic_ec2reservation.simulation import (
+    SimulatedEC2Connection, SimulatedReservedInstance)
+from dynamic_ec2reservation.snapshot import InventorySnapshot
+
+LINUX = ('linux', 'EC2-VPC', 'm4.large')
+WINDOWS = ('windows', 'EC2-VPC', 'm4.large')
+
+
+def connection():
+    """ A simulated connection with a linux and a windows reservation in
+    us-east-1a, whose modifications stay processing until fulfilment_delay
+    is lowered
+    """
+    return SimulatedEC2Connection('us-east-1', reserved=[
+        SimulatedReservedInstance(
+            'ri-linux', 'm4.large', 'us-east-1a', 1,
+            'Linux/UNIX (Amazon VPC)'),
+        SimulatedReservedInstance(
+            'ri-windows', 'm4.large', 'us-east-1a', 1,
+            'Windows (Amazon VPC)')], fulfilment_delay=3600)
+
+
+def moves(ec2, tracker):
+    """ Plan moving every reservation of the connection to us-east-1b """
+    return get_modifications(
+        Inventory([(LINUX + ('us-east-1b',), 1),
+                   (WINDOWS + ('us-east-1b',), 1)]),
+        InventorySnapshot(ec2), tracker=tracker)
+
+
+class ModificationTrackerTest(unittest.TestCase):
+    """ ModificationTracker """
+    def setUp(self):
+        self.ec2 = connection()
+        self.tracker = ModificationTracker()
+        linux, = [modification for modification in moves(
+            self.ec2, self.tracker) if modification.group == LINUX]
+        self.modification_id, = submit_planned_modifications(
+            [linux], InventorySnapshot(self.ec2), self.tracker)
+
+    def test_submitted_reservations_are_busy(self):
+        self.assertEqual(self.tracker.submitted, 1)
+        self.assertEqual(list(self.tracker.in_flight), [self.modification_id])
+        self.assertEqual(
+            self.tracker.busy_reservation_ids, frozenset(['ri-linux']))
+        self.assertEqual(
+            self.tracker.refresh(InventorySnapshot(self.ec2)),
+            frozenset(['ri-linux']))
+
+    def test_busy_groups_are_skipped(self):
+        self.tracker.refresh(InventorySnapshot(self.ec2))
+        self.assertEqual(
+            [modification.group
+             for modification in moves(self.ec2, self.tracker)],
+            [WINDOWS])
+
+    def test_modifications_of_others_are_busy(self):
+        self.ec2.modify_reserved_instances(
+            'someone-else', ['ri-windows'],
+            self.ec2.reserved_instances[1:2])
+        self.assertEqual(
+            self.tracker.refresh(InventorySnapshot(self.ec2)),
+            frozenset(['ri-linux', 'ri-windows']))
+        self.assertEqual(moves(self.ec2, self.tracker), [])
+        self.assertEqual(self.tracker.submitted, 1)
+
+    def test_fulfilled(self):
+        self.ec2.fulfilment_delay = 0
+        self.assertEqual(
+            self.tracker.refresh(InventorySnapshot(self.ec2)), frozenset())
+        self.assertEqual(self.tracker.fulfilled, 1)
+        self.assertEqual(self.tracker.in_flight, {})
+        self.assertEqual(len(self.tracker.latencies), 1)
+
+    def test_unknown_modification_dropped(self):
+        self.tracker.add('rimod-unknown', LINUX, ['ri-gone'])
+        self.tracker.refresh(InventorySnapshot(self.ec2))
+        self.assertEqual(list(self.tracker.in_flight), [self.modification_id])
+        self.assertEqual(
+            (self.tracker.fulfilled, self.tracker.failed), (0, 0))
+
+    def test_restored_modifications_are_busy(self):
+        restored = ModificationTracker()
+        restored.restore(self.tracker.in_flight)
+        self.assertEqual(
+            restored.busy_reservation_ids, frozenset(['ri-linux']))
+        self.assertEqual(
+            [modification.group for modification in moves(self.ec2, restored)],
+            [WINDOWS])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+""" Tests for instance size flexibility """
+import unittest
+
+from dynamic_ec2reservation.inventory import Inventory
+from dynamic_ec2reservation.normalization import (
+    SizeNormalizer, get_family_units)
+from dynamic_ec2reservation.rebalance import (
+    get_change_diff, get_size_flexible_changes)
+
+
+def inventory(counts):
+    """ Build a Linux/UNIX VPC inventory from {(instance_type, az): count} """
+    result = Inventory()
+    for (instance_type, az), count in counts.iteritems():
+        result[('linux', 'EC2-VPC', instance_type, az)] = count
+
+    return result
+
+
+class GetFamilyUnitsTest(unittest.TestCase):
+    """ get_family_units """
+    def test_known_size(self):
+        self.assertEqual(get_family_units('m4.large'), ('m4', 16))
+        self.assertEqual(get_family_units('t2.nano'), ('t2', 1))
+
+    def test_unknown_size(self):
+        self.assertEqual(get_family_units('x9.huge'), ('x9.huge', 1))
+
+
+class SizeNormalizerTest(unittest.TestCase):
+    """ SizeNormalizer """
+    def test_round_trip(self):
+        reserved = inventory({('t2.micro', 'a'): 4, ('t2.small', 'a'): 1})
+        running = inventory({('t2.micro', 'a'): 1, ('t2.small', 'a'): 1})
+        normalizer = SizeNormalizer(reserved, running)
+
+        self.assertEqual(
+            normalizer.denormalize(normalizer.normalize(reserved)), reserved)
+
+    def test_group_key(self):
+        reserved = inventory({('m4.large', 'a'): 1})
+        running = inventory({('m4.xlarge', 'a'): 1})
+        normalizer = SizeNormalizer(reserved, running)
+
+        self.assertEqual(
+            normalizer.group_key(('linux', 'EC2-VPC', 'm4.xlarge', 'a')),
+            ('linux', 'EC2-VPC', 'm4'))
+        self.assertEqual(
+            normalizer.group_key(('windows', 'EC2-VPC', 'm4.xlarge', 'a')),
+            ('windows', 'EC2-VPC', 'm4.xlarge'))
+
+
+class GetSizeFlexibleChangesTest(unittest.TestCase):
+    """ get_size_flexible_changes """
+    def assertStable(self, reserved, running):
+        changes, group_key = get_size_flexible_changes(reserved, running)
+        self.assertEqual(
+            get_change_diff(reserved, changes, group_key), Inventory())
+
+    def test_covered_mixed_sizes_are_stable(self):
+        self.assertStable(
+            inventory({('t2.micro', 'a'): 4, ('t2.small', 'a'): 1}),
+            inventory({('t2.micro', 'a'): 1, ('t2.small', 'a'): 1}))
+
+    def test_fully_used_reservations_are_stable(self):
+        self.assertStable(
+            inventory({('m4.large', 'a'): 2, ('m4.xlarge', 'b'): 1}),
+            inventory({('m4.large', 'a'): 3, ('m4.xlarge', 'b'): 1}))
+
+    def test_moves_capacity_across_sizes(self):
+        reserved = inventory({('m4.xlarge', 'a'): 1})
+        running = inventory({('m4.large', 'b'): 2})
+
+        changes, group_key = get_size_flexible_changes(reserved, running)
+
+        self.assertEqual(
+            get_change_diff(reserved, changes, group_key),
+            inventory({('m4.large', 'b'): 2}))
+
+
+if __name__ == '__main__':
+    unittest.main()
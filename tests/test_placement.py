@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+""" Tests for reservation placement """
+import itertools
+import unittest
+
+from dynamic_ec2reservation.inventory import Inventory
+from dynamic_ec2reservation.placement import place_reservations
+from dynamic_ec2reservation.rebalance import get_changes
+
+GROUP = ('linux', 'EC2-VPC', 'm4.large')
+OTHER = ('windows', 'EC2-VPC', 'm4.large')
+
+
+def inventory(items):
+    """ An inventory of (group, az, count) items, added in order """
+    result = Inventory()
+    for group, az, count in items:
+        result[group + (az,)] = count
+    return result
+
+
+class PlaceReservationsTest(unittest.TestCase):
+    """ place_reservations """
+    def test_largest_shortfall_first(self):
+        self.assertEqual(
+            place_reservations(3, {'a': 1, 'b': 4, 'c': 2}),
+            {'b': 3})
+        self.assertEqual(
+            place_reservations(8, {'a': 1, 'b': 4, 'c': 2}),
+            {'a': 1, 'b': 4, 'c': 2})
+
+    def test_ties_by_az_name(self):
+        for azs in itertools.permutations(['c', 'a', 'b']):
+            running = dict((az, 2) for az in azs)
+            self.assertEqual(
+                place_reservations(3, running), {'a': 2, 'b': 1})
+
+    def test_keeps_used_reservations(self):
+        self.assertEqual(
+            place_reservations(3, {'a': 5, 'b': 1}, {'b': 1, 'c': 2}),
+            {'a': 2, 'b': 1})
+
+    def test_kept_reservations_limited_by_pool(self):
+        for azs in itertools.permutations(['c', 'a', 'b']):
+            counts = dict((az, 2) for az in azs)
+            self.assertEqual(
+                place_reservations(3, counts, counts), {'a': 2, 'b': 1})
+
+    def test_leftovers_stay(self):
+        self.assertEqual(
+            place_reservations(5, {'a': 1}, {'b': 2, 'c': 3}),
+            {'a': 1, 'b': 2, 'c': 2})
+
+    def test_unchanged_when_covered(self):
+        current = {'a': 2, 'b': 1}
+        self.assertEqual(
+            place_reservations(3, {'a': 2, 'b': 1}, current), current)
+
+
+class GetChangesTest(unittest.TestCase):
+    """ rebalance.get_changes """
+    def test_same_for_any_order(self):
+        running_items = [(GROUP, 'us-east-1a', 2), (GROUP, 'us-east-1b', 2),
+                         (GROUP, 'us-east-1c', 2), (OTHER, 'us-east-1a', 1)]
+        reserved_items = [(GROUP, 'us-east-1d', 3), (OTHER, 'us-east-1b', 1)]
+        reserved = inventory(reserved_items)
+        expected = inventory([(GROUP, 'us-east-1a', 2),
+                              (GROUP, 'us-east-1b', 1),
+                              (OTHER, 'us-east-1a', 1)])
+
+        for items in itertools.permutations(running_items):
+            self.assertEqual(
+                get_changes(
+                    reserved.totals(), inventory(items),
+                    inventory(reversed(reserved_items))),
+                expected)
+
+    def test_keeps_used_reservations(self):
+        reserved = inventory([(GROUP, 'us-east-1a', 1),
+                              (GROUP, 'us-east-1c', 1)])
+        running = inventory([(GROUP, 'us-east-1a', 1),
+                             (GROUP, 'us-east-1b', 3)])
+        self.assertEqual(
+            get_changes(reserved.totals(), running, reserved),
+            inventory([(GROUP, 'us-east-1a', 1), (GROUP, 'us-east-1b', 1)]))
+
+    def test_unreserved_and_idle_groups(self):
+        reserved = inventory([(OTHER, 'us-east-1a', 2)])
+        running = inventory([(GROUP, 'us-east-1a', 4)])
+        self.assertEqual(
+            get_changes(reserved.totals(), running, reserved), Inventory())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+""" Tests for EC2 API rate limiting """
+import os
+import shutil
+import tempfile
+import unittest
+
+from boto.ec2.connection import EC2Connection
+from boto.exception import BotoServerError
+
+from dynamic_ec2reservation.aws import ratelimit
+from dynamic_ec2reservation.aws.ec2 import get_rate_limit_account
+from dynamic_ec2reservation.aws.ratelimit import (
+    DEFAULT_RATES, RateLimiter, parse_rates)
+
+KEY = 'prod/us-east-1'
+
+
+class FakeClock(object):
+    """ Stands in for the time module, sleeping by moving the clock on """
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.slept += seconds
+
+
+def throttling_error():
+    """ The error EC2 raises for throttled calls """
+    error = BotoServerError(503, 'Service Unavailable')
+    error.error_code = 'RequestLimitExceeded'
+    return error
+
+
+class ParseRatesTest(unittest.TestCase):
+    """ parse_rates """
+    def test_defaults(self):
+        self.assertEqual(parse_rates(None), DEFAULT_RATES)
+
+    def test_rates(self):
+        limits = parse_rates('*=10/40, ModifyReservedInstances=0.5')
+        self.assertEqual(limits['*'], (10.0, 40))
+        self.assertEqual(limits['ModifyReservedInstances'], (0.5, 1))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, parse_rates, 'DescribeInstances')
+        self.assertRaises(ValueError, parse_rates, '*=fast')
+
+
+class RateLimiterTest(unittest.TestCase):
+    """ RateLimiter """
+    def setUp(self):
+        self.clock = FakeClock()
+        self.time = ratelimit.time
+        ratelimit.time = self.clock
+
+    def tearDown(self):
+        ratelimit.time = self.time
+
+    def test_burst_then_rate(self):
+        limiter = RateLimiter({'*': (2.0, 3)})
+        for _ in xrange(3):
+            self.assertEqual(limiter.acquire(KEY, 'DescribeInstances'), 0)
+        self.assertEqual(limiter.acquire(KEY, 'DescribeInstances'), 0.5)
+        self.assertEqual(self.clock.slept, 0.5)
+
+    def test_buckets_are_separate(self):
+        limiter = RateLimiter({'*': (1.0, 1)})
+        limiter.acquire(KEY, 'DescribeInstances')
+        self.assertEqual(limiter.acquire(KEY, 'DescribeReservedInstances'), 0)
+        self.assertEqual(
+            limiter.acquire('prod/eu-west-1', 'DescribeInstances'), 0)
+
+    def test_no_limit(self):
+        limiter = RateLimiter({'*': (0, 0)})
+        for _ in xrange(100):
+            self.assertEqual(limiter.acquire(KEY, 'DescribeInstances'), 0)
+
+    def test_throttling_halves_the_rate(self):
+        limiter = RateLimiter({'*': (4.0, 1)})
+        limiter.acquire(KEY, 'DescribeInstances')
+        limiter.record(KEY, 'DescribeInstances', throttling_error())
+        self.assertEqual(limiter.acquire(KEY, 'DescribeInstances'), 0.5)
+
+        for _ in xrange(100):
+            limiter.record(KEY, 'DescribeInstances')
+        self.clock.now += 10
+        limiter.acquire(KEY, 'DescribeInstances')
+        self.assertEqual(limiter.acquire(KEY, 'DescribeInstances'), 0.25)
+
+    def test_other_errors_do_not_slow_down(self):
+        limiter = RateLimiter({'*': (4.0, 1)})
+        limiter.acquire(KEY, 'DescribeInstances')
+        limiter.record(
+            KEY, 'DescribeInstances', BotoServerError(400, 'Bad Request'))
+        self.assertEqual(limiter.acquire(KEY, 'DescribeInstances'), 0.25)
+
+    def test_shared_file(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'buckets.json')
+            RateLimiter({'*': (1.0, 1)}, path).acquire(
+                KEY, 'DescribeInstances')
+            self.assertEqual(
+                RateLimiter({'*': (1.0, 1)}, path).acquire(
+                    KEY, 'DescribeInstances'),
+                1.0)
+        finally:
+            shutil.rmtree(directory)
+
+
+class GetRateLimitAccountTest(unittest.TestCase):
+    """ get_rate_limit_account """
+    def test_access_key(self):
+        for access_key in ('AKIAFIRST', 'AKIASECOND'):
+            connection = EC2Connection(
+                aws_access_key_id=access_key, aws_secret_access_key='secret')
+            self.assertEqual(get_rate_limit_account(connection), access_key)
+
+    def test_no_access_key(self):
+        self.assertEqual(get_rate_limit_account(object()), 'default')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+""" Tests for the check scheduler """
+import unittest
+
+from boto.exception import BotoServerError
+
+from dynamic_ec2reservation.scheduler import (
+    BACKOFF_BASE, IDLE_CYCLES, Scheduler, is_throttling_error)
+
+
+def throttling_error():
+    """ The error EC2 raises for throttled calls """
+    error = BotoServerError(503, 'Service Unavailable')
+    error.error_code = 'RequestLimitExceeded'
+    return error
+
+
+class SchedulerTest(unittest.TestCase):
+    """ Scheduler """
+    def test_bounds(self):
+        scheduler = Scheduler(400)
+        self.assertEqual(
+            (scheduler.min_interval, scheduler.interval,
+             scheduler.max_interval),
+            (100, 400, 1600))
+
+    def test_zero_check_interval(self):
+        scheduler = Scheduler(0)
+        self.assertEqual(scheduler.interval, 1)
+        self.assertEqual(scheduler.max_interval, 1)
+        delay = scheduler.next_delay()
+        self.assertTrue(0 < delay <= 1)
+
+    def test_max_below_min(self):
+        scheduler = Scheduler(60, min_interval=120, max_interval=30)
+        self.assertEqual(scheduler.interval, 120)
+        self.assertEqual(scheduler.max_interval, 120)
+
+    def test_shrinks_on_changes(self):
+        scheduler = Scheduler(400)
+        scheduler.record(changes=1)
+        self.assertEqual(scheduler.interval, 200)
+        scheduler.record(churn=0.5)
+        self.assertEqual(scheduler.interval, 100)
+        scheduler.record(changes=1)
+        self.assertEqual(scheduler.interval, 100)
+
+    def test_grows_when_idle(self):
+        scheduler = Scheduler(400)
+        for _ in xrange(IDLE_CYCLES - 1):
+            scheduler.record()
+        self.assertEqual(scheduler.interval, 400)
+        scheduler.record()
+        self.assertEqual(scheduler.interval, 800)
+
+    def test_backoff(self):
+        scheduler = Scheduler(400)
+        scheduler.record(errors=[throttling_error()])
+        scheduler.record(errors=[throttling_error()])
+        delay = scheduler.next_delay()
+        self.assertTrue(BACKOFF_BASE <= delay <= 2 * BACKOFF_BASE)
+
+        scheduler.record()
+        self.assertEqual(scheduler.failures, 0)
+        self.assertTrue(scheduler.next_delay() <= scheduler.interval)
+
+    def test_target_backoff(self):
+        scheduler = Scheduler(400)
+        scheduler.record_target('us-east-1')
+        scheduler.record_target('prod/eu-west-1', throttling_error())
+        self.assertTrue(scheduler.is_due('us-east-1'))
+        self.assertFalse(scheduler.is_due('prod/eu-west-1'))
+        self.assertEqual(scheduler.failures, 0)
+
+        scheduler.record_target('prod/eu-west-1', throttling_error())
+        self.assertEqual(scheduler.target_failures['prod/eu-west-1'][0], 2)
+
+        scheduler.record_target('prod/eu-west-1')
+        self.assertTrue(scheduler.is_due('prod/eu-west-1'))
+
+
+class IsThrottlingErrorTest(unittest.TestCase):
+    """ is_throttling_error """
+    def test_is_throttling_error(self):
+        self.assertTrue(is_throttling_error(throttling_error()))
+        self.assertFalse(is_throttling_error(
+            BotoServerError(400, 'Bad Request')))
+        self.assertFalse(is_throttling_error(ValueError()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+""" Tests for reservation selection """
+import collections
+import unittest
+
+from dynamic_ec2reservation.selection import ReservationIndex
+
+Reservation = collections.namedtuple('Reservation', ['id', 'instance_count'])
+
+GROUP = ('linux', 'EC2-VPC', 'm4.large')
+ZONE_A = GROUP + ('us-east-1a',)
+ZONE_B = GROUP + ('us-east-1b',)
+ZONE_C = GROUP + ('us-east-1c',)
+
+
+def index(reservations):
+    """ An index of (key, id, instance count) reservations in GROUP """
+    ris = ReservationIndex()
+    for key, ri_id, count in reservations:
+        ris.add(GROUP, key, Reservation(ri_id, count))
+    return ris
+
+
+class ReservationIndexTest(unittest.TestCase):
+    """ ReservationIndex """
+    def test_counts(self):
+        ris = index([(ZONE_A, 'ri-1', 2), (ZONE_A, 'ri-2', 3),
+                     (ZONE_B, 'ri-3', 1)])
+        self.assertEqual(ris.counts(GROUP), {ZONE_A: 5, ZONE_B: 1})
+        self.assertEqual(
+            sorted(ris.reservation_ids(GROUP)), ['ri-1', 'ri-2', 'ri-3'])
+        self.assertEqual(ris.counts(('windows', 'EC2-VPC', 'm4.large')), {})
+
+    def test_unchanged(self):
+        ris = index([(ZONE_A, 'ri-1', 2)])
+        self.assertEqual(ris.select(GROUP, {ZONE_A: 2}), ([], []))
+
+    def test_smallest_covering_reservation(self):
+        ris = index([(ZONE_A, 'ri-1', 5), (ZONE_A, 'ri-2', 2),
+                     (ZONE_A, 'ri-3', 1)])
+        selected, configurations = ris.select(
+            GROUP, {ZONE_A: 6, ZONE_B: 2})
+        self.assertEqual(selected, ['ri-2'])
+        self.assertEqual(configurations, [(ZONE_B, 2)])
+
+    def test_left_over_stays(self):
+        ris = index([(ZONE_A, 'ri-1', 4), (ZONE_B, 'ri-2', 1)])
+        selected, configurations = ris.select(
+            GROUP, {ZONE_A: 1, ZONE_B: 1, ZONE_C: 3})
+        self.assertEqual(selected, ['ri-1'])
+        self.assertEqual(configurations, [(ZONE_A, 1), (ZONE_C, 3)])
+
+    def test_several_reservations(self):
+        ris = index([(ZONE_A, 'ri-1', 2), (ZONE_A, 'ri-2', 2),
+                     (ZONE_A, 'ri-3', 2)])
+        selected, configurations = ris.select(GROUP, {ZONE_A: 1, ZONE_B: 5})
+        self.assertEqual(sorted(selected), ['ri-1', 'ri-2', 'ri-3'])
+        self.assertEqual(configurations, [(ZONE_A, 1), (ZONE_B, 5)])
+
+
+if __name__ == '__main__':
+    unittest.main()
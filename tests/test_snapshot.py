@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+""" Tests for the per-cycle inventory snapshot """
+import threading
+import time
+import unittest
+
+from dynamic_ec2reservation.rebalance import (
+    get_reserved_instances, get_running_instances)
+from dynamic_ec2reservation.simulation import (
+    SimulatedEC2Connection, SimulatedReservedInstance)
+from dynamic_ec2reservation.snapshot import InventorySnapshot
+
+SMALL = ('linux', 'EC2-VPC', 'm4.large', 'us-east-1a')
+
+
+def connection(running_count=1):
+    """ A simulated connection with one reservation and some instances """
+    return SimulatedEC2Connection(
+        'us-east-1', {SMALL: running_count},
+        [SimulatedReservedInstance(
+            'ri-1', 'm4.large', 'us-east-1a', 1,
+            'Linux/UNIX (Amazon VPC)')])
+
+
+class ApiCallCountTest(unittest.TestCase):
+    """ InventorySnapshot call counting """
+    def test_reserved_instances_fetched_once(self):
+        ec2 = connection()
+        snapshot = InventorySnapshot(ec2)
+        for _ in xrange(3):
+            self.assertEqual(len(get_reserved_instances(snapshot)), 1)
+
+        self.assertEqual(snapshot.api_calls, {'DescribeReservedInstances': 1})
+        self.assertEqual(ec2.api_calls, snapshot.api_calls)
+
+    def test_calls_per_action(self):
+        ec2 = connection(running_count=2500)
+        snapshot = InventorySnapshot(ec2)
+        get_reserved_instances(snapshot)
+        running = get_running_instances(snapshot)
+
+        self.assertEqual(running[SMALL], 2500)
+        self.assertEqual(
+            snapshot.api_calls,
+            {'DescribeReservedInstances': 1, 'DescribeInstances': 3})
+        self.assertEqual(snapshot.api_call_count, 4)
+        self.assertEqual(ec2.api_calls, snapshot.api_calls)
+
+    def test_max_concurrent_requests(self):
+        snapshot = InventorySnapshot(connection(), max_concurrent_requests=2)
+        lock = threading.Lock()
+        in_flight = [0, 0]
+
+        def call():
+            """ Make a slow call, noting the most calls in flight """
+            with snapshot.api_call('DescribeInstances'):
+                with lock:
+                    in_flight[0] += 1
+                    in_flight[1] = max(in_flight)
+                time.sleep(0.02)
+                with lock:
+                    in_flight[0] -= 1
+
+        threads = [threading.Thread(target=call) for _ in xrange(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(in_flight[1], 2)
+        self.assertEqual(snapshot.api_calls, {'DescribeInstances': 6})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+""" Tests for the persistent state """
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from dynamic_ec2reservation.inventory import Inventory
+from dynamic_ec2reservation.state import StateStore
+from dynamic_ec2reservation.store import InventoryStore
+
+SMALL = ('linux', 'EC2-VPC', 'm4.large', 'us-east-1a')
+FILTERS = {'instance-type': ['m4.large'], 'platform': 'windows'}
+
+
+class InventoryStateTest(unittest.TestCase):
+    """ StateStore.save_inventory and load_inventory """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.state = StateStore(os.path.join(self.directory, 'state.db'))
+
+    def tearDown(self):
+        self.state.close()
+        shutil.rmtree(self.directory)
+
+    def test_nothing_saved(self):
+        self.assertEqual(self.state.load_inventory('us-east-1'), None)
+
+    def test_restart_merges(self):
+        store = InventoryStore(full_scan_interval=10)
+        store.replace(
+            Inventory([(SMALL, 2)]), time.time(),
+            {'i-1': (SMALL, True), 'i-2': (SMALL, False)}, FILTERS)
+        self.state.save_inventory(
+            'us-east-1', store.running, store.scanned_at,
+            store.incremental_cycles, store.get_tracked())
+
+        restored = InventoryStore(full_scan_interval=10)
+        restored.restore(*self.state.load_inventory('us-east-1'))
+        self.assertEqual(dict(restored.running.iteritems()), {SMALL: 2})
+        self.assertEqual(restored.get_tracked(), store.get_tracked())
+        self.assertTrue(restored.can_merge(FILTERS))
+
+    def test_untracked(self):
+        store = InventoryStore(full_scan_interval=0)
+        store.replace(Inventory([(SMALL, 1)]))
+        self.state.save_inventory(
+            'us-east-1', store.running, store.scanned_at,
+            store.incremental_cycles, store.get_tracked())
+
+        saved = self.state.load_inventory('us-east-1')
+        self.assertEqual(saved[3], None)
+        restored = InventoryStore(full_scan_interval=10)
+        restored.restore(*saved)
+        self.assertFalse(restored.can_merge(None))
+
+
+if __name__ == '__main__':
+    unittest.main()
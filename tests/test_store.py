@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+""" Tests for the running instance store """
+import time
+import unittest
+
+from dynamic_ec2reservation.events import InstanceEvent
+from dynamic_ec2reservation.inventory import Inventory
+from dynamic_ec2reservation.store import InventoryStore
+
+SMALL = ('linux', 'EC2-VPC', 'm4.large', 'us-east-1a')
+LARGE = ('linux', 'EC2-VPC', 'm4.xlarge', 'us-east-1b')
+FILTERS = {'instance-type': ['m4.*']}
+
+
+def scanned_store():
+    """ A store after a full scan that found i-old, launched long before
+    it, i-recent, launched just before it, and i-stopped, already stopped
+    """
+    store = InventoryStore(full_scan_interval=10)
+    store.replace(
+        Inventory([(SMALL, 2)]), time.time(),
+        {'i-recent': (SMALL, True), 'i-stopped': (SMALL, False)}, FILTERS)
+    return store
+
+
+def event(instance_id, state, key, seconds):
+    """ An event some seconds after the scan of a store """
+    return InstanceEvent(
+        'us-east-1', instance_id, state, key, time.time() + seconds)
+
+
+class ApplyTest(unittest.TestCase):
+    """ InventoryStore.apply """
+    def test_events_for_scanned_instances(self):
+        store = scanned_store()
+        touched = store.apply([
+            event('i-old', 'running', SMALL, -86400),
+            event('i-recent', 'running', SMALL, 10),
+            event('i-gone', 'stopped', SMALL, -60)])
+        self.assertEqual(touched, set())
+        self.assertEqual(store.running[SMALL], 2)
+
+    def test_up_and_down(self):
+        store = scanned_store()
+        touched = store.apply([
+            event('i-new', 'running', LARGE, 60),
+            event('i-new', 'running', LARGE, 60),
+            event('i-old', 'terminated', SMALL, 100),
+            event('i-old', 'stopped', SMALL, 100),
+            event('i-stopped', 'stopped', SMALL, 100)])
+        self.assertEqual(touched, set([SMALL[:3], LARGE[:3]]))
+        self.assertEqual(
+            dict(store.running.iteritems()), {SMALL: 1, LARGE: 1})
+
+    def test_restarted_instance(self):
+        store = scanned_store()
+        store.apply([
+            event('i-old', 'stopped', SMALL, 60),
+            event('i-old', 'running', SMALL, 120)])
+        self.assertEqual(store.running[SMALL], 2)
+
+    def test_without_tracked_instances(self):
+        store = InventoryStore(full_scan_interval=10)
+        store.replace(Inventory([(SMALL, 2)]))
+        store.apply([
+            event('i-1', 'stopped', SMALL, 60),
+            event('i-1', 'stopped', SMALL, 60)])
+        self.assertEqual(store.running[SMALL], 1)
+
+
+class MergeTest(unittest.TestCase):
+    """ InventoryStore.merge """
+    def test_merge(self):
+        store = scanned_store()
+        self.assertTrue(store.can_merge(FILTERS))
+
+        now = time.time()
+        launched = {
+            'i-recent': (SMALL, now - 60),
+            'i-new': (LARGE, now + 60)}
+        departed = {
+            'i-stopped': (SMALL, now - 86400),
+            'i-old': (SMALL, now - 86400),
+            'i-brief': (LARGE, now + 30)}
+        self.assertEqual(store.merge(launched, departed), 2)
+        self.assertEqual(
+            dict(store.running.iteritems()), {SMALL: 1, LARGE: 1})
+        self.assertEqual(store.incremental_cycles, 1)
+
+        self.assertEqual(store.merge(launched, departed), 0)
+        self.assertEqual(
+            dict(store.running.iteritems()), {SMALL: 1, LARGE: 1})
+
+    def test_cannot_merge(self):
+        store = scanned_store()
+        self.assertFalse(store.can_merge({'instance-type': ['c4.*']}))
+
+        store.incremental_cycles = store.full_scan_interval
+        self.assertFalse(store.can_merge(FILTERS))
+
+        store = InventoryStore(full_scan_interval=10)
+        store.replace(Inventory([(SMALL, 1)]))
+        self.assertFalse(store.can_merge(None))
+
+    def test_tracks_instances(self):
+        self.assertTrue(InventoryStore(full_scan_interval=10).tracks_instances)
+        self.assertFalse(InventoryStore(full_scan_interval=0).tracks_instances)
+
+
+if __name__ == '__main__':
+    unittest.main()